@@ -0,0 +1,106 @@
+"""
+Асинхронный режим работы бота на AsyncTeleBot
+
+Получение апдейтов и отправка ответов идут через асинхронный клиент
+Telegram, а работа с Google Sheets (маршрутизация, постановка строки в
+очередь записи) выполняется в пуле потоков, чтобы не блокировать цикл
+событий. Сообщения для одного листа обрабатываются строго по порядку
+поступления, для разных листов — параллельно. Ответы уходят через ту же
+очередь отправки с учётом flood-лимитов, что и в синхронном режиме.
+"""
+
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from telebot.async_telebot import AsyncTeleBot
+
+from send_queue import SendQueue
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPES = ['text', 'document', 'photo', 'video']
+
+
+class KeyedLocks:
+    """asyncio.Lock на каждый ключ; блокировки без очереди ожидающих удаляются"""
+
+    def __init__(self):
+        self._locks = {}
+        self._waiters = {}
+
+    async def run(self, key, coro_factory):
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            async with lock:
+                return await coro_factory()
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+                del self._locks[key]
+
+    def __len__(self):
+        return len(self._locks)
+
+
+def create_async_bot(token, process_message, is_authorized, route_key, commands, sheets_workers=8, send_limits=None):
+    """Создаёт AsyncTeleBot с теми же обработчиками, что и синхронный бот.
+
+    process_message(message, reply) — синхронный конвейер из bot.py;
+    route_key(chat_id) — ключ листа для упорядочивания;
+    commands — словарь {команда: текст ответа};
+    send_limits — параметры SendQueue (лимиты отправки).
+    """
+    bot = AsyncTeleBot(token)
+    executor = ThreadPoolExecutor(max_workers=sheets_workers, thread_name_prefix='sheets')
+    ordering = KeyedLocks()
+    loops = {}
+
+    def send(message, text):
+        # Поток очереди ждёт результата из цикла событий, чтобы увидеть 429 и повторить
+        asyncio.run_coroutine_threadsafe(bot.reply_to(message, text), loops['main']).result()
+
+    send_queue = SendQueue(send, **(send_limits or {})).start()
+
+    for command, text in commands.items():
+        bot.register_message_handler(_command_handler(loops, send_queue, text), commands=[command])
+
+    @bot.message_handler(func=is_authorized, content_types=CONTENT_TYPES)
+    async def handle_message(message):
+        loop = loops.setdefault('main', asyncio.get_running_loop())
+        await ordering.run(
+            route_key(message.chat.id),
+            lambda: loop.run_in_executor(executor, process_message, message, send_queue.reply)
+        )
+
+    bot.sheets_executor = executor
+    bot.send_queue = send_queue
+    return bot
+
+
+def _command_handler(loops, send_queue, text):
+    async def handler(message):
+        loops.setdefault('main', asyncio.get_running_loop())
+        send_queue.reply(message, text)
+    return handler
+
+
+def run_async(token, process_message, is_authorized, route_key, commands, sheets_workers=8, send_limits=None):
+    """Запускает асинхронный polling до остановки процесса"""
+    bot = create_async_bot(token, process_message, is_authorized, route_key, commands, sheets_workers, send_limits)
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        try:
+            await bot.remove_webhook()  # Если ранее работал webhook, getUpdates вернёт 409
+            await bot.infinity_polling()
+        finally:
+            # Дорабатываем принятые сообщения и отправляем ответы, пока цикл событий жив
+            await loop.run_in_executor(None, bot.sheets_executor.shutdown, True)
+            await loop.run_in_executor(None, bot.send_queue.stop, 10)
+            await bot.close_session()
+
+    logger.info(f"⚡ Асинхронный режим: {sheets_workers} потоков для Google Sheets")
+    asyncio.run(main())
@@ -0,0 +1,442 @@
+#!/usr/bin/env python3
+"""
+Офлайн-бенчмарк конвейера обработки сообщений
+
+Прогоняет тысячи синтетических сообщений (корректные счета, счета с
+ошибками, подписи к документам, посторонняя болтовня) через настоящий
+bot.handle_message. Google Sheets и Telegram заменены объектами в памяти.
+Считает сообщений в секунду, задержку до ответа (p50/p95/p99), число
+обращений к Sheets API на сообщение и пиковую память.
+
+Результаты дописываются в bench_results.jsonl (локальная история, не в git)
+и сравниваются с прошлым запуском с теми же параметрами. Кроме того, каждый
+запуск сравнивается с эталоном из bench_baseline.json, который хранится в
+репозитории, — так регрессии видны между версиями, а не только между
+соседними запусками на одной машине. Эталон обновляется флагом
+--update-baseline и коммитится вместе с изменением, которое его сдвинуло.
+
+    python benchmark.py --messages 5000
+    python benchmark.py --messages 2000 --api-latency 50 --fail-on-regression
+    python benchmark.py --update-baseline
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+RESULTS_FILE = 'bench_results.jsonl'
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+SHEETS = {'admin': 'Админ бот', 'snab': 'СНАБ бот текущий'}
+CHATS = {-1001: 'admin', -1002: 'snab', -1003: 'snab'}
+MIX = (('valid', 0.6), ('invalid', 0.15), ('caption', 0.1), ('chatter', 0.15))
+COMPARED = (
+    ('messages_per_second', 'больше'),
+    ('latency_p95_ms', 'меньше'),
+    ('api_calls_per_message', 'меньше'),
+    ('peak_memory_kb', 'меньше'),
+)
+
+
+class FakeWorksheet:
+    """Лист gspread в памяти; каждое обращение считается как вызов API"""
+
+    def __init__(self, spreadsheet, title, sheet_id, row_count, existing_rows):
+        self.spreadsheet = spreadsheet
+        self.spreadsheet_id = spreadsheet.id
+        self.title = title
+        self.id = sheet_id
+        self.row_count = row_count
+        self.rows = {1: ['Дата', 'Реквизиты счета']}
+        for n in range(2, existing_rows + 2):
+            self.rows[n] = ['01.01.2024', f'Старый счет {n}', '', '', '', '', '', '', '100,00', 'ООО Архив']
+        self._lock = threading.Lock()
+
+    def col_values(self, col):
+        self.spreadsheet.api_call('col_values')
+        with self._lock:
+            cells = [self.rows.get(n, []) for n in range(1, max(self.rows, default=0) + 1)]
+        return [row[col - 1] if len(row) >= col else '' for row in cells]
+
+    def get(self, range_name):
+        self.spreadsheet.api_call('get')
+        first, last = (int(cell.lstrip('ABCDEFGHIJKLMNOPQRSTUVWXYZ')) for cell in range_name.split(':'))
+        with self._lock:
+            rows = [self.rows.get(n, []) for n in range(first, last + 1)]
+        while rows and not rows[-1]:
+            rows.pop()
+        return rows
+
+    def add_rows(self, rows):
+        self.spreadsheet.api_call('add_rows')
+        self.row_count += rows
+
+    def batch_update(self, data, **kwargs):
+        self.spreadsheet.api_call('batch_update')
+        with self._lock:
+            for item in data:
+                self.rows[int(item['range'].split(':')[0].lstrip('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))] = item['values'][0]
+
+
+class FakeSpreadsheet:
+    def __init__(self, spreadsheet_id, api_latency, row_count, existing_rows):
+        self.id = spreadsheet_id
+        self.api_latency = api_latency
+        self.calls = {}
+        self._lock = threading.Lock()
+        self._worksheets = [
+            FakeWorksheet(self, title, sheet_id, row_count, existing_rows)
+            for sheet_id, title in enumerate(SHEETS.values())
+        ]
+
+    def api_call(self, name):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+        if self.api_latency:
+            time.sleep(self.api_latency)
+
+    def worksheets(self):
+        self.api_call('worksheets')
+        return list(self._worksheets)
+
+    def worksheet(self, title):
+        self.api_call('worksheet')
+        return next(ws for ws in self._worksheets if ws.title == title)
+
+
+class FakeClient:
+    """Замена gspread.Client: открывает таблицы в памяти"""
+
+    def __init__(self, args):
+        self.args = args
+        self.spreadsheets = {}
+
+    def open_by_key(self, key):
+        if key not in self.spreadsheets:
+            self.spreadsheets[key] = FakeSpreadsheet(
+                key, self.args.api_latency / 1000.0, self.args.row_count, self.args.existing_rows
+            )
+        self.spreadsheets[key].api_call('open_by_key')
+        return self.spreadsheets[key]
+
+    def api_calls(self):
+        return sum(sum(sheet.calls.values()) for sheet in self.spreadsheets.values())
+
+
+class FakeTelegram:
+    """Записывает ответы бота вместо отправки в Telegram"""
+
+    def __init__(self):
+        self.replies = {}
+        self.count = 0
+        self._cond = threading.Condition()
+
+    def reply_to(self, message, text):
+        with self._cond:
+            self.replies.setdefault((message.chat.id, message.message_id), []).append((time.perf_counter(), text))
+            self.count += 1
+            self._cond.notify_all()
+
+    def wait_for(self, count, timeout):
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self.count < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+
+def make_message(chat_id, message_id, kind, rng):
+    """Синтетическое сообщение Telegram нужного вида"""
+    amount = f"{rng.randint(100, 999999)},{rng.randint(0, 99):02d}"
+    invoice = (
+        f"@paycollect_bot 01.02.2025 - Счет {message_id} от 01.02.2025 - Объект{chat_id % 7} - Стройка МСК - "
+        f"Этап 3 - Оплата за окна - Оплата за окна алюминий - {amount} - ООО Поставщик {message_id % 50} - ООО Дом"
+    )
+    if kind == 'invalid':
+        invoice = invoice.replace('01.02.2025 - ', '1 февраля - ', 1).replace(amount, '30 500 руб')
+    elif kind == 'chatter':
+        invoice = rng.choice(['Добрый день, счёт во вложении', 'Принято', 'Когда оплата?', 'Спасибо!'])
+    message = SimpleNamespace(
+        message_id=message_id,
+        chat=SimpleNamespace(id=chat_id, type='supergroup'),
+        from_user=SimpleNamespace(id=1, username='bench'),
+        content_type='document' if kind == 'caption' else 'text',
+        text=None if kind == 'caption' else invoice,
+        caption=invoice if kind == 'caption' else None
+    )
+    return message
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def git_version():
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, timeout=5
+        ).stdout.strip() or 'unknown'
+    except (OSError, subprocess.SubprocessError):
+        return 'unknown'
+
+
+def prepare_environment(args, workdir):
+    """Переменные окружения для bot.py: фейковые ключи, файлы во временном каталоге"""
+    os.environ.update({
+        'TELEGRAM_TOKEN': '123456:benchmark',
+        'SPREADSHEET_ID': 'benchmark-sheet',
+        'CHAT_ADMIN_ID': ','.join(str(c) for c, role in CHATS.items() if role == 'admin'),
+        'CHAT_SNAB_ID': ','.join(str(c) for c, role in CHATS.items() if role == 'snab'),
+        'SHEET_ADMIN_NAME': SHEETS['admin'],
+        'SHEET_SNAB_NAME': SHEETS['snab'],
+        'ROUTES_FILE': os.path.join(workdir, 'routes.json'),
+        'SHARDS_FILE': os.path.join(workdir, 'shards.json'),
+        'SHARDS_STATE_FILE': os.path.join(workdir, 'shard_assignments.json'),
+        'SHEET_REDIRECTS_FILE': os.path.join(workdir, 'sheet_redirects.json'),
+        'JOURNAL_PATH': os.path.join(workdir, 'journal.db'),
+        'LOG_FILE': os.path.join(workdir, 'bot.log'),
+        'LOG_LEVEL': args.log_level,
+        'BOT_STATS_SOCKET': os.path.join(workdir, 'stats.sock'),
+        'METRICS_PORT': '0',
+        'WRITE_BATCH_WINDOW': str(args.batch_window),
+        'WORKER_QUEUE_SIZE': str(args.queue_size or args.messages),
+        'WORKER_KEY_BACKLOG': str(args.queue_size or args.messages),
+        # Фейковый Telegram не ограничивает частоту — меряем конвейер, а не flood-лимиты
+        'TELEGRAM_SEND_PER_SECOND': '1000000',
+        'TELEGRAM_GROUP_PER_MINUTE': '1000000',
+    })
+    if args.shards:
+        # Счета распределяются по проектам между таблицами benchmark-shard-N
+        shards = {f'shard-{n}': {'spreadsheet_id': f'benchmark-shard-{n}'} for n in range(args.shards)}
+        with open(os.environ['SHARDS_FILE'], 'w', encoding='utf8') as f:
+            json.dump({'key': 'project', 'shards': shards}, f)
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix='paycollect-bench-')
+    prepare_environment(args, workdir)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from sheets_client import SheetsClientFactory
+    client = FakeClient(args)
+    SheetsClientFactory.client = lambda self: client
+    SheetsClientFactory.start_refresher = lambda self: self
+    import bot
+
+    telegram = FakeTelegram()
+    bot.send_queue.send = telegram.reply_to
+    bot.start_services()
+    bot.sheets_connection.wait_ready(30)
+    time.sleep(0.2)  # Прогрев, загрузка индекса счетов и курсоров — вне замера
+
+    kinds = rng.choices([kind for kind, _ in MIX], weights=[weight for _, weight in MIX], k=args.messages)
+    chat_ids = list(CHATS)
+    messages = [(kind, make_message(chat_ids[i % len(chat_ids)], i + 1, kind, rng)) for i, kind in enumerate(kinds)]
+    expected_replies = sum(1 for kind in kinds if kind != 'chatter')
+
+    calls_before = client.api_calls()
+    tracemalloc.start()
+    submitted = {}
+    started = time.perf_counter()
+    interval = 1.0 / args.rate if args.rate else 0
+    for n, (kind, message) in enumerate(messages):
+        if interval:
+            delay = started + n * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        submitted[(message.chat.id, message.message_id)] = (kind, time.perf_counter())
+        bot.handle_message(message)
+    completed = telegram.wait_for(expected_replies, args.timeout)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    api_calls = client.api_calls() - calls_before
+    bot.stop_services()
+
+    latencies = {}
+    overloaded = 0
+    for key, (kind, sent_at) in submitted.items():
+        replies = telegram.replies.get(key)
+        if not replies:
+            continue
+        if any('перегружен' in text for _, text in replies):
+            overloaded += 1
+        latencies.setdefault(kind, []).append((replies[-1][0] - sent_at) * 1000)
+    all_latencies = [value for values in latencies.values() for value in values]
+
+    stages = {}
+    for stage in ('parse', 'validate', 'route', 'row_lookup', 'sheet_write', 'telegram_reply'):
+        histogram = bot.metrics.stage(stage)
+        if histogram is not None:
+            stages[stage] = {'count': histogram.count, 'p50_ms': histogram.quantile(0.5) * 1000,
+                             'p95_ms': histogram.quantile(0.95) * 1000}
+
+    return {
+        'completed': completed,
+        'messages': args.messages,
+        'replies': telegram.count,
+        'expected_replies': expected_replies,
+        'overloaded': overloaded,
+        'elapsed_s': round(elapsed, 3),
+        'messages_per_second': round(args.messages / elapsed, 1),
+        'latency_p50_ms': round(percentile(all_latencies, 0.50), 2),
+        'latency_p95_ms': round(percentile(all_latencies, 0.95), 2),
+        'latency_p99_ms': round(percentile(all_latencies, 0.99), 2),
+        'latency_by_kind_p95_ms': {kind: round(percentile(values, 0.95), 2) for kind, values in latencies.items()},
+        'api_calls': api_calls,
+        'api_calls_per_message': round(api_calls / args.messages, 4),
+        'api_calls_by_method': {key: sum(s.calls.get(key, 0) for s in client.spreadsheets.values())
+                                for key in sorted({k for s in client.spreadsheets.values() for k in s.calls})},
+        'peak_memory_kb': round(peak / 1024, 1),
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'stages': stages,
+    }
+
+
+def params_of(args):
+    return {key: getattr(args, key) for key in
+            ('messages', 'rate', 'api_latency', 'batch_window', 'queue_size', 'existing_rows', 'row_count', 'seed',
+             'shards')}
+
+
+def previous_result(path, params):
+    """Последний сохранённый запуск с теми же параметрами"""
+    if not os.path.exists(path):
+        return None
+    last = None
+    with open(path, encoding='utf8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get('params') == params:
+                last = entry
+    return last
+
+
+def load_baseline(path):
+    """Эталонные запуски из bench_baseline.json (список записей с params и results)"""
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf8') as f:
+        return json.load(f)
+
+
+def baseline_result(baseline, params):
+    """Эталонный запуск с теми же параметрами"""
+    for entry in baseline:
+        if entry.get('params') == params:
+            return entry
+    return None
+
+
+def save_baseline(path, baseline, entry):
+    """Заменяет эталон для параметров entry, остальные эталоны не трогает"""
+    baseline = [item for item in baseline if item.get('params') != entry['params']] + [entry]
+    with open(path, 'w', encoding='utf8') as f:
+        json.dump(baseline, f, ensure_ascii=False, indent=2)
+        f.write('\n')
+
+
+def compare(previous, results, threshold, title='Сравнение с'):
+    """Печатает изменения относительно прошлого запуска; возвращает список регрессий"""
+    regressions = []
+    print(f"\n📊 {title} {previous['version']} ({previous['timestamp']}):")
+    for key, better in COMPARED:
+        old, new = previous['results'].get(key), results.get(key)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        worse = change < -threshold if better == 'больше' else change > threshold
+        mark = '🔴' if worse else '🟢'
+        print(f"   {mark} {key}: {old} -> {new} ({change:+.1%})")
+        if worse:
+            regressions.append(key)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Офлайн-бенчмарк конвейера PayCollect Bot')
+    parser.add_argument('--messages', type=int, default=5000, help='Число синтетических сообщений')
+    parser.add_argument('--rate', type=float, default=0, help='Сообщений в секунду на входе (0 — без ограничения)')
+    parser.add_argument('--api-latency', type=float, default=0, help='Задержка каждого вызова Sheets API, мс')
+    parser.add_argument('--batch-window', type=float, default=0.5, help='WRITE_BATCH_WINDOW, сек')
+    parser.add_argument('--existing-rows', type=int, default=1000, help='Строк в листах до начала замера')
+    parser.add_argument('--row-count', type=int, default=100000, help='Размер листов')
+    parser.add_argument('--shards', type=int, default=0, help='Число таблиц-шардов (0 — одна таблица)')
+    parser.add_argument('--seed', type=int, default=1, help='Seed генератора сообщений')
+    parser.add_argument('--timeout', type=float, default=120, help='Сколько ждать всех ответов, сек')
+    parser.add_argument('--queue-size', type=int, default=0,
+                        help='WORKER_QUEUE_SIZE и WORKER_KEY_BACKLOG (0 — вместить все сообщения)')
+    parser.add_argument('--log-level', default='CRITICAL',
+                        help='LOG_LEVEL бота на время замера (INFO — с учётом стоимости логирования)')
+    parser.add_argument('--results', default=RESULTS_FILE, help='Файл истории результатов (JSON lines)')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='Эталонные результаты из репозитория (JSON)')
+    parser.add_argument('--update-baseline', action='store_true', help='Записать этот запуск как эталон')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Допустимое ухудшение, доля')
+    parser.add_argument('--fail-on-regression', action='store_true', help='Код возврата 1 при регрессии')
+    args = parser.parse_args()
+
+    print(f"🏁 Бенчмарк: {args.messages} сообщений, задержка API {args.api_latency} мс")
+    results = run(args)
+    params = params_of(args)
+
+    print(f"   ⚡ {results['messages_per_second']} сообщений/с за {results['elapsed_s']} с")
+    print(f"   ⏱️ задержка до ответа p50/p95/p99: {results['latency_p50_ms']} / "
+          f"{results['latency_p95_ms']} / {results['latency_p99_ms']} мс")
+    print(f"   📡 вызовов Sheets API: {results['api_calls']} ({results['api_calls_per_message']} на сообщение)")
+    print(f"   🧠 пик памяти (tracemalloc): {results['peak_memory_kb']} КБ, max RSS: {results['max_rss_kb']} КБ")
+    if not results['completed']:
+        print(f"   ⚠️ получено {results['replies']} ответов из {results['expected_replies']} за {args.timeout} с")
+    if results['overloaded']:
+        print(f"   ⚠️ отклонено из-за перегрузки пула: {results['overloaded']}")
+
+    previous = previous_result(args.results, params)
+    entry = {
+        'version': git_version(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'params': params,
+        'results': results
+    }
+    with open(args.results, 'a', encoding='utf8') as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+    print(f"💾 Результат сохранён в {args.results}")
+
+    regressions = compare(previous, results, args.threshold) if previous else []
+
+    baseline = load_baseline(args.baseline)
+    reference = baseline_result(baseline, params)
+    if reference:
+        regressions += compare(reference, results, args.threshold, title='Сравнение с эталоном')
+    elif not args.update_baseline:
+        print(f"\nℹ️ Эталона для этих параметров нет в {args.baseline} (--update-baseline, чтобы записать)")
+    if args.update_baseline:
+        save_baseline(args.baseline, baseline, entry)
+        print(f"📌 Эталон обновлён в {args.baseline}")
+    sys.stdout.flush()
+    # Фоновые потоки бота не должны задерживать выход
+    if regressions and args.fail_on_regression:
+        os._exit(1)
+    os._exit(0 if results['completed'] else 2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,268 +1,712 @@
 import telebot
-import gspread
 import traceback
-import re
 import os
 import logging
+import threading
 from dotenv import load_dotenv
+from gspread.http_client import HTTPClient
+from async_bot import run_async
+from capacity import CapacityManager, period_title, roll_over
+from circuit_breaker import BreakerRegistry, breaker_http_client
+from dedupe import InvoiceIndex, ProcessedIndex, build_index_from_worksheet, sheet_row_url
+from invoice_parser import InvoiceParser, telegram_link
+from journal import InvoiceJournal, JournalCommitter
+from log_pipeline import setup_logging
+from metrics import MetricsRegistry, serve_metrics
+from rate_limiter import SheetsRateLimiter, limited_http_client, register_limiter_metrics
+from reference import ReferenceDictionaries, load_reference_sheet
+from routing import ChatRouter, config_from_env
+from row_cursor import RowCursorRegistry
+from send_queue import SendQueue
+from sheets_client import SheetsClientFactory
+from sheets_connection import LazySheetsConnection
+from shards import ShardMap, ShardWriter
+from sinks import SINK_CSV, SINK_SHEETS, SINK_SQLITE, CSVSink, SheetsSink, SQLiteSink
+from stats_channel import StatsPublisher
+from worksheet_cache import WorksheetCache
+from worker_pool import KeyedWorkerPool, PoolFullError
+from write_queue import NoFreeRowError, WriteBehindQueue
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('bot.log'),
-        logging.StreamHandler()
-    ]
+load_dotenv()  # Загрузка переменных окружения из .env файла
+
+# Настройка логирования: запись в файл и консоль идёт в фоновом потоке
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")  # Файл логов (JSON-строки)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")  # Общий уровень логирования
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")  # Уровни отдельных логгеров, например telebot=WARNING,write_queue=DEBUG
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))  # Ротация по размеру файла, байт
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))  # Сколько старых файлов логов хранить
+LOG_ROTATE_INTERVAL = float(os.getenv("LOG_ROTATE_INTERVAL", "86400"))  # Ротация по времени, сек (0 — выключена)
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))  # Записей в очереди до прореживания и сброса
+LOG_CONSOLE = os.getenv("LOG_CONSOLE", "1") == "1"  # Дублировать логи в stderr (manage.py выключает: 0)
+log_listener = setup_logging(
+    LOG_FILE,
+    level=LOG_LEVEL,
+    levels=LOG_LEVELS,
+    max_bytes=LOG_MAX_BYTES,
+    backup_count=LOG_BACKUP_COUNT,
+    rotate_interval=LOG_ROTATE_INTERVAL,
+    queue_size=LOG_QUEUE_SIZE,
+    console=LOG_CONSOLE
 )
 logger = logging.getLogger(__name__)
 
-load_dotenv()  # Загрузка переменных окружения из .env файла
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")  # Замените на токен вашего бота или добавьте в .env
 SPREADSHEET_ID = os.getenv("SPREADSHEET_ID")  # Замените на ID вашей Google таблицы (только ID) или добавьте в .env
 SHEET_ADMIN_NAME = os.getenv("SHEET_ADMIN_NAME", "Админ бот")  # Лист для админ бота
 SHEET_SNAB_NAME = os.getenv("SHEET_SNAB_NAME", "СНАБ бот текущий")  # Лист для снаб бота
 CHAT_ADMIN_ID = os.getenv("CHAT_ADMIN_ID", "")  # ID чатов админ бота
 CHAT_SNAB_ID = os.getenv("CHAT_SNAB_ID", "")  # ID чатов снаб бота
+WRITE_BATCH_WINDOW = float(os.getenv("WRITE_BATCH_WINDOW", "0.5"))  # Окно накопления строк перед записью, сек
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "50"))  # Максимум строк в одной пачке
+ROW_CURSOR_RESYNC = float(os.getenv("ROW_CURSOR_RESYNC", "300"))  # Период сверки курсора строк с таблицей, сек
+WORKSHEET_CACHE_TTL = float(os.getenv("WORKSHEET_CACHE_TTL", "600"))  # Время жизни кэша листов, сек
+SHEETS_WARMUP_TIMEOUT = float(os.getenv("SHEETS_WARMUP_TIMEOUT", "60"))  # Сколько сообщение ждёт подключения к Sheets, сек
+SHEETS_CONNECT_RETRY = float(os.getenv("SHEETS_CONNECT_RETRY", "10"))  # Пауза между попытками подключения, сек
+SHEETS_HTTP_POOL = int(os.getenv("SHEETS_HTTP_POOL", "10"))  # Keep-alive соединений к Google API
+SHEETS_TOKEN_MARGIN = float(os.getenv("SHEETS_TOKEN_MARGIN", "300"))  # За сколько секунд до истечения обновлять токен
+ROUTES_FILE = os.getenv("ROUTES_FILE", "routes.json")  # Файл маршрутов чатов (если нет — берутся CHAT_*_ID)
+ROUTES_WATCH_INTERVAL = float(os.getenv("ROUTES_WATCH_INTERVAL", "5"))  # Период проверки файла маршрутов, сек
+SHEET_GROW_CHUNK = int(os.getenv("SHEET_GROW_CHUNK", "1000"))  # На сколько строк расширять лист за раз
+SHEET_GROW_HEADROOM = int(os.getenv("SHEET_GROW_HEADROOM", "200"))  # Запас свободных строк, при котором лист расширяется
+SHEET_MAX_ROWS = int(os.getenv("SHEET_MAX_ROWS", "0"))  # Предел строк листа, затем новый лист периода (0 — без предела)
+SHEET_HEADER_ROWS = int(os.getenv("SHEET_HEADER_ROWS", "1"))  # Строк шапки, копируемых в новый лист
+SHEET_PERIOD_FORMAT = os.getenv("SHEET_PERIOD_FORMAT", "%Y-%m")  # Суффикс названия нового листа (strftime)
+SHARDS_FILE = os.getenv("SHARDS_FILE", "shards.json")  # Карта таблиц-шардов (если нет — всё пишется в SPREADSHEET_ID)
+SHARDS_STATE_FILE = os.getenv("SHARDS_STATE_FILE", "shard_assignments.json")  # Закрепления чатов/проектов за шардами
+SHEET_REDIRECTS_FILE = os.getenv("SHEET_REDIRECTS_FILE", "sheet_redirects.json")  # Переадресации заполненных листов
+BOT_RUNTIME = os.getenv("BOT_RUNTIME", "polling")  # polling — TeleBot, async — AsyncTeleBot
+ASYNC_SHEETS_WORKERS = int(os.getenv("ASYNC_SHEETS_WORKERS", "8"))  # Потоки для работы с Sheets в async режиме
+WORKER_POOL_SIZE = int(os.getenv("WORKER_POOL_SIZE", "4"))  # Потоки обработки сообщений в режиме polling
+WORKER_QUEUE_SIZE = int(os.getenv("WORKER_QUEUE_SIZE", "1000"))  # Максимум сообщений в очереди пула
+WORKER_KEY_BACKLOG = int(os.getenv("WORKER_KEY_BACKLOG", "200"))  # Максимум сообщений в очереди одного листа
+JOURNAL_PATH = os.getenv("JOURNAL_PATH", "journal.db")  # Локальный журнал счетов (SQLite)
+JOURNAL_RETRY_INTERVAL = float(os.getenv("JOURNAL_RETRY_INTERVAL", "30"))  # Период повторной записи из журнала, сек
+SHEETS_READS_PER_MINUTE = int(os.getenv("SHEETS_READS_PER_MINUTE", "60"))  # Квота чтения Sheets API, запросов/мин
+SHEETS_WRITES_PER_MINUTE = int(os.getenv("SHEETS_WRITES_PER_MINUTE", "60"))  # Квота записи Sheets API, запросов/мин
+SHEETS_MAX_RETRIES = int(os.getenv("SHEETS_MAX_RETRIES", "6"))  # Повторов при 429/5xx перед ошибкой
+SHEETS_BREAKER_THRESHOLD = int(os.getenv("SHEETS_BREAKER_THRESHOLD", "5"))  # Ошибок подряд до деградированного режима
+SHEETS_BREAKER_RESET = float(os.getenv("SHEETS_BREAKER_RESET", "60"))  # Пауза перед пробным запросом, сек
+BOT_STATS_SOCKET = os.getenv("BOT_STATS_SOCKET", ".bot_stats.sock")  # UNIX-сокет monitor.py для статистики бота
+BOT_STATS_INTERVAL = float(os.getenv("BOT_STATS_INTERVAL", "1"))  # Период отправки статистики в monitor.py, сек
+DEDUPE_MAX_ENTRIES = int(os.getenv("DEDUPE_MAX_ENTRIES", "50000"))  # Сколько последних сообщений помнить для защиты от дублей
+INVOICE_INDEX_CHUNK = int(os.getenv("INVOICE_INDEX_CHUNK", "1000"))  # Строк за один запрос при построении индекса счетов
+TELEGRAM_SEND_PER_SECOND = float(os.getenv("TELEGRAM_SEND_PER_SECOND", "30"))  # Общий лимит отправки бота, сообщений/с
+TELEGRAM_GROUP_PER_MINUTE = float(os.getenv("TELEGRAM_GROUP_PER_MINUTE", "20"))  # Лимит отправки в одну группу, сообщений/мин
+TELEGRAM_SEND_WORKERS = int(os.getenv("TELEGRAM_SEND_WORKERS", "4"))  # Потоки очереди отправки ответов
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")  # Адрес HTTP-сервера метрик
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))  # Порт /metrics (0 — не запускать)
+SINK_SQLITE_PATH = os.getenv("SINK_SQLITE_PATH", "registry.db")  # База для ролей с "sink": "sqlite"
+REFERENCE_SHEET = os.getenv("REFERENCE_SHEET", "")  # Лист-справочник проектов, регионов, этапов, категорий, поставщиков
+REFERENCE_TTL = float(os.getenv("REFERENCE_TTL", "600"))  # Период обновления справочников, сек
+REFERENCE_MATCH_THRESHOLD = float(os.getenv("REFERENCE_MATCH_THRESHOLD", "0.5"))  # Порог похожести для подсказок (0..1)
+SINK_CSV_DIR = os.getenv("SINK_CSV_DIR", "registry_csv")  # Каталог CSV-файлов для ролей с "sink": "csv"
 CREDENTIALS_FILE = 'your_credentials_file.json'
 
 
+def runtime_snapshot():
+    """Счётчики и состояние бота для monitor.py"""
+    return {
+        'messages': metrics.totals('messages_total', 'outcome'),
+        'sheets_breaker': sheets_breaker.status(),
+        'sheets_breakers': sheets_breakers.status(),
+        'sheets_connection': dict(sheets_connection.status(), **sheets_factory.stats()),
+        'sheets_limiter': limiter_stats(),
+        'queues': {
+            'handler': message_pool.stats()['queued'],
+            'write': write_pending(),
+            'send': send_queue.pending_count(),
+            'journal': journal.pending_count()
+        }
+    }
+
+# Статистика уходит в monitor.py датаграммами, без разбора логов
+stats_publisher = StatsPublisher(BOT_STATS_SOCKET, runtime_snapshot, interval=BOT_STATS_INTERVAL)
+
 # --- Авторизация в Google Sheets ---
-scope = [
-       'https://www.googleapis.com/auth/spreadsheets',
-       'https://www.googleapis.com/auth/drive'
-   ]
+def create_sheets_limiter():
+    return SheetsRateLimiter(
+        reads_per_minute=SHEETS_READS_PER_MINUTE,
+        writes_per_minute=SHEETS_WRITES_PER_MINUTE,
+        max_retries=SHEETS_MAX_RETRIES
+    )
+
+# Все запросы к Sheets (чтение, запись, метаданные) идут через ограничитель квоты
+sheets_limiter = create_sheets_limiter()
+# Свой выключатель у каждой таблицы: сбой одного шарда не переводит остальные в деградированный режим
+sheets_breakers = BreakerRegistry(
+    'sheets',
+    failure_threshold=SHEETS_BREAKER_THRESHOLD,
+    reset_timeout=SHEETS_BREAKER_RESET,
+    on_state_change=lambda breaker, old, new: stats_publisher.event('sheets', f"Google Sheets ({breaker.name}): {old} -> {new}")
+)
+
+def breaker_for(spreadsheet_id):
+    return sheets_breakers.get(spreadsheet_id)
+
+sheets_breaker = breaker_for(SPREADSHEET_ID)  # Основная таблица — для monitor.py
+
+def create_sheets_factory(credentials_file, limiter):
+    return SheetsClientFactory(
+        credentials_file,
+        # Выключатель внутри цикла повторов: считается каждая попытка, при разомкнутом — без ожидания повторов
+        http_client=limited_http_client(limiter, base=breaker_http_client(HTTPClient, sheets_breakers)),
+        pool_size=SHEETS_HTTP_POOL,
+        refresh_margin=SHEETS_TOKEN_MARGIN,
+        metadata_ttl=WORKSHEET_CACHE_TTL
+    )
+
+# Один клиент на файл ключей: пул соединений, токен обновляется заранее в фоне
+sheets_factory = create_sheets_factory(CREDENTIALS_FILE, sheets_limiter)
+
+# --- Шарды: чаты или проекты распределяются по нескольким таблицам ---
+shard_map = ShardMap(SHARDS_FILE, SHARDS_STATE_FILE, CREDENTIALS_FILE).load()
+# Квота Sheets считается на проект service account, поэтому клиент и ограничитель — на файл ключей
+sheets_factories = {CREDENTIALS_FILE: sheets_factory}
+sheets_limiters = {CREDENTIALS_FILE: sheets_limiter}
+sheets_factories_lock = threading.Lock()
+
+def factory_for(spreadsheet_id):
+    """Клиент таблицы; шарды с отдельным файлом ключей получают свой клиент и свою квоту"""
+    credentials = shard_map.credentials_for(spreadsheet_id)
+    factory = sheets_factories.get(credentials)
+    if factory is None:
+        with sheets_factories_lock:
+            factory = sheets_factories.get(credentials)
+            if factory is None:
+                limiter = sheets_limiters[credentials] = create_sheets_limiter()
+                factory = create_sheets_factory(credentials, limiter).start_refresher()
+                sheets_factories[credentials] = factory
+    return factory
+
+def limiter_stats():
+    """Состояние ограничителей квоты по файлам ключей: токены, ожидания, повторы, 429"""
+    return {credentials: limiter.stats() for credentials, limiter in list(sheets_limiters.items())}
 
-gc = gspread.service_account(filename=CREDENTIALS_FILE, scopes=scope)
-sh = gc.open_by_key(SPREADSHEET_ID)
 # Листы инициализируются динамически в зависимости от чата
+worksheet_caches = {}
+
+# --- Маршрутизация чатов ---
+router = ChatRouter(
+    ROUTES_FILE,
+    SPREADSHEET_ID,
+    fallback_config=config_from_env(CHAT_ADMIN_ID, CHAT_SNAB_ID, SHEET_ADMIN_NAME, SHEET_SNAB_NAME),
+    redirects_path=SHEET_REDIRECTS_FILE
+)
+router.load()
 
 # --- Инициализация бота ---
 bot = telebot.TeleBot(TELEGRAM_TOKEN)
+invoice_parser = InvoiceParser()
+
+# Метрики этапов обработки и счётчики сообщений по чатам и листам
+metrics = MetricsRegistry()
+
+# Все ответы идут через очередь по чатам: flood-лимиты Telegram не тормозят обработку
+SEND_LIMITS = {
+    'global_per_second': TELEGRAM_SEND_PER_SECOND,
+    'group_per_minute': TELEGRAM_GROUP_PER_MINUTE,
+    'workers': TELEGRAM_SEND_WORKERS
+}
+send_queue = SendQueue(bot.reply_to, metrics=metrics, **SEND_LIMITS).start()
+
+WELCOME_MSG = "👋 Привет! Я бот для формирования реестра оплат.\n\n📋 Отправляйте сообщения в формате:\n@paycollect_bot [данные через пробел дефис пробел]\n\n💡 Используйте /info для получения шаблона"
+INFO_MSG = """📝 Пример для описания счетов:
+
+@paycollect_bot 01.01.2025 - Счет 1 от 01.01.2025 - Объект2 - Стройка МСК - Этап 3 - Оплата за окна - Оплата за окна алюминий - 30500,00 - ООО Петрович - ООО Дом Газобетон
+
+🔹 Формат: дата - реквизиты счета - объект - регион - этап - категория - описание - сумма - поставщик - компания
+🔹 Разделитель: пробел дефис пробел (' - ')
+🔹 Сумма: только цифры без пробелов и копейки разделенные запятой"""
 
 # --- Обработчик команды /start ---
 @bot.message_handler(commands=['start'])
 def send_welcome(message):
     logger.info(f"🚀 Команда /start от пользователя {message.from_user.username} ({message.from_user.id}) в чате {message.chat.id}")
-    welcome_msg = "👋 Привет! Я бот для формирования реестра оплат.\n\n📋 Отправляйте сообщения в формате:\n@paycollect_bot [данные через пробел дефис пробел]\n\n💡 Используйте /info для получения шаблона"
-    bot.reply_to(message, welcome_msg)
+    send_queue.reply(message, WELCOME_MSG)
     logger.info("✅ Отправлено приветственное сообщение")
 
 # --- Обработчик команды /info ---
 @bot.message_handler(commands=['info'])
 def send_info(message):
     logger.info(f"ℹ️ Команда /info от пользователя {message.from_user.username} ({message.from_user.id}) в чате {message.chat.id}")
-    info_msg = """📝 Пример для описания счетов:
+    send_queue.reply(message, INFO_MSG)
+    logger.info("✅ Отправлена информация о формате")
 
-@paycollect_bot 01.01.2025 - Счет 1 от 01.01.2025 - Объект2 - Стройка МСК - Этап 3 - Оплата за окна - Оплата за окна алюминий - 30500,00 - ООО Петрович - ООО Дом Газобетон
+shard_writers = {}
+shard_writers_lock = threading.Lock()
 
-🔹 Формат: дата - реквизиты счета - объект - регион - этап - категория - описание - сумма - поставщик - компания
-🔹 Разделитель: пробел дефис пробел (' - ')
-🔹 Сумма: только цифры без пробелов и копейки разделенные запятой"""
-    bot.reply_to(message, info_msg)
-    logger.info("✅ Отправлена информация о формате")
+def get_shard_writer(spreadsheet_id):
+    """Очередь записи и курсоры строк таблицы; создаются при первом обращении"""
+    writer = shard_writers.get(spreadsheet_id)
+    if writer is None:
+        with shard_writers_lock:
+            writer = shard_writers.get(spreadsheet_id)
+            if writer is None:
+                row_cursors = RowCursorRegistry(resync_interval=ROW_CURSOR_RESYNC)
+                write_queue = WriteBehindQueue(
+                    find_empty_rows,
+                    flush_interval=WRITE_BATCH_WINDOW,
+                    max_batch_size=WRITE_BATCH_SIZE,
+                    on_commit=row_cursors.advance,
+                    on_error=on_batch_error,
+                    metrics=metrics,
+                    capacity=capacity,
+                    on_allocate=lambda worksheet, allocations: journal.mark_allocated(worksheet.title, allocations)
+                ).start()
+                writer = shard_writers[spreadsheet_id] = ShardWriter(row_cursors, write_queue)
+    return writer
+
+def write_pending():
+    return sum(writer.write_queue.pending_count() for writer in list(shard_writers.values()))
 
 def find_empty_row(worksheet, date_column=1):  # date_column - номер столбца с датой (начинается с 1)
     """Находит первую строку, где столбец с датой пуст."""
-    data = worksheet.col_values(date_column)
+    return find_empty_rows(worksheet, 1)[0]
+
+def find_empty_rows(worksheet, count):
+    """Возвращает count свободных строк из курсора листа без скачивания столбца."""
+    with metrics.time('row_lookup'):
+        return get_shard_writer(worksheet.spreadsheet_id).row_cursors.peek(worksheet, count)
+
+def on_batch_error(worksheet, error):
+    """После ошибки записи лист мог измениться — перечитываем курсор и метаданные"""
+    get_shard_writer(worksheet.spreadsheet_id).row_cursors.invalidate(worksheet)
+    if not isinstance(error, NoFreeRowError):
+        get_worksheet_cache(worksheet.spreadsheet_id).invalidate(worksheet.title)
+
+def get_worksheet(spreadsheet_id, sheet_name):
+    """Лист по ключу маршрута; в устойчивом режиме без обращения к сети"""
+    return get_worksheet_cache(spreadsheet_id).get(sheet_name)
+
+def roll_over_sheet(worksheet):
+    """Лист достиг SHEET_MAX_ROWS: заводим лист следующего периода и переводим на него маршруты"""
+    source = (worksheet.spreadsheet_id, worksheet.title)
+    if router.resolve(*source) != source:
+        return  # Уже переадресован, в лист дописываются только строки из очереди
+    cache = get_worksheet_cache(worksheet.spreadsheet_id)
+    existing = {ws.title for ws in cache.spreadsheet.worksheets()}
+    title = period_title(router.origin(*source)[1], existing, period_format=SHEET_PERIOD_FORMAT)
+    roll_over(cache.spreadsheet, worksheet, title, rows=SHEET_GROW_CHUNK, header_rows=SHEET_HEADER_ROWS)
+    cache.invalidate()
+    router.redirect(source, (worksheet.spreadsheet_id, title))
+    ensure_sheet_indexed(worksheet.spreadsheet_id, title)
+    stats_publisher.event('sheets', f"Лист '{worksheet.title}' заполнен, новые счета пишутся в '{title}'")
+
+# Расширение листов — в фоне после записи пачки, а не при нехватке строк
+capacity = CapacityManager(
+    grow_chunk=SHEET_GROW_CHUNK,
+    headroom=SHEET_GROW_HEADROOM,
+    max_rows=SHEET_MAX_ROWS,
+    on_full=roll_over_sheet
+)
+
+# --- Хранилища строк: Google Sheets или локальные (по маршруту) ---
+sinks = {}
+sinks_lock = threading.Lock()
+
+def create_sink(kind, spreadsheet_id, sheet_name):
+    if kind == SINK_SQLITE:
+        return SQLiteSink(SINK_SQLITE_PATH, spreadsheet_id, sheet_name)
+    if kind == SINK_CSV:
+        return CSVSink.for_sheet(SINK_CSV_DIR, spreadsheet_id, sheet_name)
+    return SheetsSink(lambda: get_worksheet(spreadsheet_id, sheet_name), get_shard_writer(spreadsheet_id).write_queue)
+
+def get_sink(spreadsheet_id, sheet_name):
+    """Хранилище листа; создаётся при первом обращении"""
+    key = (router.sink_for(spreadsheet_id, sheet_name), spreadsheet_id, sheet_name)
+    sink = sinks.get(key)
+    if sink is None:
+        with sinks_lock:
+            sink = sinks.get(key)
+            if sink is None:
+                sink = sinks[key] = create_sink(*key)
+    return sink
+
+# --- Журнал счетов ---
+journal = InvoiceJournal(JOURNAL_PATH)
+
+def submit_journal_entry(entry):
+    """Передаёт счёт из журнала в хранилище его листа"""
+    # Счёт мог ждать в журнале, пока его лист заполнился и был заменён листом нового периода
+    sink = get_sink(*router.resolve(entry.spreadsheet_id, entry.sheet_name))
+    future = sink.submit(entry.row, entry.id)
+    future.add_done_callback(lambda f: remember_invoice_row(f, sink, entry.row))
+    return future
+
+def find_written_row(entry):
+    """Строка, выделенная счёту прошлой попыткой, если в ней уже ссылка на его сообщение"""
+    existing = get_sink(entry.spreadsheet_id, entry.written_sheet).lookup_row(entry.row_number)
+    link_index = invoice_parser.link_column - 1
+    if existing and len(existing) > link_index and existing[link_index] == entry.row[link_index]:
+        return entry.row_number
+    return None
+
+def journal_entry_paused(entry):
+    """Повтор ждёт, пока Sheets недоступен; счета локальных хранилищ уходят и во время сбоя"""
+    spreadsheet_id, sheet_name = router.resolve(entry.spreadsheet_id, entry.sheet_name)
+    sink = get_sink(spreadsheet_id, sheet_name)
+    return sink.remote and (breaker_for(spreadsheet_id).is_open or not sheets_connection.ready)
+
+committer = JournalCommitter(
+    journal,
+    submit_journal_entry,
+    retry_interval=JOURNAL_RETRY_INTERVAL,
+    paused=journal_entry_paused,
+    find_written=find_written_row
+)
+
+# Справочники полей: проверка сообщения идёт по индексу в памяти, лист перечитывается в фоне
+references = ReferenceDictionaries(
+    lambda: load_reference_sheet(get_worksheet(SPREADSHEET_ID, REFERENCE_SHEET), invoice_parser.fields),
+    invoice_parser.fields,
+    ttl=REFERENCE_TTL,
+    threshold=REFERENCE_MATCH_THRESHOLD
+)
+
+# Индекс обработанных сообщений: повторная доставка апдейта не создаёт дубль строки
+processed_index = ProcessedIndex(max_size=DEDUPE_MAX_ENTRIES)
+processed_index.load(journal.recent_messages(DEDUPE_MAX_ENTRIES))
+
+# Индекс содержимого счетов: тот же счёт, присланный повторно другим человеком или в другой чат
+invoice_index = InvoiceIndex()
+indexed_sheets = set()
+indexed_sheets_lock = threading.Lock()
+
+def remember_invoice_row(future, sink, row):
+    """Запоминает в индексе строку, в которую записан счёт"""
+    if future.exception() is None:
+        spreadsheet_id, sheet_id = sink.location()
+        invoice_index.set_location(row, spreadsheet_id, sheet_id, future.result())
+
+def ensure_sheet_indexed(spreadsheet_id, sheet_name):
+    """Один раз на лист загружает существующие счета в индекс (в фоновом потоке)"""
+    if router.sink_for(spreadsheet_id, sheet_name) != SINK_SHEETS:
+        return  # Локальные хранилища попадают в индекс по мере записи
+    with indexed_sheets_lock:
+        if (spreadsheet_id, sheet_name) in indexed_sheets:
+            return
+        indexed_sheets.add((spreadsheet_id, sheet_name))
+
+    def load():
+        try:
+            added = build_index_from_worksheet(
+                invoice_index, get_worksheet(spreadsheet_id, sheet_name), chunk=INVOICE_INDEX_CHUNK
+            )
+            logger.info(f"🗂️ Индекс счетов: из листа '{sheet_name}' загружено {added}, всего {len(invoice_index)}")
+        except Exception as e:
+            logger.error(f"❌ Не удалось загрузить счета листа '{sheet_name}' в индекс: {e}")
+            with indexed_sheets_lock:
+                indexed_sheets.discard((spreadsheet_id, sheet_name))  # Повторим при следующем сообщении
+
+    threading.Thread(target=load, name='invoice-index', daemon=True).start()
+
+def duplicate_warning(original):
+    """Текст предупреждения со ссылкой на исходный счёт"""
+    spreadsheet_id, sheet_id, row_number, link = original
+    if row_number is not None and spreadsheet_id is not None:
+        where = f"строка {row_number}: {sheet_row_url(spreadsheet_id, sheet_id, row_number)}"
+    else:
+        where = f"ещё записывается, исходное сообщение: {link}"
+    return f"⚠️ Похоже, этот счёт уже есть в реестре ({where}). Проверьте, не оплачивается ли он повторно."
+
+DEGRADED_MSG = "✅ Счёт принят и будет записан в реестр, как только Google Sheets станет доступен."
+JOURNALED_MSG = "📥 Счёт сохранён и будет записан в реестр автоматически, как только таблица станет доступна."
+
+def count_message(message, outcome, sheet=None):
+    """Счётчик сообщений: processed, rejected, journaled или failed по чату и листу.
+
+    sheet — лист, в который пишется счёт (после шардов и переадресаций); до выбора листа — лист маршрута чата.
+    """
+    if sheet is None:
+        sheet = route_key(message.chat.id)[1]
+    metrics.inc('messages_total', chat=message.chat.id, sheet=sheet, outcome=outcome)
+    stats_publisher.record(outcome, f"чат {message.chat.id}, лист '{sheet}'")
+
+def on_row_written(future, message, reply, worksheet_name, amount, supplier):
+    """Отвечает пользователю после того, как пачка с его строкой записана"""
     try:
-        empty_row_index = data.index('') + 1  # Индекс первой пустой ячейки + 1 = номер строки
-        return empty_row_index
-    except ValueError:
-        return len(data) + 1  # Если все ячейки заполнены, возвращает номер следующей строки
+        empty_row = future.result()
+    except Exception as write_error:
+        error_msg = f"Ошибка записи в лист '{worksheet_name}': {str(write_error)}"
+        logger.error(f"❌ {error_msg}")
+        count_message(message, 'failed', worksheet_name)
+        reply(message, f"⚠️ {error_msg}\n{JOURNALED_MSG}")
+        return
+
+    count_message(message, 'processed', worksheet_name)
+    processed_index.record(message.chat.id, message.message_id, empty_row)
+    success_msg = "✅ Данные успешно добавлены в реестр оплат!"
+    logger.info(f"🎉 Данные записаны в лист '{worksheet_name}', строка {empty_row}")
+    reply(message, success_msg)
+    logger.info(f"📊 Обработка завершена успешно. Сумма: {amount}, Поставщик: {supplier}")
 
 # --- Функция для обработки сообщений ---
 def is_authorized_chat(message):
     """Проверяет, авторизован ли чат для работы с ботом"""
-    chat_id_str = str(message.chat.id)
-    admin_chats = [id.strip() for id in CHAT_ADMIN_ID.split(',') if id.strip()]
-    snab_chats = [id.strip() for id in CHAT_SNAB_ID.split(',') if id.strip()]
+    route = router.lookup(message.chat.id)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"🔍 Проверка авторизации чата {message.chat.id} (тип: {message.chat.type}): {route is not None}")
+    return route is not None
 
-    is_in_allowed_groups = chat_id_str in admin_chats or chat_id_str in snab_chats
-    
-    logger.info(f"🔍 Проверка авторизации чата {chat_id_str} (тип: {message.chat.type})")
-    logger.info(f"   📋 В разрешенных группах: {is_in_allowed_groups}")
-    
-    return is_in_allowed_groups
+def open_worksheet_cache(spreadsheet_id):
+    cache = worksheet_caches.get(spreadsheet_id)
+    if cache is None:
+        cache = worksheet_caches.setdefault(
+            spreadsheet_id, WorksheetCache(factory_for(spreadsheet_id).spreadsheet(spreadsheet_id), ttl=WORKSHEET_CACHE_TTL)
+        )
+    return cache
 
-def get_worksheet_for_chat(chat_id):
-    """Определяет лист для записи в зависимости от чата"""
-    chat_id_str = str(chat_id)
-    admin_chats = [id.strip() for id in CHAT_ADMIN_ID.split(',') if id.strip()]
-    
-    # Личные чаты направляем в админ лист для тестирования
-    if chat_id_str in admin_chats:
-        logger.info(f"📝 Админ группа {chat_id_str} -> Админ лист")
-        return sh.worksheet(SHEET_ADMIN_NAME)
-    else:
-        logger.info(f"📝 Снаб группа {chat_id_str} -> Снаб лист")
-        return sh.worksheet(SHEET_SNAB_NAME)
+def get_worksheet_cache(spreadsheet_id):
+    """Кэш листов таблицы; таблицы без маршрутов открываются при первом обращении"""
+    cache = worksheet_caches.get(spreadsheet_id)
+    if cache is None:
+        # До окончания прогрева сообщение ждёт здесь; по таймауту счёт остаётся в журнале
+        sheets_connection.client(SHEETS_WARMUP_TIMEOUT)
+        cache = open_worksheet_cache(spreadsheet_id)
+    return cache
+
+def warm_up_sheets(client):
+    """Открывает таблицы маршрутов, листы и курсоры строк до первых сообщений"""
+    sheets = {
+        (route.spreadsheet_id, route.sheet_name) for route in router.table.values()
+        if router.sink_for(route.spreadsheet_id, route.sheet_name) == SINK_SHEETS
+    }
+    # В таблицах-шардах те же листы, что и в маршрутах
+    sheets |= {
+        router.resolve(shard.spreadsheet_id, router.origin(spreadsheet_id, sheet_name)[1])
+        for shard in shard_map.shards.values() for spreadsheet_id, sheet_name in list(sheets)
+    }
+    open_worksheet_cache(SPREADSHEET_ID)
+    for spreadsheet_id, sheet_name in sorted(sheets):
+        try:
+            worksheet = open_worksheet_cache(spreadsheet_id).get(sheet_name)
+            capacity.observe(worksheet, find_empty_row(worksheet))
+        except Exception as e:
+            logger.warning(f"⚠️ Лист '{sheet_name}' не прогрет: {e}")
+            continue
+        ensure_sheet_indexed(spreadsheet_id, sheet_name)
+    for spreadsheet_id, sheet_name in list(router.redirects):
+        ensure_sheet_indexed(spreadsheet_id, sheet_name)  # Счета заполненных листов тоже проверяются на повтор
+
+# Клиент создаётся в фоне при start_services: импорт модуля не ходит в сеть
+sheets_connection = LazySheetsConnection(sheets_factory.client, warm_up_sheets, retry_interval=SHEETS_CONNECT_RETRY)
+
+def extract_text(message):
+    """Текст сообщения или подпись к документу/фото/видео"""
+    if message.content_type == 'text':
+        return message.text
+    return message.caption
+
+message_pool = KeyedWorkerPool(
+    workers=WORKER_POOL_SIZE,
+    max_queue=WORKER_QUEUE_SIZE,
+    max_per_key=WORKER_KEY_BACKLOG,
+    name='handler'
+)
+
+def route_key(chat_id):
+    """Ключ листа, в который пишет чат: сообщения с одним ключом обрабатываются по порядку"""
+    route = router.lookup(chat_id)
+    if route is None:
+        return (SPREADSHEET_ID, SHEET_SNAB_NAME)
+    return (route.spreadsheet_id, route.sheet_name)
+
+def shard_route(chat_id, project):
+    """Таблица и лист счёта: маршрут чата, затем карта шардов (по чату или проекту)"""
+    spreadsheet_id, sheet_name = route_key(chat_id)
+    if not shard_map.enabled or router.sink_for(spreadsheet_id, sheet_name) != SINK_SHEETS:
+        return spreadsheet_id, sheet_name
+    shard = shard_map.shard_for(chat_id, project)
+    if shard.spreadsheet_id == spreadsheet_id:
+        return spreadsheet_id, sheet_name
+    # В таблице-шарде лист называется так же, как исходный лист маршрута
+    return router.resolve(shard.spreadsheet_id, router.origin(spreadsheet_id, sheet_name)[1])
 
 @bot.message_handler(func=is_authorized_chat, content_types=['text', 'document', 'photo', 'video'])
 def handle_message(message):
-    """Обработчик сообщений с полным логированием"""
-    
+    """Передаёт сообщение в пул обработчиков, не блокируя поток polling"""
+    try:
+        message_pool.submit(route_key(message.chat.id), process_message, message, send_queue.reply)
+    except PoolFullError as e:
+        logger.error(f"❌ Пул обработчиков переполнен: {e}")
+        send_queue.reply(message, "❌ Бот перегружен, повторите отправку через минуту.")
+
+def process_message(message, reply):
+    """Разбор, валидация и постановка счёта в очередь записи.
+
+    reply(message, text) отправляет ответ пользователю; так один и тот же
+    конвейер работает и с синхронным, и с асинхронным клиентом Telegram.
+    """
+
+    # Болтовню в чатах отсекаем проверкой префикса до любой другой работы
+    text = extract_text(message)
+    if not invoice_parser.is_addressed(text):
+        return
+
     # Логируем получение сообщения
     logger.info(f"📩 Получено сообщение от пользователя {message.from_user.username} ({message.from_user.id}) в чате {message.chat.id}")
-    logger.info(f"📝 Тип сообщения: {message.content_type}")
+    logger.debug(f"📝 Тип сообщения: {message.content_type}")
     
     try:
-        text = None
-        
-        # Извлекаем текст из сообщения
-        if message.content_type == 'text':
-            text = message.text
-            logger.info(f"💬 Текст сообщения: {text}")
-        elif message.content_type == 'document' and message.caption:
-            text = message.caption
-            logger.info(f"📎 Описание документа: {text}")
-        elif message.content_type == 'photo' and message.caption:
-            text = message.caption
-            logger.info(f"🖼️ Описание фото: {text}")
-        elif message.content_type == 'video' and message.caption:
-            text = message.caption
-            logger.info(f"🎥 Описание видео: {text}")
-        
-        # Проверяем, что текст содержит команду бота
-        if text and text.startswith('@paycollect_bot'):
-            logger.info("🤖 Обрабатываем команду @paycollect_bot")
-        
-            # Парсим сообщение
-            parsed_text = text.lstrip('@paycollect_bot').strip()
-            logger.info(f"🔄 Обработанный текст: {parsed_text}")
-        
-            # Разбиваем на части
-            try:
-                parts = [item.strip() for item in parsed_text.split(' - ')]
-                logger.info(f"📊 Разбито на {len(parts)} частей: {parts}")
-            
-                if len(parts) != 10:
-                    error_msg = f"❌ Неверное количество полей: ожидается 10, получено {len(parts)}"
-                    logger.error(error_msg)
-                    bot.reply_to(message, f"Ошибка: {error_msg}. Проверьте формат сообщения и разделители.")
-                    return
-                
-            except Exception as e:
-                error_msg = f"❌ Ошибка парсинга сообщения: {str(e)}"
-                logger.error(error_msg)
-                bot.reply_to(message, f"Ошибка парсинга: {error_msg}")
+        is_new, known_row = processed_index.reserve(message.chat.id, message.message_id)
+        if not is_new:
+            where = f"уже записано в строку {known_row}" if known_row else "уже в обработке"
+            logger.info(f"♻️ Повторная доставка сообщения {message.message_id} из чата {message.chat.id}: {where}")
+            return
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"🤖 Обрабатываем команду @paycollect_bot: {text}")
+
+        # Разбор и валидация всех полей за один проход
+        with metrics.time('parse'):
+            parts = invoice_parser.split(text)
+        with metrics.time('validate'):
+            result = invoice_parser.validate(parts)
+        if result.errors:
+            count_message(message, 'rejected')
+            logger.error(f"❌ Найдено {len(result.errors)} ошибок валидации")
+            for error in result.errors:
+                logger.warning(f"⚠️ {error}")
+            # Все ошибки одним ответом: по сообщению на поле быстро упирается в flood-лимит группы
+            reply(message, "\n".join(result.errors))
+            return
+
+        values = result.values
+        if REFERENCE_SHEET:
+            with metrics.time('reference'):
+                checked = references.check(values)
+            if checked.errors:
+                count_message(message, 'rejected')
+                logger.warning(f"📚 Значения не из справочника: {'; '.join(checked.errors)}")
+                reply(message, "\n".join(checked.errors))
                 return
-        
-            # Валидация полей
-            logger.info("✅ Начинаем валидацию полей...")
-            errors = []
-        
-            # Проверяем каждое поле
-            validations = [
-                (r"\d{2}\.\d{2}\.\d{4}", parts[0], "Дата (ДД.ММ.ГГГГ)"),
-                (r"[\w\s.,*-]+", parts[1], "Реквизиты счета"),
-                (r"[\w\s.,*-]+", parts[2], "Название чата"),
-                (r"[\w\s.,*-]+", parts[3], "Регион/направление"),
-                (r"[\w\s.,*-]+", parts[4], "Этап/вид расходов"),
-                (r"[\w\s.,*-]+", parts[5], "Категория"),
-                (r"[\w\s0-9.,*-]+", parts[6], "Детализация расходов"),
-                (r"^-?\d+,\d{2}$", parts[7], "Сумма (ожидается только цифры и копейки разделенные запятой)"),
-                (r"[\w\s.,*-]+", parts[8], "Поставщик"),
-                (r"[\w\s.,*-]+", parts[9], "Компания")
-            ]
-        
-            for pattern, value, field_name in validations:
-                if not re.match(pattern, value):
-                    error_msg = f"Ошибка в поле '{field_name}': '{value}'"
-                    errors.append(error_msg)
-                    logger.warning(f"⚠️ {error_msg}")
-        
-            # Если есть ошибки валидации
-            if errors:
-                logger.error(f"❌ Найдено {len(errors)} ошибок валидации")
-                for error in errors:
-                    bot.reply_to(message, error)
+            values = checked.values
+        logger.info("✅ Валидация успешно пройдена")
+
+        # Подготавливаем данные для записи
+        entry = None
+        future = None
+        worksheet_name = None
+        indexed_row = None
+        try:
+            # Определяем лист для записи
+            with metrics.time('route'):
+                spreadsheet_id, worksheet_name = shard_route(message.chat.id, values['project'])
+            logger.info(f"📄 Чат {message.chat.id} -> лист '{worksheet_name}'")
+
+            # Формируем строку для записи
+            row = invoice_parser.build_row(values, telegram_link(message.chat.id, message.message_id))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"📝 Подготовлена строка для записи: {row}")
+
+            # Повтор того же счёта — предупреждаем, но запись не блокируем: решает человек
+            ensure_sheet_indexed(spreadsheet_id, worksheet_name)
+            original = invoice_index.check_and_add(row)
+            if original is None:
+                indexed_row = row
+            else:
+                logger.warning(f"👯 Возможный повтор счёта: {values['account']}, {values['supplier']}, {values['amount']}")
+                reply(message, duplicate_warning(original))
+
+            # Сначала журнал (локальный fsync), затем очередь записи в таблицу
+            entry = committer.append(message.chat.id, message.message_id, spreadsheet_id, worksheet_name, row)
+            logger.info(f"💾 Счёт #{entry.id} сохранён в журнал")
+
+            # Деградированный режим: таблица недоступна, отвечаем сразу, запись — из журнала позже
+            if breaker_for(spreadsheet_id).is_open and get_sink(spreadsheet_id, worksheet_name).remote:
+                logger.warning(f"🔌 Sheets недоступен, счёт #{entry.id} ждёт в журнале")
+                committer.release(entry)  # Иначе replay так и не возьмёт его после восстановления
+                count_message(message, 'journaled', worksheet_name)
+                reply(message, DEGRADED_MSG)
                 return
-        
-            logger.info("✅ Валидация успешно пройдена")
-        
-            # Подготавливаем данные для записи
+
             try:
-                date, account, project, direction, stage, category, description, amount, supplier, company = tuple(parts)
-            
-                # Определяем лист для записи
-                logger.info(f"📋 Определяем лист для чата {message.chat.id}")
-                worksheet = get_worksheet_for_chat(message.chat.id)
-                worksheet_name = worksheet.title
-                logger.info(f"📄 Выбран лист: '{worksheet_name}'")
-            
-                # Формируем строку для записи
-                telegram_link = f"https://t.me/c/{str(message.chat.id).lstrip('-').lstrip('100')}/{message.message_id}"
-                row = [
-                    date,
-                    account.strip(),
-                    project.strip(),
-                    '',
-                    direction.strip().title(),
-                    stage.strip(),
-                    category.strip(),
-                    description.strip(),
-                    amount,
-                    supplier.strip(),
-                    telegram_link,
-                    company.strip()
-                ]
-
-                logger.info(f"📝 Подготовлена строка для записи: {row}")
-            
-                # Находим пустую строку
-                empty_row = find_empty_row(worksheet)
-                logger.info(f"🔍 Найдена пустая строка: {empty_row}")
-            
-                if empty_row is None or empty_row > worksheet.row_count:
-                    error_msg = "Не найдена подходящая строка для записи данных"
-                    logger.error(f"❌ {error_msg}")
-                    bot.reply_to(message, f"Ошибка: {error_msg}")
-                    return
-            
-                # Записываем данные
-                logger.info(f"💾 Начинаем запись в строку {empty_row}")
-            
-                for i, value in enumerate(row):
-                    try:
-                        worksheet.update_cell(empty_row, i + 1, value)
-                        logger.debug(f"✏️ Записано в ячейку [{empty_row}, {i + 1}]: {value}")
-                    except Exception as cell_error:
-                        error_msg = f"Ошибка записи в ячейку [{empty_row}, {i + 1}]: {str(cell_error)}"
-                        logger.error(f"❌ {error_msg}")
-                        bot.reply_to(message, f"Ошибка записи: {error_msg}")
-                        return
-            
-                # Успешная запись
-                success_msg = "✅ Данные успешно добавлены в реестр оплат!"
-                logger.info(f"🎉 Данные записаны в лист '{worksheet_name}', строка {empty_row}")
-                bot.reply_to(message, success_msg)
-            
-                # Логируем статистику
-                logger.info(f"📊 Обработка завершена успешно. Сумма: {amount}, Поставщик: {supplier}")
-            
-            except Exception as processing_error:
-                error_msg = f"Ошибка обработки данных: {str(processing_error)}"
-                logger.error(f"❌ {error_msg}")
-                logger.error(f"🔍 Traceback: {traceback.format_exc()}")
-                bot.reply_to(message, f"Ошибка: {error_msg}")
+                future = committer.commit(entry)
+            except Exception as e:
+                logger.error(f"❌ Лист '{worksheet_name}' недоступен, счёт #{entry.id} ждёт в журнале: {e}")
+                count_message(message, 'journaled', worksheet_name)
+                reply(message, JOURNALED_MSG)
                 return
 
+            # Ответ уйдёт после коммита пачки
+            logger.info(f"📥 Строка поставлена в очередь записи листа '{worksheet_name}'")
+            future.add_done_callback(
+                lambda f: on_row_written(f, message, reply, worksheet_name, values['amount'], values['supplier'])
+            )
+
+        except Exception as processing_error:
+            if entry is None:
+                # Счёт не попал в журнал — повторная отправка сообщения должна пройти
+                processed_index.release(message.chat.id, message.message_id)
+                if indexed_row is not None:
+                    invoice_index.discard(indexed_row)
+            elif future is None:
+                committer.release(entry)  # Счёт в журнале, но не отправлен — отправит replay
+            error_msg = f"Ошибка обработки данных: {str(processing_error)}"
+            count_message(message, 'failed', worksheet_name)
+            logger.error(f"❌ {error_msg}")
+            logger.error(f"🔍 Traceback: {traceback.format_exc()}")
+            reply(message, f"Ошибка: {error_msg}")
+            return
+
     except IndexError as e:
         error_msg = f"Недостаточно полей в сообщении: {str(e)}"
+        count_message(message, 'rejected')
         logger.error(f"❌ {error_msg}")
-        bot.reply_to(message, "❌ Ошибка: Недостаточно полей для заполнения. Проверьте формат сообщения.")
+        reply(message, "❌ Ошибка: Недостаточно полей для заполнения. Проверьте формат сообщения.")
         
     except Exception as e:
         error_msg = f"Неожиданная ошибка при обработке сообщения: {str(e)}"
+        count_message(message, 'failed')
         logger.error(f"❌ {error_msg}")
         logger.error(f"🔍 Полный traceback: {traceback.format_exc()}")
         logger.error(f"📝 Исходное сообщение: {message.text if hasattr(message, 'text') else 'Не текстовое сообщение'}")
-        bot.reply_to(message, f"❌ Произошла неожиданная ошибка: {str(e)}")
+        reply(message, f"❌ Произошла неожиданная ошибка: {str(e)}")
         
     finally:
         logger.info("🏁 Обработка сообщения завершена")
 
+def start_services():
+    """Фоновые службы, общие для polling и webhook режимов"""
+    router.watch(ROUTES_WATCH_INTERVAL)
+    router.install_sighup_handler()
+    sheets_connection.start()  # Подключение, листы, курсоры и индекс счетов — в фоне
+    sheets_factory.start_refresher()
+    if REFERENCE_SHEET:
+        references.refresh_if_stale()  # Дождётся подключения к Sheets в фоновом потоке
+    committer.start()  # Счета, оставшиеся в журнале после перезапуска, уйдут после прогрева
+    stats_publisher.start()
+    if METRICS_PORT:
+        metrics.gauge('write_queue_pending', write_pending, 'Строк в очередях записи всех таблиц')
+        metrics.gauge('send_queue_pending', send_queue.pending_count, 'Ответов в очереди отправки')
+        metrics.gauge('journal_pending', journal.pending_count, 'Счетов в журнале, ещё не записанных в таблицу')
+        metrics.gauge('handler_queue', lambda: message_pool.stats()['queued'], 'Сообщений в очереди пула обработчиков')
+        register_limiter_metrics(metrics, lambda: dict(sheets_limiters))
+        try:
+            serve_metrics(metrics, METRICS_HOST, METRICS_PORT)
+        except OSError as e:
+            logger.error(f"❌ Не удалось запустить сервер метрик на порту {METRICS_PORT}: {e}")
+
+def stop_services():
+    """Дорабатывает принятые сообщения и записывает накопленные строки"""
+    message_pool.shutdown(timeout=10)
+    committer.stop(timeout=10)
+    for writer in list(shard_writers.values()):
+        writer.write_queue.stop(timeout=10)
+    send_queue.stop(timeout=10)  # Последними уходят ответы о записанных строках
+    stats_publisher.stop()
+    sheets_connection.stop()
+    for factory in list(sheets_factories.values()):
+        factory.close()
+    for sink in list(sinks.values()):
+        sink.close()
+    journal.close()
+
+def enable_webhook(url, secret_token):
+    """Регистрирует webhook в Telegram; после этого long polling не нужен"""
+    bot.set_webhook(url=url, secret_token=secret_token, drop_pending_updates=False)
+    logger.info(f"🌐 Webhook зарегистрирован: {url}")
+
 # --- Запуск бота ---
 if __name__ == '__main__':
     logger.info("🚀 Запуск PayCollect Bot...")
@@ -272,13 +716,32 @@ if __name__ == '__main__':
     logger.info(f"   📄 Snab лист: {SHEET_SNAB_NAME}")
     logger.info(f"   👥 Admin чаты: {len(CHAT_ADMIN_ID.split(',')) if CHAT_ADMIN_ID else 0}")
     logger.info(f"   👥 Snab чаты: {len(CHAT_SNAB_ID.split(',')) if CHAT_SNAB_ID else 0}")
+    logger.info(f"   🧭 Маршрутов чатов: {len(router.table)}")
+    logger.info(f"   ⚙️ Режим: {BOT_RUNTIME}")
+    logger.info(f"   🧵 Пул обработчиков: {WORKER_POOL_SIZE} потоков, очередь {WORKER_QUEUE_SIZE}, на лист {WORKER_KEY_BACKLOG}")
+    start_services()
     try:
-        logger.info("🔄 Начинаем polling...")
         print("Бот запущен и готов к работе! Логи записываются в bot.log")
-        bot.infinity_polling()
+        if BOT_RUNTIME == 'async':
+            logger.info("🔄 Начинаем асинхронный polling...")
+            run_async(
+                TELEGRAM_TOKEN,
+                process_message,
+                is_authorized_chat,
+                route_key,
+                {'start': WELCOME_MSG, 'info': INFO_MSG},
+                sheets_workers=ASYNC_SHEETS_WORKERS,
+                send_limits=SEND_LIMITS
+            )
+        else:
+            logger.info("🔄 Начинаем polling...")
+            bot.remove_webhook()  # Если ранее работал webhook, getUpdates вернёт 409
+            bot.infinity_polling()
     except KeyboardInterrupt:
         logger.info("⏹️ Бот остановлен пользователем")
     except Exception as e:
         logger.error(f"❌ Критическая ошибка бота: {str(e)}")
         logger.error(f"🔍 Traceback: {traceback.format_exc()}")
         raise
+    finally:
+        stop_services()
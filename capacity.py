@@ -0,0 +1,111 @@
+"""
+Управление размером листов реестра
+
+Раньше, когда свободная строка оказывалась за ``worksheet.row_count``,
+счёт отклонялся с ошибкой «Не найдена подходящая строка». Теперь после
+каждой записанной пачки сравнивается запас строк с ``headroom``; если запас
+кончается, лист в фоновом потоке расширяется на ``grow_chunk`` строк
+одним запросом add_rows. Запись ждёт расширения, только если фон не успел.
+
+Лист не растёт больше ``max_rows`` строк: по достижении предела вызывается
+``on_full(worksheet)`` — бот заводит лист следующего периода и направляет
+в него маршруты (см. roll_over и ChatRouter.redirect).
+"""
+
+import logging
+import threading
+from datetime import datetime
+
+from gspread.utils import ValueInputOption
+
+from write_queue import NoFreeRowError, worksheet_key
+
+logger = logging.getLogger(__name__)
+
+
+class CapacityManager:
+    """Заранее расширяет листы и сообщает о заполненных"""
+
+    def __init__(self, grow_chunk=1000, headroom=200, max_rows=0, on_full=None):
+        self.grow_chunk = grow_chunk
+        self.headroom = headroom
+        self.max_rows = max_rows  # 0 — без предела
+        self.on_full = on_full
+        self.grown = 0
+        self._busy = set()
+        self._lock = threading.Lock()
+        self._grow_lock = threading.Lock()
+
+    def is_full(self, worksheet):
+        return bool(self.max_rows) and worksheet.row_count >= self.max_rows
+
+    def observe(self, worksheet, next_row):
+        """Проверка после записи: дёшево, сеть — только в фоновом потоке"""
+        if worksheet.row_count - next_row + 1 >= self.headroom:
+            return
+        key = worksheet_key(worksheet)
+        with self._lock:
+            if key in self._busy:
+                return
+            self._busy.add(key)
+        threading.Thread(
+            target=self._extend, args=(worksheet, key), name=f'capacity-{worksheet.title}', daemon=True
+        ).start()
+
+    def _extend(self, worksheet, key):
+        try:
+            if self.is_full(worksheet):
+                logger.warning(f"📕 Лист '{worksheet.title}' достиг предела {self.max_rows} строк")
+                if self.on_full is not None:
+                    self.on_full(worksheet)
+            else:
+                self.grow(worksheet)
+        except Exception as e:
+            logger.error(f"❌ Не удалось расширить лист '{worksheet.title}': {e}")
+        finally:
+            with self._lock:
+                self._busy.discard(key)
+
+    def grow(self, worksheet, needed_row=0):
+        """Добавляет grow_chunk строк (и не меньше, чем нужно до needed_row)"""
+        with self._grow_lock:
+            if needed_row and needed_row <= worksheet.row_count:
+                return 0  # Уже расширен другим потоком
+            target = max(worksheet.row_count + self.grow_chunk, needed_row)
+            if self.max_rows:
+                target = min(target, self.max_rows)
+            rows = target - worksheet.row_count
+            if rows <= 0 or target < needed_row:
+                raise NoFreeRowError(f"Лист '{worksheet.title}' заполнен: предел {self.max_rows} строк")
+            worksheet.add_rows(rows)
+            self.grown += rows
+        logger.info(f"📏 Лист '{worksheet.title}' расширен на {rows} строк, всего {worksheet.row_count}")
+        return rows
+
+    def reserve(self, worksheet, last_row):
+        """Для очереди записи: гарантирует, что строка last_row существует"""
+        if last_row <= worksheet.row_count:
+            return
+        logger.warning(f"⚠️ Фоновое расширение листа '{worksheet.title}' не успело, расширяем при записи")
+        self.grow(worksheet, last_row)
+
+
+def period_title(base_title, existing_titles, now=None, period_format='%Y-%m'):
+    """Название листа периода: 'Админ бот 2025-03', при повторе — 'Админ бот 2025-03 (2)'"""
+    title = f"{base_title} {(now or datetime.now()).strftime(period_format)}"
+    candidate, n = title, 1
+    while candidate in existing_titles:
+        n += 1
+        candidate = f"{title} ({n})"
+    return candidate
+
+
+def roll_over(spreadsheet, worksheet, title, rows=1000, header_rows=1):
+    """Создаёт лист title с шапкой (значениями первых header_rows строк) листа worksheet"""
+    new_worksheet = spreadsheet.add_worksheet(title, rows=header_rows + rows, cols=worksheet.col_count)
+    if header_rows:
+        header = worksheet.get(f"1:{header_rows}")
+        if header:
+            new_worksheet.update(header, 'A1', value_input_option=ValueInputOption.user_entered)
+    logger.info(f"📗 Создан лист '{title}' вместо заполненного '{worksheet.title}'")
+    return new_worksheet
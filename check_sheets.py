@@ -4,8 +4,8 @@
 """
 
 import os
-import gspread
 from dotenv import load_dotenv
+from sheets_client import shared_factory
 
 load_dotenv()
 
@@ -19,19 +19,15 @@ def check_available_sheets():
         print(f"📊 Подключение к таблице: {SPREADSHEET_ID}")
         print(f"🔑 Файл ключей: {CREDENTIALS_FILE}")
         
-        # Подключение к Google Sheets
-        scope = [
-            'https://www.googleapis.com/auth/spreadsheets',
-            'https://www.googleapis.com/auth/drive'
-        ]
-        
-        gc = gspread.service_account(filename=CREDENTIALS_FILE, scopes=scope)
-        sh = gc.open_by_key(SPREADSHEET_ID)
+        # Подключение к Google Sheets (тот же клиент, что у бота)
+        sh = shared_factory(CREDENTIALS_FILE).spreadsheet(SPREADSHEET_ID)
         
         print(f"✅ Успешно подключились к таблице: '{sh.title}'")
         print(f"📋 Доступные листы:")
         
-        for i, worksheet in enumerate(sh.worksheets(), 1):
+        worksheets = sh.worksheets()  # Один запрос метаданных на все проверки ниже
+        titles = {worksheet.title for worksheet in worksheets}
+        for i, worksheet in enumerate(worksheets, 1):
             print(f"   {i}. '{worksheet.title}' (ID: {worksheet.id})")
         
         print(f"\n🔧 Текущие настройки в .env:")
@@ -43,20 +39,18 @@ def check_available_sheets():
         snab_sheet = os.getenv('SHEET_SNAB_NAME')
         
         if admin_sheet:
-            try:
-                sh.worksheet(admin_sheet)
+            if admin_sheet in titles:
                 print(f"✅ Лист '{admin_sheet}' найден")
-            except gspread.exceptions.WorksheetNotFound:
+            else:
                 print(f"❌ Лист '{admin_sheet}' не найден")
         
         if snab_sheet:
-            try:
-                sh.worksheet(snab_sheet)
+            if snab_sheet in titles:
                 print(f"✅ Лист '{snab_sheet}' найден")
-            except gspread.exceptions.WorksheetNotFound:
+            else:
                 print(f"❌ Лист '{snab_sheet}' не найден")
                 
-        return sh.worksheets()
+        return worksheets
         
     except Exception as e:
         print(f"❌ Ошибка подключения: {e}")
@@ -0,0 +1,193 @@
+"""
+Автоматический выключатель (circuit breaker) для Google Sheets
+
+После ``failure_threshold`` ошибок подряд выключатель размыкается: запросы
+к таблице сразу завершаются CircuitOpenError без ожидания таймаутов, а бот
+работает в деградированном режиме (счета копятся в локальном журнале).
+Через ``reset_timeout`` секунд пропускается один пробный запрос; если он
+успешен, выключатель замыкается и нормальная работа восстанавливается.
+
+BreakerRegistry держит по выключателю на таблицу: сбой одной таблицы-шарда
+не переводит остальные в деградированный режим.
+"""
+
+import logging
+import re
+import threading
+import time
+
+from gspread.exceptions import APIError
+from requests.exceptions import RequestException
+
+from rate_limiter import SheetsRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# ID таблицы в URL Sheets API (/spreadsheets/<id>) и Drive API (/files/<id>)
+SPREADSHEET_IN_URL = re.compile(r'/(?:spreadsheets|files)/([A-Za-z0-9_-]+)')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """Запрос не выполнен: выключатель разомкнут"""
+
+
+class CircuitBreaker:
+    """Выключатель с состояниями closed / open / half_open"""
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=60, clock=time.monotonic, on_state_change=None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.on_state_change = on_state_change
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.last_error = None
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def _set_state(self, state):
+        """Меняет состояние под блокировкой; возвращает переход (old, new) для _notify или None"""
+        old, self.state = self.state, state
+        return (old, state) if old != state else None
+
+    def _notify(self, transition):
+        # Вне блокировки: обработчик может читать status() этого и других выключателей
+        if transition is None:
+            return
+        old, new = transition
+        logger.warning(f"🔌 Выключатель '{self.name}': {old} -> {new}")
+        if self.on_state_change is not None:
+            self.on_state_change(self, old, new)
+
+    @property
+    def is_open(self):
+        """Разомкнут ли выключатель (пробный запрос ещё не разрешён)"""
+        with self._lock:
+            return self.state == OPEN and self.clock() - self.opened_at < self.reset_timeout
+
+    def allow_request(self):
+        """Можно ли выполнить запрос сейчас; в half_open пропускает один пробный"""
+        transition = None
+        try:
+            with self._lock:
+                if self.state == CLOSED:
+                    return True
+                if self.state == OPEN:
+                    if self.clock() - self.opened_at < self.reset_timeout:
+                        return False
+                    transition = self._set_state(HALF_OPEN)
+                if self._probe_in_flight:
+                    return False
+                self._probe_in_flight = True
+                return True
+        finally:
+            self._notify(transition)
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._probe_in_flight = False
+            transition = self._set_state(CLOSED)
+        self._notify(transition)
+
+    def record_failure(self, error=None):
+        transition = None
+        with self._lock:
+            self.failures += 1
+            self.last_error = str(error) if error is not None else None
+            self._probe_in_flight = False
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.opened_at = self.clock()
+                transition = self._set_state(OPEN)
+        self._notify(transition)
+
+    def call(self, fn, *args, **kwargs):
+        """Выполняет fn под защитой выключателя"""
+        if not self.allow_request():
+            raise CircuitOpenError(f"Google Sheets временно недоступен (выключатель '{self.name}' разомкнут)")
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            self.record_failure(e)
+            raise
+        self.record_success()
+        return result
+
+    def status(self):
+        """Состояние для мониторинга"""
+        with self._lock:
+            retry_in = None
+            if self.state == OPEN:
+                retry_in = max(0, round(self.reset_timeout - (self.clock() - self.opened_at), 1))
+            return {
+                'name': self.name,
+                'state': self.state,
+                'failures': self.failures,
+                'last_error': self.last_error,
+                'retry_in': retry_in
+            }
+
+
+class BreakerRegistry:
+    """Выключатели по таблицам; запросы без ID таблицы идут через выключатель default_key"""
+
+    def __init__(self, name, default_key='', **options):
+        self.name = name
+        self.default_key = default_key
+        self.options = options  # failure_threshold, reset_timeout, clock, on_state_change
+        self.breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        breaker = self.breakers.get(key)
+        if breaker is None:
+            with self._lock:
+                breaker = self.breakers.get(key)
+                if breaker is None:
+                    name = f"{self.name}:{key}" if key else self.name
+                    breaker = self.breakers[key] = CircuitBreaker(name, **self.options)
+        return breaker
+
+    def for_url(self, url):
+        match = SPREADSHEET_IN_URL.search(url or '')
+        return self.get(match.group(1) if match else self.default_key)
+
+    def status(self):
+        """{ключ: состояние} всех выключателей для мониторинга"""
+        return {key: breaker.status() for key, breaker in list(self.breakers.items())}
+
+
+def is_availability_error(error):
+    """Ошибки, говорящие о недоступности сервиса (а не о неверном запросе)"""
+    if isinstance(error, RequestException):
+        return True
+    return isinstance(error, APIError) and SheetsRateLimiter.is_retryable(error)
+
+
+def breaker_http_client(base, breaker):
+    """Класс HTTP-клиента gspread, защищённый выключателем breaker (или выключателем таблицы из BreakerRegistry)"""
+    select = breaker.for_url if isinstance(breaker, BreakerRegistry) else (lambda url: breaker)
+
+    class GuardedHTTPClient(base):
+        def request(self, method, endpoint, *args, **kwargs):
+            breaker = select(endpoint)
+            if not breaker.allow_request():
+                raise CircuitOpenError(f"Google Sheets временно недоступен (выключатель '{breaker.name}' разомкнут)")
+            try:
+                response = super().request(method, endpoint, *args, **kwargs)
+            except Exception as e:
+                if is_availability_error(e):
+                    breaker.record_failure(e)
+                else:
+                    breaker.record_success()  # Сервис ответил — он доступен
+                raise
+            breaker.record_success()
+            return response
+
+    return GuardedHTTPClient
@@ -0,0 +1,170 @@
+"""
+Защита от повторной обработки сообщений и повторных счетов
+
+Telegram может прислать тот же апдейт повторно после перезапуска или сбоя
+сети. ProcessedIndex хранит последние ``max_size`` пар (chat_id, message_id)
+с номером записанной строки в LRU-словаре: проверка — O(1), память
+ограничена. При старте индекс заполняется из журнала счетов.
+
+Один и тот же счёт поставщика могут прислать разные люди или в разные чаты.
+InvoiceIndex хранит хэши ключевых полей всех счетов целевых листов и
+позволяет найти такой же счёт в памяти, без чтения таблицы.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+PENDING = None  # Сообщение принято, строка ещё не записана
+
+
+class ProcessedIndex:
+    """Ограниченный LRU-индекс обработанных сообщений"""
+
+    def __init__(self, max_size=50000):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.duplicates = 0
+
+    def reserve(self, chat_id, message_id):
+        """Помечает сообщение как принятое.
+
+        Возвращает (True, None) для нового сообщения и (False, row_number)
+        для уже обработанного; row_number = None, если строка ещё в пути.
+        """
+        key = (chat_id, message_id)
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.duplicates += 1
+                return False, self._items[key]
+            self._items[key] = PENDING
+            if len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+            return True, None
+
+    def record(self, chat_id, message_id, row_number):
+        """Запоминает строку, в которую записано сообщение"""
+        key = (chat_id, message_id)
+        with self._lock:
+            self._items[key] = row_number
+            self._items.move_to_end(key)
+            if len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def release(self, chat_id, message_id):
+        """Снимает отметку, если сообщение не удалось принять (его можно прислать снова)"""
+        with self._lock:
+            self._items.pop((chat_id, message_id), None)
+
+    def load(self, items):
+        """Заполняет индекс парами ((chat_id, message_id), row_number) от старых к новым"""
+        for (chat_id, message_id), row_number in items:
+            self.record(chat_id, message_id, row_number)
+
+    def __len__(self):
+        return len(self._items)
+
+
+def sheet_row_url(spreadsheet_id, sheet_id, row_number):
+    """Ссылка на строку листа в Google Sheets"""
+    return f"https://docs.google.com/spreadsheets/d/{spreadsheet_id}/edit#gid={sheet_id}&range=A{row_number}"
+
+
+class InvoiceIndex:
+    """Хэш-индекс счетов по дате, реквизитам счёта, сумме и поставщику.
+
+    Значение — (spreadsheet_id, sheet_id, row_number, telegram_link);
+    row_number = None, пока строка ещё не записана.
+    """
+
+    def __init__(self, key_columns=(1, 2, 9, 10), link_column=11):
+        self.key_columns = key_columns
+        self.link_column = link_column
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def key(self, row):
+        """Компактный хэш ключевых полей строки или None, если какое-то поле пустое"""
+        parts = []
+        for column in self.key_columns:
+            value = row[column - 1] if column <= len(row) else ''
+            # Пробелы убираем целиком: таблица может показать сумму как «30 500,00»
+            value = ''.join(str(value).split()).casefold()
+            if not value:
+                return None
+            parts.append(value)
+        return hashlib.blake2b('\x1f'.join(parts).encode('utf8'), digest_size=12).digest()
+
+    def _link(self, row):
+        return row[self.link_column - 1] if self.link_column <= len(row) else ''
+
+    def check_and_add(self, row, spreadsheet_id=None, sheet_id=None):
+        """Возвращает место уже известного такого же счёта или добавляет этот и возвращает None"""
+        key = self.key(row)
+        if key is None:
+            return None
+        with self._lock:
+            existing = self._items.get(key)
+            if existing is not None:
+                return existing
+            self._items[key] = (spreadsheet_id, sheet_id, None, self._link(row))
+            return None
+
+    def discard(self, row):
+        """Убирает счёт, добавленный check_and_add, если он так и не попал в журнал.
+
+        Удаляется только запись этого же сообщения без номера строки: иначе повторная
+        отправка после ошибки получила бы предупреждение «ещё записывается».
+        """
+        key = self.key(row)
+        if key is None:
+            return
+        with self._lock:
+            existing = self._items.get(key)
+            if existing is not None and existing[2] is None and existing[3] == self._link(row):
+                del self._items[key]
+
+    def set_location(self, row, spreadsheet_id, sheet_id, row_number):
+        """Запоминает строку, в которую записан счёт.
+
+        Место уже известного счёта из другого сообщения не перезаписывается:
+        ссылка в предупреждениях должна вести на оригинал, а не на повтор.
+        """
+        key = self.key(row)
+        if key is None:
+            return
+        link = self._link(row)
+        with self._lock:
+            existing = self._items.get(key)
+            if existing is None or existing[3] == link:
+                self._items[key] = (spreadsheet_id, sheet_id, row_number, link)
+
+    def load_rows(self, rows, spreadsheet_id, sheet_id, first_row):
+        """Добавляет строки, прочитанные из листа; уже известные счета не перезаписываются"""
+        added = 0
+        with self._lock:
+            for offset, row in enumerate(rows):
+                key = self.key(row)
+                if key is not None and key not in self._items:
+                    self._items[key] = (spreadsheet_id, sheet_id, first_row + offset, self._link(row))
+                    added += 1
+        return added
+
+    def __len__(self):
+        return len(self._items)
+
+
+def build_index_from_worksheet(index, worksheet, first_row=1, chunk=1000, last_column='L'):
+    """Читает лист блоками по chunk строк и добавляет счета в индекс"""
+    added = 0
+    start = first_row
+    while start <= worksheet.row_count:
+        end = min(start + chunk - 1, worksheet.row_count)
+        rows = worksheet.get(f"A{start}:{last_column}{end}")
+        if not rows:
+            break
+        added += index.load_rows(rows, worksheet.spreadsheet_id, worksheet.id, start)
+        start = end + 1
+    return added
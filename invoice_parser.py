@@ -0,0 +1,96 @@
+"""
+Разбор сообщений @paycollect_bot по декларативной схеме полей
+
+Схема описывает каждое поле счёта: название, регулярное выражение,
+нормализацию и столбец в реестре. Выражения компилируются один раз при
+создании парсера. Модуль не зависит от Telegram и Google Sheets, поэтому
+его можно импортировать в тестах и бенчмарках.
+"""
+
+import re
+from collections import namedtuple
+
+BOT_TAG = '@paycollect_bot'
+FIELD_SEPARATOR = ' - '
+
+# column — номер столбца в реестре (с 1); normalize — функция или None
+Field = namedtuple('Field', ['name', 'title', 'pattern', 'normalize', 'column'])
+
+TEXT_PATTERN = r"[\w\s.,*-]+"
+
+INVOICE_FIELDS = (
+    Field('date', "Дата (ДД.ММ.ГГГГ)", r"\d{2}\.\d{2}\.\d{4}", None, 1),
+    Field('account', "Реквизиты счета", TEXT_PATTERN, None, 2),
+    Field('project', "Название чата", TEXT_PATTERN, None, 3),
+    Field('direction', "Регион/направление", TEXT_PATTERN, str.title, 5),
+    Field('stage', "Этап/вид расходов", TEXT_PATTERN, None, 6),
+    Field('category', "Категория", TEXT_PATTERN, None, 7),
+    Field('description', "Детализация расходов", r"[\w\s0-9.,*-]+", None, 8),
+    Field('amount', "Сумма (ожидается только цифры и копейки разделенные запятой)", r"^-?\d+,\d{2}$", None, 9),
+    Field('supplier', "Поставщик", TEXT_PATTERN, None, 10),
+    Field('company', "Компания", TEXT_PATTERN, None, 12),
+)
+
+LINK_COLUMN = 11  # Ссылка на сообщение в Telegram
+ROW_WIDTH = 12
+
+ParseResult = namedtuple('ParseResult', ['values', 'errors'])
+
+
+class InvoiceParser:
+    """Разбирает текст сообщения в словарь полей и строку реестра за один проход"""
+
+    def __init__(self, fields=INVOICE_FIELDS, tag=BOT_TAG, separator=FIELD_SEPARATOR,
+                 link_column=LINK_COLUMN, row_width=ROW_WIDTH):
+        self.fields = tuple(fields)
+        self.tag = tag
+        self.separator = separator
+        self.link_column = link_column
+        self.row_width = row_width
+        self._validators = tuple((field, re.compile(field.pattern).match) for field in self.fields)
+
+    def is_addressed(self, text):
+        """Дешёвая проверка: адресовано ли сообщение боту"""
+        return bool(text) and text.startswith(self.tag)
+
+    def split(self, text):
+        """Отделяет тег бота и разбивает текст на поля"""
+        body = text[len(self.tag):].strip() if text.startswith(self.tag) else text.strip()
+        return [item.strip() for item in body.split(self.separator)]
+
+    def parse(self, text):
+        """Возвращает ParseResult: значения полей или список всех ошибок сразу"""
+        return self.validate(self.split(text))
+
+    def validate(self, parts):
+        """Проверяет поля, полученные из split"""
+        if len(parts) != len(self.fields):
+            return ParseResult(None, [
+                f"Ошибка: Неверное количество полей: ожидается {len(self.fields)}, получено {len(parts)}. "
+                f"Проверьте формат сообщения и разделители."
+            ])
+
+        values = {}
+        errors = []
+        for (field, match), value in zip(self._validators, parts):
+            if match(value) is None:
+                errors.append(f"Ошибка в поле '{field.title}': '{value}'")
+            else:
+                values[field.name] = field.normalize(value) if field.normalize else value
+
+        if errors:
+            return ParseResult(None, errors)
+        return ParseResult(values, [])
+
+    def build_row(self, values, telegram_link):
+        """Раскладывает значения полей по столбцам реестра"""
+        row = [''] * self.row_width
+        for field in self.fields:
+            row[field.column - 1] = values[field.name]
+        row[self.link_column - 1] = telegram_link
+        return row
+
+
+def telegram_link(chat_id, message_id):
+    """Ссылка на сообщение в супергруппе вида https://t.me/c/<id>/<message_id>"""
+    return f"https://t.me/c/{str(chat_id).lstrip('-').lstrip('100')}/{message_id}"
@@ -0,0 +1,279 @@
+"""
+Локальный журнал счетов (write-ahead) на SQLite в режиме WAL
+
+Каждый прошедший валидацию счёт сначала сохраняется в журнал с fsync и
+только потом отправляется в Google Sheets. Фоновый JournalCommitter
+повторяет запись незаписанных счетов, а при старте процесса отправляет всё,
+что осталось в журнале после сбоя или перезапуска.
+
+Перед записью пачки в журнал сохраняются лист и номер выделенной строки.
+Если ответ batch_update потерялся или процесс упал до отметки о записи,
+при повторе сначала проверяется эта строка: счёт с той же ссылкой на
+сообщение Telegram считается записанным и второй раз не добавляется.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+JournalEntry = namedtuple(
+    'JournalEntry',
+    ['id', 'chat_id', 'message_id', 'spreadsheet_id', 'sheet_name', 'row', 'attempts', 'created_at',
+     'written_sheet', 'row_number'],
+    defaults=(None, None)  # Лист и строка, выделенные под счёт до записи
+)
+
+STATUS_PENDING = 'pending'
+STATUS_COMMITTED = 'committed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS invoices (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    spreadsheet_id TEXT NOT NULL,
+    sheet_name TEXT NOT NULL,
+    row_json TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    row_number INTEGER,
+    written_sheet TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    committed_at REAL
+);
+CREATE INDEX IF NOT EXISTS invoices_status ON invoices (status, id);
+"""
+
+# Столбцы, добавленные после первой версии схемы: журналы со старых установок дополняются при открытии
+MIGRATIONS = {'written_sheet': "ALTER TABLE invoices ADD COLUMN written_sheet TEXT"}
+
+
+class InvoiceJournal:
+    """Журнал счетов: append с fsync, выборка незаписанных, отметка о записи"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")  # fsync на каждый коммит
+        self._conn.executescript(SCHEMA)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(invoices)")}
+        for column, statement in MIGRATIONS.items():
+            if column not in columns:
+                self._conn.execute(statement)
+
+    def append(self, chat_id, message_id, spreadsheet_id, sheet_name, row):
+        """Сохраняет счёт; после возврата запись переживёт падение процесса"""
+        created_at = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO invoices (chat_id, message_id, spreadsheet_id, sheet_name, row_json, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (chat_id, message_id, spreadsheet_id, sheet_name, json.dumps(row, ensure_ascii=False), created_at)
+            )
+        return JournalEntry(cursor.lastrowid, chat_id, message_id, spreadsheet_id, sheet_name, row, 0, created_at)
+
+    def pending(self, limit=500, after_id=0):
+        """Незаписанные в таблицу счета в порядке поступления (с id больше after_id)"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, chat_id, message_id, spreadsheet_id, sheet_name, row_json, attempts, created_at, "
+                "written_sheet, row_number FROM invoices WHERE status = ? AND id > ? ORDER BY id LIMIT ?",
+                (STATUS_PENDING, after_id, limit)
+            ).fetchall()
+        return [
+            JournalEntry(id_, chat_id, message_id, spreadsheet_id, sheet_name, json.loads(row_json), attempts, created_at,
+                         written_sheet, row_number)
+            for (id_, chat_id, message_id, spreadsheet_id, sheet_name, row_json, attempts, created_at,
+                 written_sheet, row_number) in rows
+        ]
+
+    def pending_count(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM invoices WHERE status = ?", (STATUS_PENDING,)
+            ).fetchone()[0]
+
+    def recent_messages(self, limit):
+        """Последние limit сообщений: ((chat_id, message_id), row_number) от старых к новым"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT chat_id, message_id, row_number FROM invoices ORDER BY id DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [((chat_id, message_id), row_number) for chat_id, message_id, row_number in reversed(rows)]
+
+    def mark_allocated(self, sheet_name, allocations):
+        """Перед записью пачки: [(entry_id, row_number)] — строки, которые сейчас будут заняты"""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "UPDATE invoices SET written_sheet = ?, row_number = ? WHERE id = ? AND status = ?",
+                    [(sheet_name, row_number, entry_id, STATUS_PENDING) for entry_id, row_number in allocations]
+                )
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def mark_committed(self, entry_id, row_number):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE invoices SET status = ?, row_number = ?, committed_at = ? WHERE id = ?",
+                (STATUS_COMMITTED, row_number, time.time(), entry_id)
+            )
+
+    def mark_failed(self, entry_id, error):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE invoices SET attempts = attempts + 1, last_error = ? WHERE id = ?",
+                (str(error)[:500], entry_id)
+            )
+
+    def prune(self, older_than):
+        """Удаляет записанные счета старше older_than секунд"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM invoices WHERE status = ? AND committed_at < ?",
+                (STATUS_COMMITTED, time.time() - older_than)
+            )
+        return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class JournalCommitter:
+    """Переносит счета из журнала в таблицу и повторяет неудачные попытки.
+
+    submit(entry) должен вернуть concurrent.futures.Future с номером строки
+    (например, из WriteBehindQueue) или бросить исключение.
+    find_written(entry) вызывается для счетов с выделенной строкой и
+    возвращает её номер, если счёт уже в таблице, иначе None.
+    """
+
+    def __init__(self, journal, submit, retry_interval=30, keep_committed=30 * 24 * 3600, paused=None,
+                 find_written=None):
+        self.journal = journal
+        self.submit = submit
+        self.find_written = find_written
+        # paused(entry) -> True, пока хранилище счёта заведомо недоступно (например, разомкнут выключатель);
+        # счета других хранилищ при этом продолжают уходить
+        self.paused = paused
+        self.retry_interval = retry_interval
+        self.keep_committed = keep_committed
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def append(self, chat_id, message_id, spreadsheet_id, sheet_name, row):
+        """Сохраняет счёт в журнал и сразу помечает его как находящийся в работе"""
+        with self._lock:
+            entry = self.journal.append(chat_id, message_id, spreadsheet_id, sheet_name, row)
+            self._in_flight.add(entry.id)
+        return entry
+
+    def commit(self, entry):
+        """Отправляет запись журнала в таблицу; Future завершится после записи"""
+        with self._lock:
+            self._in_flight.add(entry.id)
+        try:
+            if entry.row_number is not None and self.find_written is not None:
+                # Прошлая попытка могла записать строку, но не дождаться ответа
+                row_number = self.find_written(entry)
+                if row_number is not None:
+                    logger.info(f"♻️ Счёт #{entry.id} уже в строке {row_number} листа '{entry.written_sheet}'")
+                    self._finish(entry, row_number=row_number)
+                    future = Future()
+                    future.set_result(row_number)
+                    return future
+            future = self.submit(entry)
+        except Exception as e:
+            self._finish(entry, error=e)
+            raise
+        future.add_done_callback(lambda f: self._on_done(entry, f))
+        return future
+
+    def release(self, entry):
+        """Счёт сохранён в журнале, но в таблицу сейчас не отправляется — его заберёт replay"""
+        with self._lock:
+            self._in_flight.discard(entry.id)
+
+    def _on_done(self, entry, future):
+        error = future.exception()
+        self._finish(entry, row_number=None if error else future.result(), error=error)
+
+    def _finish(self, entry, row_number=None, error=None):
+        try:
+            if error is None:
+                self.journal.mark_committed(entry.id, row_number)
+            else:
+                self.journal.mark_failed(entry.id, error)
+                logger.warning(f"⚠️ Счёт #{entry.id} остался в журнале, повтор через {self.retry_interval} с: {error}")
+        finally:
+            with self._lock:
+                self._in_flight.discard(entry.id)
+
+    def _is_paused(self, entry):
+        if self.paused is None:
+            return False
+        try:
+            return self.paused(entry)
+        except Exception as e:
+            logger.error(f"❌ Не удалось проверить хранилище счёта #{entry.id}: {e}")
+            return True
+
+    def replay(self, limit=500):
+        """Отправляет до limit незаписанных счетов, которые сейчас не в работе и не на паузе"""
+        entries, after_id = [], 0
+        while len(entries) < limit:
+            page = self.journal.pending(limit, after_id)
+            if not page:
+                break
+            after_id = page[-1].id
+            # Счета недоступного хранилища пропускаем, не задерживая остальные
+            ready = [entry for entry in page if not self._is_paused(entry)]
+            with self._lock:
+                ready = [entry for entry in ready if entry.id not in self._in_flight][:limit - len(entries)]
+                self._in_flight.update(entry.id for entry in ready)
+            entries += ready
+            if len(page) < limit:
+                break
+        if entries:
+            logger.info(f"🔁 Повторная отправка {len(entries)} счетов из журнала")
+        for entry in entries:
+            try:
+                self.commit(entry)
+            except Exception as e:
+                logger.error(f"❌ Не удалось отправить счёт #{entry.id} из журнала: {e}")
+        return len(entries)
+
+    def start(self):
+        """Отправляет накопленное при старте и запускает фоновые повторы"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='journal-committer', daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        self.replay()
+        while not self._stop.wait(self.retry_interval):
+            self.replay()
+            removed = self.journal.prune(self.keep_committed)
+            if removed:
+                logger.info(f"🧹 Из журнала удалено {removed} старых записанных счетов")
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
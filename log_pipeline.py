@@ -0,0 +1,139 @@
+"""
+Неблокирующее логирование бота
+
+Вызовы logger.* в обработчиках сообщений только кладут запись в
+ограниченную очередь; в файл и консоль пишет фоновый QueueListener.
+Файл — JSON-строки с ротацией по размеру и по времени. Когда очередь
+заполняется, DEBUG-записи прореживаются, а при полной очереди записи
+отбрасываются с подсчётом — обработка сообщений никогда не ждёт диска
+или непрочитанного stdout.
+"""
+
+import atexit
+import json
+import logging
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+CONSOLE_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна JSON-строка"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'msg': record.getMessage()
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class SizeAndTimeRotatingFileHandler(RotatingFileHandler):
+    """Ротация при превышении max_bytes или раз в interval секунд"""
+
+    def __init__(self, filename, max_bytes=10 * 1024 * 1024, backup_count=5, interval=24 * 3600, encoding='utf8'):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding=encoding, delay=True)
+        self.interval = interval
+        self.rollover_at = time.time() + interval
+
+    def shouldRollover(self, record):
+        if self.interval and time.time() >= self.rollover_at:
+            return True
+        return bool(super().shouldRollover(record))
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = time.time() + self.interval
+
+
+class PressureQueueHandler(QueueHandler):
+    """QueueHandler, который никогда не блокирует вызывающий поток.
+
+    Пока очередь заполнена больше чем на high_water, проходит только каждая
+    sample_every-я DEBUG-запись; если очередь полна — запись отбрасывается.
+    О числе потерянных записей сообщается, как только место освободится.
+    """
+
+    def __init__(self, log_queue, high_water=0.5, sample_every=10):
+        super().__init__(log_queue)
+        self.capacity = log_queue.maxsize
+        self.high_water = high_water
+        self.sample_every = sample_every
+        self.dropped = 0
+        self.sampled_out = 0
+        self._unreported = 0
+        self._debug_seen = 0
+        self._lock = threading.Lock()
+
+    def enqueue(self, record):
+        if record.levelno <= logging.DEBUG and self.queue.qsize() >= self.capacity * self.high_water:
+            with self._lock:
+                self._debug_seen += 1
+                if self._debug_seen % self.sample_every:
+                    self.sampled_out += 1
+                    return
+        with self._lock:
+            unreported, self._unreported = self._unreported, 0
+        try:
+            if unreported:
+                self.queue.put_nowait(self._dropped_record(unreported))
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+                self._unreported += unreported + 1
+
+    def _dropped_record(self, count):
+        record = logging.LogRecord(
+            __name__, logging.WARNING, __file__, 0,
+            f"⚠️ Очередь логов переполнена, потеряно записей: {count}", None, None
+        )
+        record.threadName = threading.current_thread().name
+        return record
+
+
+def parse_levels(spec):
+    """'telebot=WARNING,write_queue=DEBUG' -> {'telebot': 'WARNING', ...}"""
+    levels = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, level = item.partition('=')
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging(path='bot.log', level='INFO', levels='', max_bytes=10 * 1024 * 1024, backup_count=5,
+                  rotate_interval=24 * 3600, queue_size=10000, console=True):
+    """Настраивает корневой логгер на очередь и запускает фоновую запись.
+
+    Возвращает QueueListener; он остановится и допишет очередь при выходе.
+    """
+    file_handler = SizeAndTimeRotatingFileHandler(path, max_bytes, backup_count, rotate_interval)
+    file_handler.setFormatter(JsonFormatter())
+    handlers = [file_handler]
+    if console:
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+        handlers.append(console_handler)
+
+    log_queue = queue.Queue(maxsize=queue_size)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(PressureQueueHandler(log_queue))
+    root.setLevel(level.upper())
+    for name, logger_level in parse_levels(levels).items():
+        logging.getLogger(None if name == 'root' else name).setLevel(logger_level)
+
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -21,6 +21,8 @@ class BotManager:
         # Файлы для хранения PID
         self.bot_pid_file = self.base_dir / '.bot.pid'
         self.monitor_pid_file = self.base_dir / '.monitor.pid'
+        # Вывод бота до настройки логирования (ошибка импорта, неверный .env)
+        self.bot_stderr_file = self.base_dir / 'bot.stderr.log'
     
     def start_bot(self):
         """Запуск бота"""
@@ -30,18 +32,25 @@ class BotManager:
         
         print("🚀 Запуск бота...")
         try:
-            process = subprocess.Popen(
-                [str(self.venv_python), str(self.bot_script)],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                cwd=str(self.base_dir)
-            )
+            # Не PIPE: его никто не читает, и бот встанет, когда заполнится буфер канала.
+            # Логи идут только в bot.log с ротацией (LOG_CONSOLE=0), в файл попадают трассировки
+            # до настройки логирования и прочий вывод мимо logging
+            env = dict(os.environ, LOG_CONSOLE='0')
+            with open(self.bot_stderr_file, 'a') as output:
+                process = subprocess.Popen(
+                    [str(self.venv_python), str(self.bot_script)],
+                    stdout=output,
+                    stderr=subprocess.STDOUT,
+                    cwd=str(self.base_dir),
+                    env=env
+                )
             
             # Сохраняем PID
             with open(self.bot_pid_file, 'w') as f:
                 f.write(str(process.pid))
             
             print(f"✅ Бот запущен с PID: {process.pid}")
+            print(f"📄 Вывод процесса: {self.bot_stderr_file}")
             return True
             
         except Exception as e:
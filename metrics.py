@@ -0,0 +1,193 @@
+"""
+Метрики конвейера обработки счетов в текстовом формате Prometheus
+
+Гистограммы задержки по этапам (разбор, валидация, маршрутизация, поиск
+строки, запись в таблицу, ответ в Telegram) и счётчики сообщений по чатам
+и листам. Наблюдение — это bisect и пара сложений под блокировкой, поэтому
+на время обработки сообщения не влияет. Бот отдаёт метрики на
+http://127.0.0.1:<METRICS_PORT>/metrics, monitor.py проксирует их.
+"""
+
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in labels) + '}'
+
+
+class Histogram:
+    """Гистограмма с фиксированными границами корзин"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # Последняя корзина — +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Оценка квантиля по верхней границе корзины"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class MetricsRegistry:
+    """Гистограммы этапов, счётчики и датчики (gauge) одного процесса"""
+
+    def __init__(self, prefix='paycollect', buckets=DEFAULT_BUCKETS, clock=time.perf_counter):
+        self.prefix = prefix
+        self.buckets = buckets
+        self.clock = clock
+        self._stages = {}
+        self._counters = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self._stages.get(stage)
+            if histogram is None:
+                histogram = self._stages[stage] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    @contextmanager
+    def time(self, stage):
+        """with metrics.time('parse'): ... — время блока попадает в гистограмму этапа"""
+        started = self.clock()
+        try:
+            yield
+        finally:
+            self.observe(stage, self.clock() - started)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def gauge(self, name, fn, help_text='', kind='gauge'):
+        """Значение fn() читается в момент запроса /metrics.
+
+        fn может вернуть число или {((метка, значение), ...): число} — по строке на набор меток.
+        kind='counter' — для накопительных значений, которые ведёт сам источник.
+        """
+        self._gauges[name] = (fn, help_text, kind)
+
+    def stage(self, stage):
+        """Копия гистограммы этапа (для тестов и бенчмарков)"""
+        with self._lock:
+            histogram = self._stages.get(stage)
+            if histogram is None:
+                return None
+            copy = Histogram(histogram.buckets)
+            copy.counts, copy.sum, copy.count = list(histogram.counts), histogram.sum, histogram.count
+            return copy
+
+    def counter(self, name, **labels):
+        with self._lock:
+            return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def totals(self, name, label):
+        """Сумма счётчика name по значениям метки label"""
+        totals = {}
+        with self._lock:
+            for (counter, labels), value in self._counters.items():
+                if counter == name:
+                    key = dict(labels).get(label)
+                    totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def render(self):
+        """Текст в формате Prometheus exposition"""
+        with self._lock:
+            stages = {stage: (list(h.counts), h.sum, h.count) for stage, h in self._stages.items()}
+            counters = dict(self._counters)
+        lines = []
+        name = f'{self.prefix}_stage_seconds'
+        if stages:
+            lines.append(f'# HELP {name} Задержка этапов обработки сообщения')
+            lines.append(f'# TYPE {name} histogram')
+        for stage, (counts, total, count) in sorted(stages.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{name}_bucket{format_labels([("stage", stage), ("le", le)])} {cumulative}')
+            lines.append(f'{name}_sum{format_labels([("stage", stage)])} {total:.6f}')
+            lines.append(f'{name}_count{format_labels([("stage", stage)])} {count}')
+
+        typed = set()
+        for (counter, labels), value in sorted(counters.items()):
+            full_name = f'{self.prefix}_{counter}'
+            if full_name not in typed:
+                typed.add(full_name)
+                lines.append(f'# TYPE {full_name} counter')
+            lines.append(f'{full_name}{format_labels(labels)} {value}')
+
+        for gauge, (fn, help_text, kind) in sorted(self._gauges.items()):
+            full_name = f'{self.prefix}_{gauge}'
+            try:
+                value = fn()
+            except Exception as e:
+                logger.debug(f"Датчик {gauge} недоступен: {e}")
+                continue
+            if help_text:
+                lines.append(f'# HELP {full_name} {help_text}')
+            lines.append(f'# TYPE {full_name} {kind}')
+            if isinstance(value, dict):
+                for labels, labelled_value in sorted(value.items()):
+                    lines.append(f'{full_name}{format_labels(labels)} {labelled_value}')
+            else:
+                lines.append(f'{full_name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def serve_metrics(registry, host='127.0.0.1', port=9108):
+    """Запускает HTTP-сервер /metrics в фоновом потоке и возвращает его"""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Опрос каждые 15 с не должен засорять лог
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    logger.info(f"📈 Метрики доступны на http://{host}:{port}/metrics")
+    return server
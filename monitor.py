@@ -10,11 +10,14 @@ import time
 import psutil
 import subprocess
 import threading
+import urllib.request
 from datetime import datetime, timedelta
 from flask import Flask, render_template, jsonify, request, redirect, url_for
 from dotenv import load_dotenv
 import telebot
-import gspread
+
+from sheets_client import shared_factory
+from stats_channel import StatsReceiver
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -34,6 +37,8 @@ class BotMonitor:
         }
         self.logs = []
         self.max_logs = 1000
+        # Счётчики приходят от самого бота через UNIX-сокет (см. stats_channel.py)
+        self.stats_receiver = StatsReceiver(os.getenv('BOT_STATS_SOCKET', '.bot_stats.sock')).start()
         
     def log(self, level, message):
         """Добавляет запись в лог"""
@@ -70,7 +75,8 @@ class BotMonitor:
             self.log('INFO', f'Бот запущен с PID: {self.bot_pid}')
             
             # Запускаем мониторинг вывода бота
-            threading.Thread(target=self._monitor_bot_output, daemon=True).start()
+            for stream, level in ((self.bot_process.stdout, 'BOT_OUTPUT'), (self.bot_process.stderr, 'BOT_ERROR')):
+                threading.Thread(target=self._monitor_bot_output, args=(stream, level), daemon=True).start()
             return True
             
         except Exception as e:
@@ -126,6 +132,19 @@ class BotMonitor:
         }
         return status
     
+    def get_bot_runtime_status(self):
+        """Последний снимок, присланный ботом, и скорость обработки за минуту"""
+        runtime = self.stats_receiver.summary()
+        self.stats.update({
+            'messages_processed': runtime['messages_processed'],
+            'errors': runtime['errors'],
+            'uptime': self._get_uptime(),
+            'last_activity': runtime['last_activity'],
+            'throughput_per_minute': runtime['throughput_per_minute'],
+            'error_rate': runtime['error_rate']
+        })
+        return runtime
+    
     def _get_uptime(self):
         """Возвращает время работы бота"""
         if self.start_time is None:
@@ -152,20 +171,16 @@ class BotMonitor:
         except:
             return 0
     
-    def _monitor_bot_output(self):
-        """Мониторит вывод бота"""
-        if not self.bot_process:
-            return
-            
+    def _monitor_bot_output(self, stream, level):
+        """Читает один поток вывода бота до его закрытия.
+
+        Каждый поток читается в своём треде: поочерёдный readline() на stdout
+        и stderr зависал, пока бот писал только в другой поток. Счётчики
+        сообщений и ошибок отсюда не берутся — их присылает сам бот.
+        """
         try:
-            while self.bot_process.poll() is None:
-                output = self.bot_process.stdout.readline()
-                if output:
-                    self.log('BOT_OUTPUT', output.strip())
-                error = self.bot_process.stderr.readline()
-                if error:
-                    self.log('BOT_ERROR', error.strip())
-                    self.stats['errors'] += 1
+            for line in iter(stream.readline, ''):
+                self.log(level, line.rstrip())
         except Exception as e:
             self.log('ERROR', f'Ошибка мониторинга вывода: {e}')
 
@@ -268,8 +283,8 @@ class ConfigChecker:
                 })
                 return
             
-            gc = gspread.service_account(filename=credentials_file)
-            sh = gc.open_by_key(spreadsheet_id)
+            # Общий клиент и кэш метаданных: повторные проверки не тратят квоту и не ждут OAuth
+            sh = shared_factory(credentials_file).spreadsheet(spreadsheet_id)
             
             self.checks.append({
                 'name': 'Google Sheets',
@@ -342,12 +357,26 @@ def api_status():
         'memory_percent': psutil.virtual_memory().percent,
         'disk_percent': psutil.disk_usage('/').percent
     }
+    runtime = monitor.get_bot_runtime_status()
     return jsonify({
         'bot': status,
         'system': system_info,
-        'stats': monitor.stats
+        'stats': monitor.stats,
+        'sheets': runtime.get('sheets_breaker'),
+        'runtime': runtime
     })
 
+@app.route('/metrics')
+def metrics():
+    """Метрики бота в формате Prometheus (проксируются с METRICS_PORT бота)"""
+    url = f"http://127.0.0.1:{os.getenv('METRICS_PORT', '9108')}/metrics"
+    try:
+        with urllib.request.urlopen(url, timeout=2) as response:
+            body = response.read()
+    except OSError as e:
+        return f"# Метрики бота недоступны: {e}\n", 503, {'Content-Type': 'text/plain; charset=utf-8'}
+    return body, 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
 @app.route('/api/logs')
 def api_logs():
     """API для получения логов"""
@@ -0,0 +1,202 @@
+"""
+Ограничение частоты запросов к Google Sheets API
+
+Отдельные token bucket для чтения и записи, размеры которых задаются под
+квоту проекта (запросов в минуту). При ответах 429/5xx запрос повторяется
+с экспоненциальной задержкой и случайным разбросом, а скорость
+соответствующего bucket временно снижается и затем плавно восстанавливается.
+Вызывающий код ждёт своей очереди вместо того, чтобы получить ошибку.
+"""
+
+import logging
+import random
+import threading
+import time
+from http import HTTPStatus
+
+from gspread.exceptions import APIError
+from gspread.http_client import HTTPClient
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_CODES = {HTTPStatus.REQUEST_TIMEOUT, HTTPStatus.TOO_MANY_REQUESTS}
+
+
+class TokenBucket:
+    """Token bucket: rate_per_minute токенов в минуту, запас не больше burst"""
+
+    def __init__(self, rate_per_minute, burst=None, clock=time.monotonic, sleep=time.sleep):
+        self.max_rate = rate_per_minute
+        self.rate = rate_per_minute
+        self.burst = burst or max(1, rate_per_minute // 6)
+        self.tokens = float(self.burst)
+        self.clock = clock
+        self.sleep = sleep
+        self.waiting = 0
+        self.total_wait = 0.0
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate / 60.0)
+        self._updated = now
+
+    def acquire(self):
+        """Забирает токен, при необходимости ожидая; возвращает время ожидания"""
+        waited = 0.0
+        with self._lock:
+            self.waiting += 1
+        try:
+            while True:
+                with self._lock:
+                    self._refill(self.clock())
+                    # Допуск на округление: иначе остаток в 1e-16 токена даёт бесконечно малые ожидания
+                    if self.tokens >= 1 - 1e-9:
+                        self.tokens -= 1
+                        self.total_wait += waited
+                        return waited
+                    delay = (1 - self.tokens) * 60.0 / self.rate
+                self.sleep(delay)
+                waited += delay
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+    def throttle(self, factor=0.5, min_rate=1):
+        """Снижает скорость после ответа 429"""
+        with self._lock:
+            self.rate = max(min_rate, self.rate * factor)
+            self.tokens = min(self.tokens, 0.0)
+
+    def recover(self, step=0.05):
+        """Понемногу возвращает скорость к исходной после успешных запросов"""
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * step)
+
+
+class SheetsRateLimiter:
+    """Общий ограничитель для всех обращений бота к Google Sheets"""
+
+    def __init__(self, reads_per_minute=60, writes_per_minute=60, max_retries=6,
+                 base_delay=1.0, max_delay=64.0, clock=time.monotonic, sleep=time.sleep):
+        self.buckets = {
+            'read': TokenBucket(reads_per_minute, clock=clock, sleep=sleep),
+            'write': TokenBucket(writes_per_minute, clock=clock, sleep=sleep),
+        }
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+        self.counters = {'requests': 0, 'throttled': 0, 'retries': 0, 'failures': 0}
+        self._lock = threading.Lock()
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    @staticmethod
+    def is_retryable(error):
+        code = error.code
+        if code in RETRYABLE_CODES or code >= HTTPStatus.INTERNAL_SERVER_ERROR:
+            return True
+        # Drive API сообщает о превышении квоты кодом 403 с доменом usageLimits
+        errors = error.error.get('errors') or [{}]
+        return code == HTTPStatus.FORBIDDEN and errors[0].get('domain') == 'usageLimits'
+
+    def backoff_delay(self, attempt, error=None):
+        """Экспоненциальная задержка с разбросом; Retry-After сервера имеет приоритет"""
+        response = getattr(error, 'response', None)
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def call(self, kind, fn, *args, **kwargs):
+        """Выполняет fn с учётом квоты kind ('read' или 'write') и повторами"""
+        bucket = self.buckets[kind]
+        attempt = 0
+        while True:
+            bucket.acquire()
+            self._count('requests')
+            try:
+                result = fn(*args, **kwargs)
+            except APIError as e:
+                if not self.is_retryable(e) or attempt >= self.max_retries:
+                    self._count('failures')
+                    raise
+                if e.code == HTTPStatus.TOO_MANY_REQUESTS:
+                    self._count('throttled')
+                    bucket.throttle()
+                delay = self.backoff_delay(attempt, e)
+                attempt += 1
+                self._count('retries')
+                logger.warning(
+                    f"⏳ Sheets API {e.code} ({kind}), повтор {attempt}/{self.max_retries} через {delay:.1f} с"
+                )
+                self.sleep(delay)
+                continue
+            bucket.recover()
+            return result
+
+    def stats(self):
+        """Состояние ограничителя для метрик"""
+        with self._lock:
+            stats = dict(self.counters)
+        for kind, bucket in self.buckets.items():
+            stats[f'{kind}_rate_per_minute'] = round(bucket.rate, 2)
+            stats[f'{kind}_tokens'] = round(bucket.tokens, 2)
+            stats[f'{kind}_waiting'] = bucket.waiting
+            stats[f'{kind}_wait_seconds_total'] = round(bucket.total_wait, 3)
+        return stats
+
+
+# Счётчики ограничителя (stats()) и датчики его bucket'ов для /metrics
+LIMITER_COUNTERS = {
+    'requests': 'Попыток запросов к Sheets API',
+    'throttled': 'Ответов 429 от Sheets API',
+    'retries': 'Повторов после 429/5xx',
+    'failures': 'Запросов, завершившихся ошибкой после повторов'
+}
+BUCKET_GAUGES = {
+    'tokens': ('gauge', 'Токенов в bucket'),
+    'rate_per_minute': ('gauge', 'Текущая скорость bucket, запросов/мин'),
+    'waiting': ('gauge', 'Запросов, ждущих токен'),
+    'wait_seconds_total': ('counter', 'Суммарное ожидание токенов, сек')
+}
+
+
+def register_limiter_metrics(metrics, limiters):
+    """Метрики ограничителей в MetricsRegistry; limiters() -> {имя: SheetsRateLimiter}"""
+
+    def samples(key, per_bucket=False):
+        values = {}
+        for name, limiter in list(limiters().items()):
+            stats = limiter.stats()
+            if not per_bucket:
+                values[(('credentials', name),)] = stats[key]
+                continue
+            for kind in limiter.buckets:
+                values[(('credentials', name), ('kind', kind))] = stats[f'{kind}_{key}']
+        return values
+
+    for key, help_text in LIMITER_COUNTERS.items():
+        metrics.gauge(f'sheets_limiter_{key}_total', lambda key=key: samples(key), help_text, kind='counter')
+    for key, (kind, help_text) in BUCKET_GAUGES.items():
+        metrics.gauge(f'sheets_limiter_{key}', lambda key=key: samples(key, per_bucket=True), help_text, kind=kind)
+
+
+def limited_http_client(limiter, base=HTTPClient):
+    """Класс HTTP-клиента gspread, пропускающий каждый запрос через limiter.
+
+    base выполняет одну попытку: если это клиент с выключателем (breaker_http_client),
+    выключатель считает каждую попытку, а CircuitOpenError не повторяется — это не APIError.
+    """
+
+    class RateLimitedHTTPClient(base):
+        def request(self, method, endpoint, *args, **kwargs):
+            kind = 'read' if method.lower() == 'get' else 'write'
+            return limiter.call(kind, super().request, method, endpoint, *args, **kwargs)
+
+    return RateLimitedHTTPClient
@@ -0,0 +1,165 @@
+"""
+Справочники полей счёта: проекты, регионы, этапы, категории, поставщики
+
+Свободный текст в полях порождал в отчётах новые категории из-за опечаток.
+Допустимые значения берутся из листа-справочника (первая строка — названия
+полей, под ними значения столбцом) и держатся в памяти: точное совпадение —
+поиск в словаре, неточное — индекс триграмм с оценкой Дайса. Проверка
+сообщения не обращается к Sheets; справочник перечитывается в фоновом
+потоке, когда истёк ``ttl``.
+"""
+
+import logging
+import threading
+import time
+from collections import defaultdict, namedtuple
+
+logger = logging.getLogger(__name__)
+
+REFERENCE_FIELDS = ('project', 'direction', 'stage', 'category', 'supplier')
+# Заголовки столбцов справочника, кроме имени и названия поля из схемы
+HEADER_ALIASES = {'project': ('Проект', 'Объект'), 'direction': ('Регион',), 'stage': ('Этап',)}
+
+ReferenceCheck = namedtuple('ReferenceCheck', ['values', 'errors'])
+
+
+def normalize(value):
+    """Регистр, лишние пробелы и ё не делают значения разными"""
+    return ' '.join(str(value).replace('ё', 'е').replace('Ё', 'Е').split()).casefold()
+
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class FuzzyIndex:
+    """Точный поиск по нормализованному значению и подсказки по общим триграммам"""
+
+    def __init__(self, values, threshold=0.5, limit=3):
+        self.threshold = threshold
+        self.limit = limit
+        self.canonical = {}  # нормализованное значение -> написание из справочника
+        self._grams = {}
+        self._postings = defaultdict(list)
+        for value in values:
+            key = normalize(value)
+            if not key or key in self.canonical:
+                continue
+            self.canonical[key] = str(value).strip()
+            grams = self._grams[key] = trigrams(key)
+            for gram in grams:
+                self._postings[gram].append(key)
+
+    def __len__(self):
+        return len(self.canonical)
+
+    def exact(self, value):
+        return self.canonical.get(normalize(value))
+
+    def suggest(self, value):
+        """До limit значений справочника, похожих на value, от самого похожего"""
+        key = normalize(value)
+        grams = trigrams(key)
+        shared = defaultdict(int)
+        for gram in grams:
+            for candidate in self._postings.get(gram, ()):
+                shared[candidate] += 1
+        scored = []
+        for candidate, count in shared.items():
+            score = 2.0 * count / (len(grams) + len(self._grams[candidate]))
+            if score >= self.threshold:
+                scored.append((-score, candidate))
+        scored.sort()
+        return [self.canonical[candidate] for _, candidate in scored[:self.limit]]
+
+
+def load_reference_sheet(worksheet, fields, reference_fields=REFERENCE_FIELDS, aliases=HEADER_ALIASES):
+    """{поле: [значения]} из листа-справочника; заголовок столбца — имя поля, его название или синоним"""
+    rows = worksheet.get_all_values()
+    if not rows:
+        return {}
+    by_header = {}
+    for field in fields:
+        if field.name in reference_fields:
+            by_header[normalize(field.name)] = field.name
+            by_header[normalize(field.title)] = field.name
+            for alias in aliases.get(field.name, ()):
+                by_header[normalize(alias)] = field.name
+    columns = {}
+    for index, header in enumerate(rows[0]):
+        name = by_header.get(normalize(header))
+        if name is not None:
+            columns[name] = [row[index] for row in rows[1:] if index < len(row) and row[index].strip()]
+    return columns
+
+
+class ReferenceDictionaries:
+    """Индексы справочников с обновлением по TTL в фоновом потоке"""
+
+    def __init__(self, load, fields, ttl=600, threshold=0.5, clock=time.monotonic):
+        # load() -> {поле: [значения]}; поля без столбца в справочнике не проверяются
+        self.load = load
+        self.titles = {field.name: field.title for field in fields}
+        self.ttl = ttl
+        self.threshold = threshold
+        self.clock = clock
+        self.indexes = {}
+        self.loaded_at = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Перечитывает справочник и атомарно подменяет индексы"""
+        try:
+            columns = self.load()
+            indexes = {name: FuzzyIndex(values, self.threshold) for name, values in columns.items() if values}
+        except Exception as e:
+            # Старые индексы продолжают работать, следующая попытка — через ttl
+            logger.error(f"❌ Не удалось обновить справочники: {e}")
+            with self._lock:
+                self.loaded_at = self.clock()
+            return False
+        with self._lock:
+            self.indexes = indexes
+            self.loaded_at = self.clock()
+        summary = ', '.join(f"{name}: {len(index)}" for name, index in indexes.items())
+        logger.info(f"📚 Справочники обновлены ({summary or 'пусто'})")
+        return True
+
+    def refresh_if_stale(self):
+        """Запускает фоновое обновление, если истёк ttl (не чаще одного потока)"""
+        with self._lock:
+            if self._refreshing or (self.loaded_at is not None and self.clock() - self.loaded_at < self.ttl):
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=run, name='reference-refresh', daemon=True).start()
+
+    def check(self, values):
+        """Сверяет поля со справочниками; точные совпадения приводит к написанию из справочника"""
+        self.refresh_if_stale()
+        indexes = self.indexes
+        checked = dict(values)
+        errors = []
+        for name, index in indexes.items():
+            value = values.get(name)
+            if value is None:
+                continue
+            canonical = index.exact(value)
+            if canonical is not None:
+                checked[name] = canonical
+                continue
+            suggestions = index.suggest(value)
+            message = f"Ошибка в поле '{self.titles.get(name, name)}': '{value}' нет в справочнике."
+            if suggestions:
+                message += " Возможно, вы имели в виду: " + ", ".join(f"'{s}'" for s in suggestions) + "?"
+            errors.append(message)
+        return ReferenceCheck(checked, errors)
@@ -0,0 +1,233 @@
+"""
+Таблица маршрутизации чатов: chat_id -> роль -> таблица/лист
+
+Таблица строится один раз из JSON-файла (или из переменных окружения
+CHAT_ADMIN_ID / CHAT_SNAB_ID, если файла нет) в неизменяемый словарь,
+поэтому проверка каждого апдейта — один поиск по хэшу. При изменении файла
+или по SIGHUP таблица перестраивается и подменяется целиком одной
+операцией присваивания.
+
+Формат файла::
+
+    {
+        "roles": {
+            "admin": {"sheet": "Админ бот"},
+            "snab": {"sheet": "СНАБ бот текущий", "spreadsheet_id": "..."},
+            "stream": {"sheet": "Поток", "sink": "sqlite"}
+        },
+        "chats": {
+            "-1001234567890": "admin",
+            "-1009876543210": "snab"
+        }
+    }
+
+``sink`` — хранилище строк роли (sheets по умолчанию, sqlite или csv).
+
+Переадресации листов (заполненный лист -> лист следующего периода) бот
+заводит сам и хранит отдельно, в ``redirects_path``: файл маршрутов,
+который ведут люди, не переписывается.
+"""
+
+import json
+import logging
+import os
+import signal
+import threading
+from collections import namedtuple
+from types import MappingProxyType
+
+from sinks import SINK_KINDS, SINK_SHEETS
+
+logger = logging.getLogger(__name__)
+
+Route = namedtuple('Route', ['chat_id', 'role', 'spreadsheet_id', 'sheet_name', 'sink'], defaults=(SINK_SHEETS,))
+
+
+class RoutingError(Exception):
+    """Некорректный файл маршрутизации"""
+
+
+def parse_chat_ids(value):
+    """Разбирает строку вида '-1001, -1002' в список целых ID"""
+    return [int(chat_id.strip()) for chat_id in value.split(',') if chat_id.strip()]
+
+
+def build_table(config, default_spreadsheet_id):
+    """Строит неизменяемую таблицу маршрутов из словаря конфигурации"""
+    roles = config.get('roles', {})
+    table = {}
+    for chat_id, role in config.get('chats', {}).items():
+        if role not in roles:
+            raise RoutingError(f"Чат {chat_id}: неизвестная роль '{role}'")
+        role_config = roles[role]
+        if 'sheet' not in role_config:
+            raise RoutingError(f"Роль '{role}': не указан лист (sheet)")
+        sink = role_config.get('sink', SINK_SHEETS)
+        if sink not in SINK_KINDS:
+            raise RoutingError(f"Роль '{role}': неизвестное хранилище '{sink}'")
+        table[int(chat_id)] = Route(
+            chat_id=int(chat_id),
+            role=role,
+            spreadsheet_id=role_config.get('spreadsheet_id', default_spreadsheet_id),
+            sheet_name=role_config['sheet'],
+            sink=sink
+        )
+    return MappingProxyType(table)
+
+
+def build_sinks(table):
+    """(spreadsheet_id, sheet_name) -> тип хранилища; у листа хранилище одно"""
+    sinks = {}
+    for route in table.values():
+        key = (route.spreadsheet_id, route.sheet_name)
+        if sinks.setdefault(key, route.sink) != route.sink:
+            raise RoutingError(f"Лист '{route.sheet_name}': у ролей разные хранилища")
+    return MappingProxyType(sinks)
+
+
+def apply_redirects(table, resolve):
+    """Таблица, в которой маршруты на переадресованные листы ведут на их замену"""
+    redirected = {}
+    for chat_id, route in table.items():
+        spreadsheet_id, sheet_name = resolve(route.spreadsheet_id, route.sheet_name)
+        redirected[chat_id] = route._replace(spreadsheet_id=spreadsheet_id, sheet_name=sheet_name)
+    return MappingProxyType(redirected)
+
+
+def config_from_env(admin_chats, snab_chats, admin_sheet, snab_sheet):
+    """Конфигурация в формате файла из переменных окружения (прежнее поведение)"""
+    chats = {str(chat_id): 'snab' for chat_id in parse_chat_ids(snab_chats)}
+    # Админ-чаты имеют приоритет, как и раньше в get_worksheet_for_chat
+    chats.update({str(chat_id): 'admin' for chat_id in parse_chat_ids(admin_chats)})
+    return {
+        'roles': {'admin': {'sheet': admin_sheet}, 'snab': {'sheet': snab_sheet}},
+        'chats': chats
+    }
+
+
+class ChatRouter:
+    """Текущая таблица маршрутов с горячей перезагрузкой"""
+
+    def __init__(self, path, default_spreadsheet_id, fallback_config=None, redirects_path=None):
+        self.path = path
+        self.default_spreadsheet_id = default_spreadsheet_id
+        self.fallback_config = fallback_config or {}
+        self.redirects_path = redirects_path
+        self.redirects = {}  # (spreadsheet_id, sheet_name) -> (spreadsheet_id, sheet_name)
+        self.table = MappingProxyType({})
+        self.sinks = MappingProxyType({})
+        self._base_table = self.table
+        self._redirect_lock = threading.Lock()
+        self._mtime = None
+        self._watcher = None
+
+    def lookup(self, chat_id):
+        """Маршрут чата или None, если чат не обслуживается"""
+        return self.table.get(chat_id)
+
+    def sink_for(self, spreadsheet_id, sheet_name):
+        """Тип хранилища листа; листы без маршрута пишутся в Google Sheets"""
+        return self.sinks.get((spreadsheet_id, sheet_name), SINK_SHEETS)
+
+    def load(self):
+        """Перечитывает конфигурацию и атомарно подменяет таблицу"""
+        if self.path and os.path.exists(self.path):
+            mtime = os.path.getmtime(self.path)
+            with open(self.path, 'r', encoding='utf8') as f:
+                config = json.load(f)
+            source = self.path
+        else:
+            mtime = None
+            config = self.fallback_config
+            source = 'переменные окружения'
+
+        base_table = build_table(config, self.default_spreadsheet_id)
+        with self._redirect_lock:
+            self.redirects = self._load_redirects()
+            table = apply_redirects(base_table, self.resolve)
+            sinks = build_sinks(table)
+            self._base_table = base_table
+            self.table, self.sinks = table, sinks
+        self._mtime = mtime
+        logger.info(f"🧭 Таблица маршрутов загружена ({source}): {len(table)} чатов")
+        return table
+
+    def _load_redirects(self):
+        if not self.redirects_path or not os.path.exists(self.redirects_path):
+            return {}
+        with open(self.redirects_path, 'r', encoding='utf8') as f:
+            items = json.load(f)
+        return {tuple(item['from']): tuple(item['to']) for item in items}
+
+    def _save_redirects(self):
+        items = [{'from': list(source), 'to': list(target)} for source, target in self.redirects.items()]
+        tmp_path = f"{self.redirects_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump(items, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.redirects_path)
+
+    def resolve(self, spreadsheet_id, sheet_name):
+        """Лист, в который сейчас пишутся счета листа sheet_name (с учётом цепочки переадресаций)"""
+        key = (spreadsheet_id, sheet_name)
+        for _ in range(len(self.redirects)):
+            target = self.redirects.get(key)
+            if target is None:
+                break
+            key = target
+        return key
+
+    def origin(self, spreadsheet_id, sheet_name):
+        """Исходный лист маршрута, с которого началась цепочка переадресаций"""
+        sources = {target: source for source, target in self.redirects.items()}
+        key = (spreadsheet_id, sheet_name)
+        for _ in range(len(sources)):
+            if key not in sources:
+                break
+            key = sources[key]
+        return key
+
+    def redirect(self, source, target):
+        """Переадресует маршруты листа source на лист target и сохраняет это на диск"""
+        with self._redirect_lock:
+            self.redirects[tuple(source)] = tuple(target)
+            if self.redirects_path:
+                self._save_redirects()
+            table = apply_redirects(self._base_table, self.resolve)
+            self.table, self.sinks = table, build_sinks(table)
+        logger.info(f"↪️ Лист '{source[1]}' переадресован на '{target[1]}'")
+
+    def reload(self):
+        """Как load, но ошибка в файле не ломает уже работающую таблицу"""
+        try:
+            return self.load()
+        except (OSError, ValueError, RoutingError) as e:
+            logger.error(f"❌ Не удалось перезагрузить маршруты, оставлена прежняя таблица: {e}")
+            return self.table
+
+    def _file_changed(self):
+        if not self.path:
+            return False
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            mtime = None
+        return mtime != self._mtime
+
+    def watch(self, interval=5.0):
+        """Запускает поток, перезагружающий таблицу при изменении файла"""
+        if self._watcher is not None:
+            return
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                if self._file_changed():
+                    self.reload()
+
+        self._watcher = stop
+        threading.Thread(target=run, name='routes-watcher', daemon=True).start()
+
+    def install_sighup_handler(self):
+        """Перезагрузка по SIGHUP (вызывать из главного потока)"""
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, lambda signum, frame: self.reload())
@@ -0,0 +1,95 @@
+"""
+Курсоры свободных строк листов Google Sheets
+
+Столбец с датой скачивается один раз при первом обращении к листу, дальше
+номера свободных строк выдаются из памяти и сдвигаются после успешной
+записи. Раз в ``resync_interval`` секунд (и после ошибок записи) курсор
+перечитывает столбец, чтобы подхватить ручные правки бухгалтерии.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+
+from write_queue import worksheet_key
+
+logger = logging.getLogger(__name__)
+
+
+class RowCursor:
+    """Курсор следующей свободной строки одного листа"""
+
+    def __init__(self, date_column=1):
+        self.date_column = date_column
+        self.free_rows = deque()  # Пустые строки внутри заполненной области
+        self.next_row = None  # Первая строка после последней заполненной
+        self.loaded_at = None
+
+    def load(self, worksheet):
+        """Читает столбец с датой и заново строит курсор"""
+        data = worksheet.col_values(self.date_column)
+        self.free_rows = deque(index + 1 for index, value in enumerate(data) if value == '')
+        self.next_row = len(data) + 1
+        self.loaded_at = time.monotonic()
+        logger.info(
+            f"🔄 Курсор листа '{worksheet.title}': следующая строка {self.next_row}, "
+            f"пропусков {len(self.free_rows)}"
+        )
+
+    def peek(self, count):
+        """Возвращает count ближайших свободных строк, не сдвигая курсор"""
+        rows = [self.free_rows[i] for i in range(min(count, len(self.free_rows)))]
+        rows += range(self.next_row, self.next_row + count - len(rows))
+        return rows
+
+    def advance(self, row_numbers):
+        """Помечает строки занятыми после успешной записи"""
+        for row_number in sorted(row_numbers):
+            if self.free_rows and self.free_rows[0] == row_number:
+                self.free_rows.popleft()
+            elif row_number >= self.next_row:
+                self.next_row = row_number + 1
+            else:
+                # Строка не из начала списка пропусков — редкий случай
+                try:
+                    self.free_rows.remove(row_number)
+                except ValueError:
+                    pass
+
+
+class RowCursorRegistry:
+    """Курсоры всех листов, с которыми работает бот"""
+
+    def __init__(self, date_column=1, resync_interval=300):
+        self.date_column = date_column
+        self.resync_interval = resync_interval
+        self._cursors = {}
+        self._lock = threading.Lock()
+
+    def _cursor(self, worksheet):
+        key = worksheet_key(worksheet)
+        cursor = self._cursors.get(key)
+        if cursor is None:
+            cursor = self._cursors[key] = RowCursor(self.date_column)
+        if cursor.loaded_at is None or time.monotonic() - cursor.loaded_at >= self.resync_interval:
+            cursor.load(worksheet)
+        return cursor
+
+    def peek(self, worksheet, count):
+        """Номера count свободных строк листа (совместимо с row_allocator очереди)"""
+        with self._lock:
+            return self._cursor(worksheet).peek(count)
+
+    def advance(self, worksheet, row_numbers):
+        with self._lock:
+            cursor = self._cursors.get(worksheet_key(worksheet))
+            if cursor is not None and cursor.loaded_at is not None:
+                cursor.advance(row_numbers)
+
+    def invalidate(self, worksheet):
+        """Принудительно перечитать лист при следующем обращении"""
+        with self._lock:
+            cursor = self._cursors.get(worksheet_key(worksheet))
+            if cursor is not None:
+                cursor.loaded_at = None
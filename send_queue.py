@@ -0,0 +1,202 @@
+"""
+Очередь исходящих сообщений Telegram с учётом flood-лимитов
+
+Все ответы бота ставятся в очередь своего чата и отправляются фоновыми
+потоками, поэтому обработка входящих сообщений никогда не ждёт Telegram.
+Порядок ответов внутри чата сохраняется. Соблюдаются общий лимит бота
+(~30 сообщений/с), лимит группы (~20 сообщений/мин) и лимит личного чата
+(~1 сообщение/с). Ответ 429 с retry_after приостанавливает только свой
+чат, сообщение остаётся в начале его очереди и будет отправлено позже.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from http import HTTPStatus
+
+logger = logging.getLogger(__name__)
+
+
+class RateWindow:
+    """Неблокирующий token bucket: rate токенов в секунду, запас burst"""
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Сколько секунд ждать до следующего токена (0 — можно сейчас)"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class ChatQueue:
+    """Очередь одного чата: сообщения, лимит и пауза после 429"""
+
+    def __init__(self, window):
+        self.items = deque()
+        self.window = window
+        self.blocked_until = 0.0
+        self.busy = False  # Сообщение чата сейчас отправляется — следующее ждёт
+
+
+def flood_wait(error):
+    """retry_after из ответа 429 или None"""
+    if getattr(error, 'error_code', None) != HTTPStatus.TOO_MANY_REQUESTS:
+        return None
+    parameters = (getattr(error, 'result_json', None) or {}).get('parameters') or {}
+    return float(parameters.get('retry_after', 1))
+
+
+def is_permanent(error):
+    """Ошибки, при которых повтор бессмыслен (бота удалили из чата, сообщение неверно)"""
+    code = getattr(error, 'error_code', None)
+    return code is not None and code != HTTPStatus.TOO_MANY_REQUESTS and code < HTTPStatus.INTERNAL_SERVER_ERROR
+
+
+class SendQueue:
+    """Очередь ответов по чатам.
+
+    send(message, text) — синхронная отправка (например, bot.reply_to);
+    reply(message, text) — совместим с reply в process_message и не блокирует.
+    """
+
+    def __init__(self, send, global_per_second=30, group_per_minute=20, private_per_second=1,
+                 workers=4, max_backoff=60.0, clock=time.monotonic, metrics=None):
+        self.send = send
+        self.group_per_minute = group_per_minute
+        self.private_per_second = private_per_second
+        self.workers = workers
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.metrics = metrics  # MetricsRegistry: время отправки попадает в этап telegram_reply
+        self._global = RateWindow(global_per_second, global_per_second, clock())
+        self._chats = OrderedDict()  # Порядок — очередь обхода чатов по кругу
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._threads = []
+        self.counters = {'queued': 0, 'sent': 0, 'flood_waits': 0, 'retries': 0, 'failed': 0}
+
+    def _window(self, chat_id, now):
+        if chat_id < 0:  # Группы и каналы
+            return RateWindow(self.group_per_minute / 60.0, 3, now)
+        return RateWindow(self.private_per_second, 1, now)
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'telegram-send-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def reply(self, message, text):
+        """Ставит ответ в очередь чата и сразу возвращает управление"""
+        chat_id = message.chat.id
+        with self._cond:
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = self._chats[chat_id] = ChatQueue(self._window(chat_id, self.clock()))
+            chat.items.append([message, text, 0])
+            self.counters['queued'] += 1
+            self._cond.notify()
+
+    def pending_count(self):
+        with self._cond:
+            return sum(len(chat.items) for chat in self._chats.values())
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self.counters)
+            stats['pending'] = sum(len(chat.items) for chat in self._chats.values())
+            stats['chats'] = len(self._chats)
+        return stats
+
+    def _take(self):
+        """Следующее сообщение, которое можно отправить, или None при остановке"""
+        with self._cond:
+            while True:
+                now = self.clock()
+                delay = None
+                for chat_id, chat in list(self._chats.items()):
+                    if chat.busy:
+                        continue
+                    chat_delay = max(chat.blocked_until - now, chat.window.wait_time(now))
+                    if not chat.items:
+                        if chat_delay <= 0 and chat.window.tokens >= chat.window.burst:
+                            del self._chats[chat_id]  # Лимит чата восстановился — состояние не нужно
+                        continue
+                    if chat_delay <= 0:
+                        global_delay = self._global.wait_time(now)
+                        if global_delay > 0:
+                            delay = global_delay
+                            break
+                        self._global.take()
+                        chat.window.take()
+                        chat.busy = True
+                        self._chats.move_to_end(chat_id)
+                        return chat_id, chat, chat.items[0]
+                    delay = chat_delay if delay is None else min(delay, chat_delay)
+                if self._stopping and not any(chat.items for chat in self._chats.values()):
+                    return None
+                self._cond.wait(delay)
+
+    def _run(self):
+        while True:
+            taken = self._take()
+            if taken is None:
+                return
+            chat_id, chat, item = taken
+            message, text, attempts = item
+            started = time.perf_counter()
+            try:
+                self.send(message, text)
+            except Exception as e:
+                self._on_error(chat_id, chat, item, e)
+            else:
+                if self.metrics is not None:
+                    self.metrics.observe('telegram_reply', time.perf_counter() - started)
+                with self._cond:
+                    chat.items.popleft()
+                    chat.busy = False
+                    self.counters['sent'] += 1
+                    self._cond.notify_all()
+
+    def _on_error(self, chat_id, chat, item, error):
+        with self._cond:
+            chat.busy = False
+            retry_after = flood_wait(error)
+            if retry_after is not None:
+                chat.blocked_until = self.clock() + retry_after
+                self.counters['flood_waits'] += 1
+                logger.warning(f"🐢 Telegram 429 для чата {chat_id}: пауза {retry_after:.0f} с, в очереди {len(chat.items)}")
+            elif is_permanent(error):
+                chat.items.popleft()
+                self.counters['failed'] += 1
+                logger.error(f"❌ Ответ в чат {chat_id} не доставлен: {error}")
+            else:
+                # Сетевая ошибка или 5xx — повторяем с растущей паузой, сообщение не теряется
+                item[2] += 1
+                backoff = min(self.max_backoff, 2 ** item[2])
+                chat.blocked_until = self.clock() + backoff
+                self.counters['retries'] += 1
+                logger.warning(f"⏳ Ошибка отправки в чат {chat_id}, повтор через {backoff:.0f} с: {error}")
+            self._cond.notify_all()
+
+    def stop(self, timeout=None):
+        """Отправляет оставшиеся ответы и останавливает потоки"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+        left = self.pending_count()
+        if left:
+            logger.warning(f"⚠️ При остановке не отправлено ответов: {left}")
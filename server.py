@@ -1,8 +1,21 @@
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from socketserver import UnixStreamServer
+import hmac
+import logging
 import os
 
+logger = logging.getLogger(__name__)
+
+# Webhook Telegram: включается, если задан WEBHOOK_PATH
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH')  # Например /telegram/webhook
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')  # secret_token из setWebhook
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')  # Публичный URL для регистрации в Telegram
+WEBHOOK_MAX_BODY = 1024 * 1024
+
 class RequestHandler(BaseHTTPRequestHandler):
+    # process_updates(list[Update]) — конвейер бота, задаётся в setup_webhook
+    process_updates = None
+
     def _set_headers(self):
         self.send_response(200)
         self.send_header("Content-type", "text/html")
@@ -13,10 +26,45 @@ class RequestHandler(BaseHTTPRequestHandler):
             index = f.read()
         return index.encode()
 
+    def _reply(self, code, body=b''):
+        self.send_response(code)
+        self.send_header("Content-type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
     def do_GET(self):
         self._set_headers()
         self.wfile.write(self._index())
 
+    def do_POST(self):
+        if self.process_updates is None or self.path != WEBHOOK_PATH:
+            self._reply(404)
+            return
+
+        token = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+            self._reply(403)
+            return
+
+        length = int(self.headers.get('Content-Length') or 0)
+        if length <= 0 or length > WEBHOOK_MAX_BODY:
+            self._reply(400)
+            return
+
+        from telebot.types import Update
+        try:
+            update = Update.de_json(self.rfile.read(length).decode('utf8'))
+        except Exception as e:
+            # Не JSON или JSON, который не является Update (KeyError/TypeError в de_json)
+            logger.warning(f"⚠️ Webhook: некорректный апдейт отклонён: {e!r}")
+            self._reply(400)
+            return
+
+        # Обработчики бота только ставят работу в очередь, поэтому ответ Telegram уходит сразу
+        self.process_updates([update])
+        self._reply(200, b'ok')
+
 
 class UnixSocketHTTPServer(UnixStreamServer):
     def get_request(self):
@@ -24,11 +72,36 @@ class UnixSocketHTTPServer(UnixStreamServer):
         return (request, ["local", 0])
 
 
+def setup_webhook():
+    """Подключает конвейер бота к POST-запросам на WEBHOOK_PATH"""
+    if not WEBHOOK_PATH:
+        return None
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET не задан: webhook без проверки токена не включается")
+    import bot
+
+    RequestHandler.process_updates = staticmethod(bot.bot.process_new_updates)
+    bot.start_services()
+    if WEBHOOK_URL:
+        bot.enable_webhook(WEBHOOK_URL, WEBHOOK_SECRET)
+    print(f"Webhook: POST {WEBHOOK_PATH}")
+    return bot
+
+
+def serve(server):
+    bot = setup_webhook()
+    try:
+        server.serve_forever()
+    finally:
+        if bot is not None:
+            bot.stop_services()
+
+
 def run_on_port():
     server_address = (os.environ.get('INSTANCE_HOST'), int(os.environ.get('PORT')))
     server = HTTPServer(server_address, RequestHandler)
     print(f"Listening http://{server_address[0]}:{server_address[1]}/")
-    server.serve_forever()
+    serve(server)
 
 def run_on_socket():
     socket = os.environ.get('SOCKET')
@@ -37,10 +110,11 @@ def run_on_socket():
     server = UnixSocketHTTPServer(socket, RequestHandler)
     os.chmod(socket, 0o660)
     print(f"Listening {socket}")
-    server.serve_forever()
+    serve(server)
 
 
-if 'SOCKET' in os.environ:
-    run_on_socket()
-else:
-    run_on_port()
+if __name__ == '__main__':
+    if 'SOCKET' in os.environ:
+        run_on_socket()
+    else:
+        run_on_port()
@@ -0,0 +1,150 @@
+"""
+Распределение чатов (или проектов) по нескольким таблицам-шардам
+
+Одна таблица — это одна квота Google Sheets и один предел размера. Карта
+шардов (файл SHARDS_FILE) направляет счета чата или проекта в свою
+таблицу; листы в таблицах-шардах называются так же, как в основной.
+
+Формат файла::
+
+    {
+        "key": "project",
+        "shards": {
+            "main": {"spreadsheet_id": "..."},
+            "2025": {"spreadsheet_id": "...", "credentials": "keys-2025.json"},
+            "archive": {"spreadsheet_id": "...", "open": false}
+        },
+        "chats": {"-1001234567890": "main"},
+        "projects": {"Объект2": "archive"}
+    }
+
+``key`` — по чему шардировать новые счета: ``chat`` или ``project``.
+Явные назначения из ``chats``/``projects`` главнее. Новый чат или проект
+закрепляется за наименее занятым открытым шардом, и закрепление пишется в
+``state_path``. Поэтому добавленный шард получает только новые ключи, а
+старые данные никуда не переезжают. Шард с ``"open": false`` новых ключей
+не получает.
+"""
+
+import json
+import logging
+import os
+import threading
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+Shard = namedtuple('Shard', ['name', 'spreadsheet_id', 'credentials', 'open'])
+# Своя очередь записи и свои курсоры строк у каждой таблицы: шарды пишутся параллельно
+ShardWriter = namedtuple('ShardWriter', ['row_cursors', 'write_queue'])
+
+SHARD_KEYS = ('chat', 'project')
+
+
+class ShardMapError(Exception):
+    """Некорректный файл шардов"""
+
+
+def normalize_project(project):
+    """'  Объект  2 ' и 'объект 2' — один проект"""
+    return ' '.join(str(project).split()).casefold()
+
+
+def build_shards(config, default_credentials):
+    shards = {}
+    for name, shard_config in config.get('shards', {}).items():
+        if 'spreadsheet_id' not in shard_config:
+            raise ShardMapError(f"Шард '{name}': не указан spreadsheet_id")
+        shards[name] = Shard(
+            name=name,
+            spreadsheet_id=shard_config['spreadsheet_id'],
+            credentials=shard_config.get('credentials', default_credentials),
+            open=bool(shard_config.get('open', True))
+        )
+    return shards
+
+
+class ShardMap:
+    """Ключ (чат или проект) -> таблица; закрепления ключей не меняются"""
+
+    def __init__(self, path, state_path, default_credentials):
+        self.path = path
+        self.state_path = state_path
+        self.default_credentials = default_credentials
+        self.key = 'chat'
+        self.shards = {}
+        self.fixed = {}  # ('chat' | 'project', ключ) -> шард из файла
+        self.assigned = {}  # Автоматические закрепления из state_path
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.shards)
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return self
+        with open(self.path, 'r', encoding='utf8') as f:
+            config = json.load(f)
+        key = config.get('key', 'chat')
+        if key not in SHARD_KEYS:
+            raise ShardMapError(f"Неизвестный ключ шардирования '{key}'")
+        shards = build_shards(config, self.default_credentials)
+        fixed = {('chat', str(int(chat_id))): shard for chat_id, shard in config.get('chats', {}).items()}
+        fixed.update(
+            {('project', normalize_project(project)): shard for project, shard in config.get('projects', {}).items()}
+        )
+        unknown = sorted({shard for shard in fixed.values() if shard not in shards})
+        if unknown:
+            raise ShardMapError(f"Неизвестные шарды: {', '.join(unknown)}")
+        if not any(shard.open for shard in shards.values()):
+            raise ShardMapError("Нет ни одного открытого шарда для новых ключей")
+
+        assigned = {}
+        if self.state_path and os.path.exists(self.state_path):
+            with open(self.state_path, 'r', encoding='utf8') as f:
+                assigned = {(kind, value): shard for kind, value, shard in json.load(f)}
+        self.key, self.shards, self.fixed, self.assigned = key, shards, fixed, assigned
+        logger.info(f"🗂️ Карта шардов: {len(shards)} таблиц, ключ '{key}', закреплено {len(assigned)}")
+        return self
+
+    def _save_state(self):
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump([[kind, value, shard] for (kind, value), shard in sorted(self.assigned.items())],
+                      f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.state_path)
+
+    def _assign(self, key):
+        with self._lock:
+            shard = self.assigned.get(key)
+            if shard in self.shards:
+                return shard
+            load = {name: 0 for name, shard in self.shards.items() if shard.open}
+            for name in self.assigned.values():
+                if name in load:
+                    load[name] += 1
+            shard = min(sorted(load), key=load.get)
+            self.assigned[key] = shard
+            if self.state_path:
+                self._save_state()
+        logger.info(f"🗂️ {key[0]} '{key[1]}' закреплён за шардом '{shard}'")
+        return shard
+
+    def shard_for(self, chat_id, project=None):
+        """Шард счёта или None, если шарды не настроены"""
+        if not self.shards:
+            return None
+        chat_key = ('chat', str(chat_id))
+        project_key = ('project', normalize_project(project)) if project else None
+        for key in (chat_key, project_key):
+            if key is not None and key in self.fixed:
+                return self.shards[self.fixed[key]]
+        key = project_key if self.key == 'project' and project_key is not None else chat_key
+        return self.shards[self._assign(key)]
+
+    def credentials_for(self, spreadsheet_id):
+        for shard in self.shards.values():
+            if shard.spreadsheet_id == spreadsheet_id:
+                return shard.credentials
+        return self.default_credentials
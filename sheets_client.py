@@ -0,0 +1,190 @@
+"""
+Общая фабрика клиентов Google Sheets
+
+bot.py, проверка конфигурации в monitor.py и check_sheets.py раньше
+каждый раз вызывали gspread.service_account: новый обмен токена OAuth,
+новое TLS-соединение и повторное открытие таблицы. Фабрика держит на
+процесс один клиент gspread поверх сессии requests с пулом keep-alive
+соединений, обновляет токен заранее (за refresh_margin секунд до
+истечения, в том числе фоновым потоком) и кэширует объекты таблиц с
+метаданными на metadata_ttl секунд.
+"""
+
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+import gspread
+import requests
+from google.auth.transport.requests import AuthorizedSession, Request
+from google.oauth2.service_account import Credentials
+from gspread.http_client import HTTPClient
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+SCOPES = [
+    'https://www.googleapis.com/auth/spreadsheets',
+    'https://www.googleapis.com/auth/drive'
+]
+
+
+def utcnow():
+    # google-auth хранит expiry как наивное время UTC
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class SheetsClientFactory:
+    """Один клиент gspread на процесс: пул соединений, токен и метаданные таблиц"""
+
+    def __init__(self, credentials_file, scopes=SCOPES, http_client=HTTPClient, pool_size=10,
+                 refresh_margin=300, metadata_ttl=600, credentials=None, clock=time.monotonic, now=utcnow):
+        self.credentials_file = credentials_file
+        self.scopes = scopes
+        self.http_client = http_client
+        self.pool_size = pool_size
+        self.refresh_margin = refresh_margin
+        self.metadata_ttl = metadata_ttl
+        self.clock = clock
+        self.now = now
+        self.token_refreshes = 0
+        self.metadata_hits = 0
+        self.metadata_misses = 0
+        self._credentials = credentials
+        self._session = None
+        self._token_session = None
+        self._client = None
+        self._spreadsheets = {}  # spreadsheet_id -> (Spreadsheet, время загрузки)
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._refresher = None
+
+    def credentials(self):
+        with self._lock:
+            if self._credentials is None:
+                self._credentials = Credentials.from_service_account_file(self.credentials_file, scopes=self.scopes)
+            return self._credentials
+
+    def _mount_pool(self, session):
+        session.mount('https://', HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size))
+        return session
+
+    def session(self):
+        """AuthorizedSession с пулом соединений к googleapis.com"""
+        with self._lock:
+            if self._session is None:
+                self._session = self._mount_pool(AuthorizedSession(self.credentials()))
+            return self._session
+
+    def token_session(self):
+        """Обычная сессия для обмена токена (keep-alive к oauth2.googleapis.com).
+
+        AuthorizedSession перед запросом сама обновила бы токен, и обмен шёл бы дважды.
+        """
+        with self._lock:
+            if self._token_session is None:
+                self._token_session = self._mount_pool(requests.Session())
+            return self._token_session
+
+    def token_expires_in(self):
+        """Секунд до истечения токена; None — токена ещё нет"""
+        credentials = self.credentials()
+        if not credentials.token or credentials.expiry is None:
+            return None
+        return (credentials.expiry - self.now()).total_seconds()
+
+    def ensure_token(self):
+        """Обновляет токен, если его нет или он истекает в ближайшие refresh_margin секунд"""
+        with self._lock:
+            expires_in = self.token_expires_in()
+            if expires_in is not None and expires_in > self.refresh_margin:
+                return False
+            self.credentials().refresh(Request(self.token_session()))
+            self.token_refreshes += 1
+            logger.debug(f"🔑 Токен Google обновлён, действует до {self.credentials().expiry}")
+            return True
+
+    def client(self):
+        """Общий клиент gspread с действующим токеном"""
+        with self._lock:
+            if self._client is None:
+                self._client = gspread.Client(
+                    auth=self.credentials(), session=self.session(), http_client=self.http_client
+                )
+            self.ensure_token()
+            return self._client
+
+    def spreadsheet(self, spreadsheet_id):
+        """Таблица с метаданными (название, листы) из кэша; open_by_key — раз в metadata_ttl"""
+        now = self.clock()
+        with self._lock:
+            cached = self._spreadsheets.get(spreadsheet_id)
+            if cached is not None and now - cached[1] < self.metadata_ttl:
+                self.metadata_hits += 1
+                return cached[0]
+        spreadsheet = self.client().open_by_key(spreadsheet_id)
+        with self._lock:
+            self.metadata_misses += 1
+            self._spreadsheets[spreadsheet_id] = (spreadsheet, now)
+        return spreadsheet
+
+    def invalidate(self, spreadsheet_id=None):
+        with self._lock:
+            if spreadsheet_id is None:
+                self._spreadsheets.clear()
+            else:
+                self._spreadsheets.pop(spreadsheet_id, None)
+
+    def start_refresher(self, retry_interval=30):
+        """Фоновое обновление токена: запросы не ждут обмена токена на истечении"""
+        with self._lock:
+            if self._refresher is None:
+                self._refresher = threading.Thread(
+                    target=self._refresh_loop, args=(retry_interval,), name='sheets-token', daemon=True
+                )
+                self._refresher.start()
+        return self
+
+    def _refresh_loop(self, retry_interval):
+        while True:
+            try:
+                self.ensure_token()
+                delay = max(self.token_expires_in() - self.refresh_margin, retry_interval)
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось обновить токен Google, повтор через {retry_interval} с: {e}")
+                delay = retry_interval
+            if self._stop.wait(delay):
+                return
+
+    def stats(self):
+        expires_in = self.token_expires_in() if self._credentials is not None else None
+        return {
+            'token_refreshes': self.token_refreshes,
+            'token_expires_in': None if expires_in is None else round(expires_in),
+            'metadata_hits': self.metadata_hits,
+            'metadata_misses': self.metadata_misses
+        }
+
+    def close(self):
+        self._stop.set()
+        with self._lock:
+            for session in (self._session, self._token_session):
+                if session is not None:
+                    session.close()
+
+
+_factories = {}
+_factories_lock = threading.Lock()
+
+
+def shared_factory(credentials_file, scopes=SCOPES, http_client=HTTPClient, **options):
+    """Фабрика, общая для всех вызовов процесса с теми же ключами и HTTP-клиентом"""
+    key = (credentials_file, tuple(scopes), http_client)
+    with _factories_lock:
+        factory = _factories.get(key)
+        if factory is None:
+            factory = _factories[key] = SheetsClientFactory(
+                credentials_file, scopes=scopes, http_client=http_client, **options
+            )
+        return factory
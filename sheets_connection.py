@@ -0,0 +1,93 @@
+"""
+Ленивое подключение к Google Sheets с прогревом в фоне
+
+Авторизация service account и открытие таблицы — это обмен токена и
+несколько запросов к API. Раньше они выполнялись при импорте bot.py, и
+запуск (а также импорт модуля в тестах и утилитах) ждал сеть. Теперь
+клиент создаётся в фоновом потоке после start(): бот сразу начинает
+polling, а первые сообщения ждут в client(), пока прогрев не закончится.
+Если подключиться не удалось, поток повторяет попытки с паузой.
+"""
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class SheetsNotReady(ConnectionError):
+    """Подключение к Google Sheets ещё не установлено"""
+
+
+class LazySheetsConnection:
+    """Клиент gspread, который создаётся и прогревается в фоновом потоке"""
+
+    def __init__(self, connect, warm_up=None, retry_interval=10.0, clock=time.monotonic):
+        # connect() -> gspread.Client; warm_up(client) — открыть таблицы, листы, курсоры
+        self.connect = connect
+        self.warm_up = warm_up
+        self.retry_interval = retry_interval
+        self.clock = clock
+        self.started_at = None
+        self.warmed_in = None  # Сколько секунд занял прогрев
+        self.last_error = None
+        self._client = None
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self.started_at = self.clock()
+                self._thread = threading.Thread(target=self._run, name='sheets-warmup', daemon=True)
+                self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                client = self.connect()
+            except Exception as e:
+                self.last_error = e
+                logger.error(f"❌ Не удалось подключиться к Google Sheets, повтор через {self.retry_interval} с: {e}")
+                self._stop.wait(self.retry_interval)
+                continue
+            self._client = client
+            if self.warm_up is not None:
+                try:
+                    self.warm_up(client)
+                except Exception as e:
+                    # Клиент есть — листы и курсоры догрузятся при первом обращении
+                    logger.warning(f"⚠️ Прогрев Google Sheets выполнен не полностью: {e}")
+            self.warmed_in = self.clock() - self.started_at
+            self._ready.set()
+            logger.info(f"🔥 Google Sheets подключён за {self.warmed_in:.2f} с")
+            return
+
+    def wait_ready(self, timeout=None):
+        """Ждёт окончания прогрева; False — не успели за timeout"""
+        self.start()
+        return self._ready.wait(timeout)
+
+    def client(self, timeout=None):
+        """Клиент gspread; до окончания прогрева вызов ждёт не дольше timeout"""
+        if not self.wait_ready(timeout):
+            raise SheetsNotReady(f"Google Sheets не подключён за {timeout} с: {self.last_error or 'идёт прогрев'}")
+        return self._client
+
+    def status(self):
+        return {
+            'ready': self.ready,
+            'warmed_in': self.warmed_in,
+            'last_error': str(self.last_error) if self.last_error else None
+        }
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,224 @@
+"""
+Хранилища строк реестра: Google Sheets, локальная SQLite и CSV-файл
+
+У всех хранилищ один интерфейс: append_batch (добавить строки и получить
+их номера), lookup_row и update_row. Какое хранилище использует лист,
+задаётся для роли в файле маршрутов ("sink": "sheets" | "sqlite" | "csv").
+Локальные хранилища не ходят в сеть: их можно использовать для чатов с
+большим потоком счетов (с отдельной выгрузкой в таблицу) и в тестах.
+"""
+
+import csv
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import Future
+
+from gspread.utils import ValueInputOption
+
+from write_queue import row_range
+
+SINK_SHEETS = 'sheets'
+SINK_SQLITE = 'sqlite'
+SINK_CSV = 'csv'
+SINK_KINDS = (SINK_SHEETS, SINK_SQLITE, SINK_CSV)
+
+
+class SinkError(Exception):
+    """Операция не поддерживается хранилищем"""
+
+
+class StorageSink(ABC):
+    """Общий интерфейс хранилища строк"""
+
+    kind = None
+    remote = False  # True — хранилище зависит от Google Sheets (и выключателя)
+
+    def submit(self, row, tag=None):
+        """Записывает строку; Future вернёт её номер. tag нужен только очереди записи Sheets"""
+        future = Future()
+        try:
+            future.set_result(self.append_batch([row])[0])
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    @abstractmethod
+    def append_batch(self, rows):
+        """Добавляет строки и возвращает их номера"""
+
+    @abstractmethod
+    def lookup_row(self, row_number):
+        """Строка по номеру или None"""
+
+    @abstractmethod
+    def update_row(self, row_number, row):
+        """Заменяет строку; SinkError, если хранилище этого не умеет"""
+
+    def location(self):
+        """(spreadsheet_id, sheet_id) для ссылок на строку; None — ссылок нет"""
+        return None, None
+
+    def close(self):
+        pass
+
+
+class SheetsSink(StorageSink):
+    """Лист Google Sheets; добавление идёт пачками через WriteBehindQueue"""
+
+    kind = SINK_SHEETS
+    remote = True
+
+    def __init__(self, resolve_worksheet, write_queue):
+        # resolve_worksheet() -> актуальный gspread.Worksheet (из кэша листов)
+        self.resolve_worksheet = resolve_worksheet
+        self.write_queue = write_queue
+
+    def submit(self, row, tag=None):
+        return self.write_queue.submit(self.resolve_worksheet(), row, tag)
+
+    def append_batch(self, rows):
+        futures = [self.submit(row) for row in rows]
+        return [future.result() for future in futures]
+
+    def lookup_row(self, row_number):
+        return self.resolve_worksheet().row_values(row_number) or None
+
+    def update_row(self, row_number, row):
+        self.resolve_worksheet().update(
+            [row], row_range(row_number, len(row)), value_input_option=ValueInputOption.user_entered
+        )
+
+    def location(self):
+        worksheet = self.resolve_worksheet()
+        return worksheet.spreadsheet_id, worksheet.id
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS registry_rows (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    spreadsheet_id TEXT NOT NULL DEFAULT '',
+    sheet TEXT NOT NULL,
+    row_json TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL
+);
+"""
+# Строки из баз до появления столбца spreadsheet_id остаются с пустым значением
+SQLITE_MIGRATIONS = {
+    'spreadsheet_id': "ALTER TABLE registry_rows ADD COLUMN spreadsheet_id TEXT NOT NULL DEFAULT ''"
+}
+SQLITE_INDEX = "CREATE INDEX IF NOT EXISTS registry_rows_location ON registry_rows (spreadsheet_id, sheet, id)"
+
+
+def file_safe(name):
+    return "".join(c if c.isalnum() or c in ' -_' else '_' for c in name)
+
+
+class SQLiteSink(StorageSink):
+    """Локальная SQLite; номер строки — id записи, лист — пара (spreadsheet_id, sheet_name)"""
+
+    kind = SINK_SQLITE
+
+    def __init__(self, path, spreadsheet_id, sheet_name):
+        self.path = path
+        # Таблицы-шарды с одноимёнными листами не должны писать в один и тот же лист
+        self.spreadsheet_id = spreadsheet_id
+        self.sheet_name = sheet_name
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # Счёт уже сохранён в журнале с fsync, здесь достаточно NORMAL
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SQLITE_SCHEMA)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(registry_rows)")}
+        for column, statement in SQLITE_MIGRATIONS.items():
+            if column not in columns:
+                self._conn.execute(statement)
+        self._conn.execute(SQLITE_INDEX)
+
+    def append_batch(self, rows):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                row_numbers = [
+                    self._conn.execute(
+                        "INSERT INTO registry_rows (spreadsheet_id, sheet, row_json, created_at) VALUES (?, ?, ?, ?)",
+                        (self.spreadsheet_id, self.sheet_name, json.dumps(row, ensure_ascii=False), now)
+                    ).lastrowid
+                    for row in rows
+                ]
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+        return row_numbers
+
+    def lookup_row(self, row_number):
+        with self._lock:
+            found = self._conn.execute(
+                "SELECT row_json FROM registry_rows WHERE id = ? AND spreadsheet_id = ? AND sheet = ?",
+                (row_number, self.spreadsheet_id, self.sheet_name)
+            ).fetchone()
+        return json.loads(found[0]) if found else None
+
+    def update_row(self, row_number, row):
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE registry_rows SET row_json = ?, updated_at = ? WHERE id = ? AND spreadsheet_id = ? AND sheet = ?",
+                (json.dumps(row, ensure_ascii=False), time.time(), row_number, self.spreadsheet_id, self.sheet_name)
+            )
+        if not cursor.rowcount:
+            raise SinkError(f"Строка {row_number} не найдена в '{self.sheet_name}'")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class CSVSink(StorageSink):
+    """CSV-файл только для добавления; номер строки — номер записи в файле"""
+
+    kind = SINK_CSV
+
+    @classmethod
+    def for_sheet(cls, directory, spreadsheet_id, sheet_name):
+        """Файл <directory>/<spreadsheet_id>/<лист>.csv: своя нумерация у листа каждой таблицы"""
+        sheet_dir = os.path.join(directory, file_safe(spreadsheet_id))
+        os.makedirs(sheet_dir, exist_ok=True)
+        return cls(os.path.join(sheet_dir, f"{file_safe(sheet_name)}.csv"))
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._count = 0
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf8', newline='') as f:
+                self._count = sum(1 for _ in csv.reader(f))
+
+    def append_batch(self, rows):
+        with self._lock:
+            with open(self.path, 'a', encoding='utf8', newline='') as f:
+                csv.writer(f).writerows(rows)
+                f.flush()
+                os.fsync(f.fileno())
+            first = self._count + 1
+            self._count += len(rows)
+        return list(range(first, first + len(rows)))
+
+    def lookup_row(self, row_number):
+        with self._lock:
+            if not os.path.exists(self.path):
+                return None
+            with open(self.path, 'r', encoding='utf8', newline='') as f:
+                for number, row in enumerate(csv.reader(f), start=1):
+                    if number == row_number:
+                        return row
+        return None
+
+    def update_row(self, row_number, row):
+        raise SinkError("CSV-хранилище только для добавления строк")
@@ -0,0 +1,209 @@
+"""
+Канал статистики от бота к monitor.py через UNIX datagram сокет
+
+Бот раз в ``interval`` секунд (и сразу при важных событиях) отправляет
+JSON-снимок счётчиков, очередей и последних событий одной датаграммой.
+Отправка неблокирующая: если монитор не запущен или не успевает читать,
+снимок просто теряется, следующий его заменит. Монитор держит последний
+снимок и по истории за окно считает пропускную способность и долю ошибок
+без разбора логов и stdout бота.
+"""
+
+import json
+import logging
+import os
+import socket
+import stat
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+MAX_DATAGRAM = 64 * 1024
+OUTCOMES = ('processed', 'rejected', 'journaled', 'failed')
+
+
+class StatsPublisher:
+    """Сторона бота: снимок snapshot() плюс последние события"""
+
+    def __init__(self, path, snapshot, interval=1.0, max_events=20, clock=time.time):
+        self.path = path
+        self.snapshot = snapshot
+        self.interval = interval
+        self.clock = clock
+        self.started_at = clock()
+        self.last_activity = None
+        self.events = deque(maxlen=max_events)
+        self.sent = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._sock = None
+        if hasattr(socket, 'AF_UNIX'):
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._sock.setblocking(False)
+
+    def record(self, outcome, detail=None):
+        """Отмечает обработанное сообщение; всё, кроме успеха, попадает в события"""
+        now = self.clock()
+        with self._lock:
+            self.last_activity = now
+            if outcome != 'processed':
+                self.events.append({'ts': now, 'kind': outcome, 'text': detail or ''})
+
+    def event(self, kind, text):
+        with self._lock:
+            self.events.append({'ts': self.clock(), 'kind': kind, 'text': text})
+        self.publish()
+
+    def payload(self):
+        with self._lock:
+            extra = {
+                'pid': os.getpid(),
+                'started_at': self.started_at,
+                'sent_at': self.clock(),
+                'last_activity': self.last_activity,
+                'events': list(self.events)
+            }
+        data = dict(self.snapshot())
+        data.update(extra)
+        encoded = json.dumps(data, ensure_ascii=False, default=str).encode('utf8')
+        if len(encoded) > MAX_DATAGRAM:
+            data['events'] = data['events'][-3:]
+            encoded = json.dumps(data, ensure_ascii=False, default=str).encode('utf8')
+        return encoded
+
+    def publish(self):
+        """Отправляет снимок; никогда не блокирует и не бросает исключений"""
+        if self._sock is None:
+            return False
+        try:
+            self._sock.sendto(self.payload(), self.path)
+        except OSError as e:
+            # Нет монитора (ENOENT/ECONNREFUSED) или его буфер полон (EAGAIN) — не страшно
+            logger.debug(f"Снимок статистики не отправлен: {e}")
+            return False
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось собрать снимок статистики: {e}")
+            return False
+        self.sent += 1
+        return True
+
+    def start(self):
+        if self._sock is None:
+            logger.warning("⚠️ UNIX-сокеты недоступны, статистика для monitor.py не публикуется")
+        elif self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='stats-publisher', daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.publish()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(self.interval + 1)
+        self.publish()  # Последний снимок с итоговыми счётчиками
+        if self._sock is not None:
+            self._sock.close()
+
+
+class StatsReceiver:
+    """Сторона монитора: последний снимок и скорость за окно window секунд"""
+
+    def __init__(self, path, window=60.0, stale_after=10.0, clock=time.time):
+        self.path = path
+        self.window = window
+        self.stale_after = stale_after
+        self.clock = clock
+        self.latest = {}
+        self.received_at = None
+        self.received = 0
+        self._history = deque()  # (время, {outcome: счётчик})
+        self._lock = threading.Lock()
+        self._sock = None
+        self._thread = None
+
+    def start(self):
+        if not hasattr(socket, 'AF_UNIX'):
+            return self
+        try:
+            if stat.S_ISSOCK(os.stat(self.path).st_mode):
+                os.unlink(self.path)  # Сокет от прошлого запуска монитора
+        except FileNotFoundError:
+            pass
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(self.path)
+        self._sock.settimeout(1.0)
+        self._thread = threading.Thread(target=self._run, name='stats-receiver', daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while self._sock is not None:
+            try:
+                data = self._sock.recv(MAX_DATAGRAM)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            self.handle(data)
+
+    def handle(self, data):
+        try:
+            snapshot = json.loads(data.decode('utf8'))
+        except ValueError:
+            return
+        now = self.clock()
+        messages = snapshot.get('messages') or {}
+        with self._lock:
+            if self.latest.get('pid') != snapshot.get('pid'):
+                self._history.clear()  # Бот перезапущен — счётчики начались заново
+            self.latest = snapshot
+            self.received_at = now
+            self.received += 1
+            self._history.append((now, {outcome: messages.get(outcome, 0) for outcome in OUTCOMES}))
+            while len(self._history) > 2 and now - self._history[1][0] >= self.window:
+                self._history.popleft()
+
+    def summary(self):
+        """Данные для /api/status"""
+        with self._lock:
+            snapshot = dict(self.latest)
+            received_at = self.received_at
+            first = self._history[0] if self._history else None
+            last = self._history[-1] if self._history else None
+        messages = snapshot.get('messages') or {}
+        throughput = error_rate = 0.0
+        if first is not None and last[0] > first[0]:
+            delta = {outcome: last[1][outcome] - first[1][outcome] for outcome in OUTCOMES}
+            total = sum(delta.values())
+            throughput = round(total * 60.0 / (last[0] - first[0]), 2)
+            error_rate = round(delta['failed'] / total, 4) if total else 0.0
+        return {
+            'connected': received_at is not None and self.clock() - received_at < self.stale_after,
+            'messages_processed': messages.get('processed', 0),
+            'messages_rejected': messages.get('rejected', 0),
+            'messages_journaled': messages.get('journaled', 0),
+            'errors': messages.get('failed', 0),
+            'throughput_per_minute': throughput,
+            'error_rate': error_rate,
+            'last_activity': snapshot.get('last_activity'),
+            'sheets_breaker': snapshot.get('sheets_breaker'),
+            'sheets_connection': snapshot.get('sheets_connection'),
+            'sheets_limiter': snapshot.get('sheets_limiter'),
+            'queues': snapshot.get('queues'),
+            'events': snapshot.get('events', [])
+        }
+
+    def stop(self):
+        sock, self._sock = self._sock, None
+        if sock is not None:
+            sock.close()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
@@ -132,6 +132,1653 @@ class TestMessageParsing:
         amount_pattern = r"^\d+$"
         assert not re.match(amount_pattern, parts[6]), "Сумма должна быть неверной"
 
+class FakeWorksheet:
+    """Лист в памяти вместо gspread.Worksheet, считает обращения к API"""
+
+    def __init__(self, title='Тест', sheet_id=0, row_count=1000, dates=None):
+        self.title = title
+        self.id = sheet_id
+        self.spreadsheet_id = 'fake'
+        self.row_count = row_count
+        self.dates = list(dates or [])
+        self.rows = {}
+        self.calls = []
+
+    def col_values(self, col):
+        self.calls.append('col_values')
+        return list(self.dates)
+
+    def batch_update(self, data, **kwargs):
+        self.calls.append('batch_update')
+        for item in data:
+            row_number = int(item['range'].split(':')[0][1:])
+            self.rows[row_number] = item['values'][0]
+            while len(self.dates) < row_number:
+                self.dates.append('')
+            self.dates[row_number - 1] = item['values'][0][0]
+
+    def get(self, range_name):
+        self.calls.append('get')
+        first, last = (int(cell.lstrip('ABCDEFGHIJKLMNOPQRSTUVWXYZ')) for cell in range_name.split(':'))
+        rows = [self.rows.get(n, []) for n in range(first, last + 1)]
+        while rows and not rows[-1]:
+            rows.pop()
+        return rows
+
+    def add_rows(self, rows):
+        self.calls.append('add_rows')
+        self.row_count += rows
+
+
+class TestWriteBehindQueue:
+    """Тесты очереди пакетной записи"""
+
+    @staticmethod
+    def _allocator(worksheet, count):
+        data = worksheet.col_values(1)
+        rows = [i + 1 for i, value in enumerate(data) if value == '']
+        rows += range(len(data) + 1, len(data) + 1 + count)
+        return rows[:count]
+
+    def test_rows_grouped_per_worksheet(self):
+        """Строки одного листа записываются одним batch_update"""
+        from write_queue import WriteBehindQueue
+
+        admin = FakeWorksheet('Админ', sheet_id=1, dates=['Дата', '01.01.2025'])
+        snab = FakeWorksheet('Снаб', sheet_id=2, dates=['Дата'])
+        queue = WriteBehindQueue(self._allocator, flush_interval=10, max_batch_size=100)
+
+        futures = [queue.submit(admin, [f'0{i}.01.2025', 'x']) for i in range(1, 4)]
+        futures.append(queue.submit(snab, ['05.01.2025', 'y']))
+        queue.flush()
+
+        assert [f.result(timeout=1) for f in futures] == [3, 4, 5, 2]
+        assert admin.calls.count('batch_update') == 1
+        assert snab.calls.count('batch_update') == 1
+        assert admin.rows[4] == ['02.01.2025', 'x']
+
+    def test_background_flush_and_gap_reuse(self):
+        """Фоновый поток заполняет пустые строки в середине листа"""
+        from write_queue import WriteBehindQueue
+
+        sheet = FakeWorksheet(dates=['Дата', '', '01.01.2025'])
+        queue = WriteBehindQueue(self._allocator, flush_interval=0.01, max_batch_size=2).start()
+        first = queue.submit(sheet, ['02.01.2025'])
+        second = queue.submit(sheet, ['03.01.2025'])
+        assert (first.result(timeout=2), second.result(timeout=2)) == (2, 4)
+        queue.stop(timeout=2)
+
+    def test_no_free_row(self):
+        """Переполнение листа отдаётся в Future как NoFreeRowError"""
+        from write_queue import NoFreeRowError, WriteBehindQueue
+
+        sheet = FakeWorksheet(row_count=2, dates=['Дата', '01.01.2025'])
+        queue = WriteBehindQueue(self._allocator)
+        future = queue.submit(sheet, ['02.01.2025'])
+        queue.flush()
+        with pytest.raises(NoFreeRowError):
+            future.result(timeout=1)
+        assert 'batch_update' not in sheet.calls
+
+    def test_stop_does_not_race_background_flush(self):
+        """stop() с истёкшим таймаутом ждёт пачку фонового потока и не занимает её строки"""
+        import threading
+
+        from row_cursor import RowCursorRegistry
+        from write_queue import WriteBehindQueue
+
+        class SlowWorksheet(FakeWorksheet):
+            def batch_update(self, data, **kwargs):
+                writing.set()
+                release.wait(2)
+                super().batch_update(data, **kwargs)
+
+        writing, release = threading.Event(), threading.Event()
+        sheet = SlowWorksheet(dates=['Дата'])
+        cursors = RowCursorRegistry(resync_interval=3600)
+        queue = WriteBehindQueue(cursors.peek, flush_interval=0, on_commit=cursors.advance).start()
+        first = queue.submit(sheet, ['01.01.2025'])
+        assert writing.wait(2)
+        second = queue.submit(sheet, ['02.01.2025'])
+        threading.Timer(0.1, release.set).start()
+        queue.stop(timeout=0.01)
+
+        assert (first.result(timeout=2), second.result(timeout=2)) == (2, 3)
+        assert sheet.rows[2] == ['01.01.2025'] and sheet.rows[3] == ['02.01.2025']
+
+class TestRowCursor:
+    """Тесты курсора свободных строк"""
+
+    def test_column_loaded_once(self):
+        """Столбец с датой скачивается один раз, дальше курсор двигается в памяти"""
+        from row_cursor import RowCursorRegistry
+
+        sheet = FakeWorksheet(dates=['Дата', '01.01.2025', '', '02.01.2025'])
+        cursors = RowCursorRegistry(resync_interval=3600)
+
+        assert cursors.peek(sheet, 3) == [3, 5, 6]
+        cursors.advance(sheet, [3, 5])
+        assert cursors.peek(sheet, 1) == [6]
+        cursors.advance(sheet, [6])
+        assert cursors.peek(sheet, 2) == [7, 8]
+        assert sheet.calls.count('col_values') == 1
+
+    def test_resync_picks_up_manual_edits(self):
+        """После invalidate или истечения интервала лист перечитывается"""
+        from row_cursor import RowCursorRegistry
+
+        sheet = FakeWorksheet(dates=['Дата', '01.01.2025'])
+        cursors = RowCursorRegistry(resync_interval=3600)
+        assert cursors.peek(sheet, 1) == [3]
+
+        sheet.dates += ['03.01.2025', '04.01.2025']  # Бухгалтер дописал строки вручную
+        cursors.invalidate(sheet)
+        assert cursors.peek(sheet, 1) == [5]
+
+        cursors.resync_interval = 0
+        sheet.dates[1] = ''
+        assert cursors.peek(sheet, 1) == [2]
+        assert sheet.calls.count('col_values') == 3
+
+    def test_queue_advances_cursor(self):
+        """Очередь записи сдвигает курсор только после успешной пачки"""
+        from row_cursor import RowCursorRegistry
+        from write_queue import WriteBehindQueue
+
+        sheet = FakeWorksheet(dates=['Дата'])
+        cursors = RowCursorRegistry(resync_interval=3600)
+        queue = WriteBehindQueue(cursors.peek, on_commit=cursors.advance)
+        for day in range(1, 4):
+            queue.submit(sheet, [f'0{day}.01.2025'])
+        queue.flush()
+        queue.submit(sheet, ['04.01.2025'])
+        queue.flush()
+
+        assert sorted(sheet.rows) == [2, 3, 4, 5]
+        assert sheet.calls == ['col_values', 'batch_update', 'batch_update']
+
+class FakeSpreadsheet:
+    """Таблица в памяти, считает запросы метаданных"""
+
+    def __init__(self, worksheets):
+        self._worksheets = list(worksheets)
+        self.metadata_calls = 0
+        self.fail = False
+
+    def worksheets(self):
+        self.metadata_calls += 1
+        if self.fail:
+            raise ConnectionError("Sheets недоступен")
+        return list(self._worksheets)
+
+
+class TestWorksheetCache:
+    """Тесты кэша листов"""
+
+    def test_steady_state_without_network(self):
+        """Повторные обращения к листам не ходят в сеть"""
+        from worksheet_cache import WorksheetCache
+
+        sh = FakeSpreadsheet([FakeWorksheet('Админ', 1), FakeWorksheet('Снаб', 2)])
+        cache = WorksheetCache(sh, ttl=3600)
+        for _ in range(10):
+            assert cache.get('Админ').id == 1
+            assert cache.get('Снаб').id == 2
+        assert sh.metadata_calls == 1
+
+    def test_missing_and_invalidated_sheets(self):
+        """Неизвестный лист даёт WorksheetNotFound, invalidate форсирует перечитывание"""
+        from worksheet_cache import WorksheetCache
+
+        sh = FakeSpreadsheet([FakeWorksheet('Админ', 1)])
+        cache = WorksheetCache(sh, ttl=3600)
+        with pytest.raises(gspread.exceptions.WorksheetNotFound):
+            cache.get('Снаб')
+
+        sh._worksheets.append(FakeWorksheet('Снаб', 2))
+        assert cache.get('Снаб').id == 2
+        cache.invalidate('Админ')
+        cache.get('Админ')
+        assert sh.metadata_calls == 3
+
+    def test_stale_entry_survives_outage(self):
+        """При недоступной таблице устаревший лист продолжает использоваться"""
+        from worksheet_cache import WorksheetCache
+
+        sh = FakeSpreadsheet([FakeWorksheet('Админ', 1)])
+        cache = WorksheetCache(sh, ttl=0)
+        cache.get('Админ')
+        sh.fail = True
+        assert cache.get('Админ').id == 1
+
+class TestChatRouting:
+    """Тесты таблицы маршрутизации чатов"""
+
+    def test_env_fallback_matches_old_rules(self):
+        """Без файла маршруты строятся из CHAT_ADMIN_ID / CHAT_SNAB_ID"""
+        from routing import ChatRouter, config_from_env
+
+        config = config_from_env('-100, -200', '-300,,-100', 'Админ', 'Снаб')
+        router = ChatRouter(None, 'sheet-id', fallback_config=config)
+        router.load()
+
+        assert router.lookup(-100).sheet_name == 'Админ'
+        assert router.lookup(-300).role == 'snab'
+        assert router.lookup(-300).spreadsheet_id == 'sheet-id'
+        assert router.lookup(-999) is None
+
+    def test_file_reload_swaps_table(self, tmp_path):
+        """Изменение файла подменяет таблицу, битый файл оставляет прежнюю"""
+        from routing import ChatRouter
+
+        path = tmp_path / 'routes.json'
+        path.write_text(json.dumps({
+            'roles': {'admin': {'sheet': 'Админ'}, 'project': {'sheet': 'Проект', 'spreadsheet_id': 'other'}},
+            'chats': {'-1': 'admin'}
+        }), encoding='utf8')
+        router = ChatRouter(str(path), 'main')
+        router.load()
+        assert router.lookup(-2) is None
+
+        path.write_text(json.dumps({
+            'roles': {'project': {'sheet': 'Проект', 'spreadsheet_id': 'other'}},
+            'chats': {'-2': 'project'}
+        }), encoding='utf8')
+        router.reload()
+        assert router.lookup(-1) is None
+        assert router.lookup(-2).spreadsheet_id == 'other'
+
+        path.write_text(json.dumps({'roles': {}, 'chats': {'-3': 'missing'}}), encoding='utf8')
+        router.reload()
+        assert router.lookup(-2).sheet_name == 'Проект'
+
+    def test_table_is_read_only(self):
+        """Таблица маршрутов неизменяема"""
+        from routing import build_table
+
+        table = build_table({'roles': {'admin': {'sheet': 'Админ'}}, 'chats': {'-1': 'admin'}}, 'main')
+        with pytest.raises(TypeError):
+            table[-2] = table[-1]
+
+class TestInvoiceParser:
+    """Тесты парсера счетов по схеме полей"""
+
+    VALID = ("@paycollect_bot 01.01.2025 - Счет 1 от 01.01.2025 - Объект2 - стройка мск - Этап 3 - "
+             "Оплата за окна - Оплата за окна алюминий - 30500,00 - ООО Петрович - ООО Дом Газобетон")
+
+    def test_valid_message_builds_row(self):
+        """Корректное сообщение раскладывается по 12 столбцам реестра"""
+        from invoice_parser import InvoiceParser, telegram_link
+
+        parser = InvoiceParser()
+        result = parser.parse(self.VALID)
+        assert result.errors == []
+
+        row = parser.build_row(result.values, telegram_link(-1002890383045, 7))
+        assert row == [
+            '01.01.2025', 'Счет 1 от 01.01.2025', 'Объект2', '', 'Стройка Мск', 'Этап 3', 'Оплата за окна',
+            'Оплата за окна алюминий', '30500,00', 'ООО Петрович', 'https://t.me/c/2890383045/7', 'ООО Дом Газобетон'
+        ]
+
+    def test_all_field_errors_returned_together(self):
+        """Ошибки всех полей возвращаются одним списком"""
+        from invoice_parser import InvoiceParser
+
+        text = self.VALID.replace('01.01.2025 - Счет', '1.1.2025 - Счет').replace('30500,00', '30500руб')
+        result = InvoiceParser().parse(text)
+        assert result.values is None
+        assert len(result.errors) == 2
+        assert 'Дата' in result.errors[0] and 'Сумма' in result.errors[1]
+
+    def test_wrong_field_count(self):
+        """Неверное число полей — одна ошибка с подсказкой про разделители"""
+        from invoice_parser import InvoiceParser
+
+        result = InvoiceParser().parse('@paycollect_bot 01.01.2025 - Объект')
+        assert len(result.errors) == 1
+        assert 'получено 2' in result.errors[0]
+
+    def test_untagged_chatter_rejected(self):
+        """Сообщения без тега бота отсекаются проверкой префикса"""
+        from invoice_parser import InvoiceParser
+
+        parser = InvoiceParser()
+        assert parser.is_addressed(self.VALID)
+        assert not parser.is_addressed('Коллеги, счёт оплачен')
+        assert not parser.is_addressed(None)
+        assert not parser.is_addressed('')
+
+def make_message(chat_id, message_id, text):
+    """Message Telegram из словаря, как его присылает Bot API"""
+    return telebot.types.Message.de_json({
+        'message_id': message_id,
+        'date': 0,
+        'chat': {'id': chat_id, 'type': 'supergroup'},
+        'from': {'id': 1, 'is_bot': False, 'first_name': 'Тест', 'username': 'tester'},
+        'text': text
+    })
+
+
+class TestAsyncRuntime:
+    """Тесты асинхронного режима"""
+
+    def test_order_kept_per_worksheet(self):
+        """Сообщения одного листа идут по порядку, разных листов — параллельно"""
+        import asyncio
+        import threading
+        import time
+        from async_bot import create_async_bot
+
+        processed = []
+        in_flight = {'now': 0, 'max': 0}
+        lock = threading.Lock()
+
+        def process(message, reply):
+            with lock:
+                in_flight['now'] += 1
+                in_flight['max'] = max(in_flight['max'], in_flight['now'])
+            time.sleep(0.02)
+            with lock:
+                in_flight['now'] -= 1
+                processed.append((message.chat.id, message.message_id))
+
+        bot = create_async_bot(
+            '123:fake', process, lambda m: True, lambda chat_id: chat_id, {}, sheets_workers=4
+        )
+        messages = [make_message(chat_id, i, '@paycollect_bot x') for i in range(5) for chat_id in (-1, -2)]
+        asyncio.run(bot.process_new_messages(messages))
+        bot.sheets_executor.shutdown()
+
+        assert [m for c, m in processed if c == -1] == list(range(5))
+        assert [m for c, m in processed if c == -2] == list(range(5))
+        assert in_flight['max'] == 2
+
+class TestKeyedWorkerPool:
+    """Тесты пула обработчиков с порядком по листам"""
+
+    def test_order_per_key_and_parallel_keys(self):
+        """Задачи одного ключа не пересекаются и идут по порядку"""
+        import threading
+        import time
+        from worker_pool import KeyedWorkerPool
+
+        done = []
+        active = {}
+        overlaps = []
+        lock = threading.Lock()
+
+        def task(key, n):
+            with lock:
+                if active.get(key):
+                    overlaps.append(key)
+                active[key] = True
+            time.sleep(0.005)
+            with lock:
+                active[key] = False
+                done.append((key, n))
+
+        pool = KeyedWorkerPool(workers=4)
+        for n in range(10):
+            for key in ('admin', 'snab', 'project'):
+                pool.submit(key, task, key, n)
+        pool.shutdown(timeout=5)
+
+        assert overlaps == []
+        for key in ('admin', 'snab', 'project'):
+            assert [n for k, n in done if k == key] == list(range(10))
+        assert pool.stats()['completed'] == 30
+
+    def test_bounded_queues(self):
+        """Переполнение очереди ключа или пула отклоняется сразу"""
+        import threading
+        import time
+        from worker_pool import KeyedWorkerPool, PoolFullError
+
+        gate = threading.Event()
+        pool = KeyedWorkerPool(workers=1, max_queue=3, max_per_key=2)
+        pool.submit('a', gate.wait)  # Занимает единственный поток
+        while pool.stats()['active'] == 0:
+            time.sleep(0.001)
+        pool.submit('a', lambda: None)
+        pool.submit('a', lambda: None)
+        with pytest.raises(PoolFullError):
+            pool.submit('a', lambda: None)
+        pool.submit('b', lambda: None)
+        with pytest.raises(PoolFullError):
+            pool.submit('c', lambda: None)
+
+        stats = pool.stats()
+        assert stats['queued'] == 3 and stats['rejected'] == 2
+        assert stats['backlog'] == {'a': 2, 'b': 1}
+        gate.set()
+        pool.shutdown(timeout=5)
+
+class TestWebhook:
+    """Тесты приёма апдейтов через webhook в server.py"""
+
+    def _serve(self, received):
+        import threading
+        import server
+
+        server.WEBHOOK_PATH = '/telegram/webhook'
+        server.WEBHOOK_SECRET = 'test-secret'
+        server.RequestHandler.process_updates = staticmethod(received.extend)
+        httpd = server.HTTPServer(('127.0.0.1', 0), server.RequestHandler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        return httpd, server.WEBHOOK_SECRET
+
+    def _post(self, httpd, path, body, secret):
+        import urllib.error
+        import urllib.request
+
+        request = urllib.request.Request(
+            f'http://127.0.0.1:{httpd.server_address[1]}{path}',
+            data=body,
+            headers={'X-Telegram-Bot-Api-Secret-Token': secret, 'Content-Type': 'application/json'}
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=5) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def test_recorded_update_is_processed(self):
+        """Записанный апдейт передаётся в конвейер бота, чужой токен отклоняется"""
+        import server
+
+        received = []
+        httpd, secret = self._serve(received)
+        update = json.dumps({
+            'update_id': 1,
+            'message': {
+                'message_id': 7, 'date': 0,
+                'chat': {'id': -1001, 'type': 'supergroup'},
+                'from': {'id': 1, 'is_bot': False, 'first_name': 'Тест'},
+                'text': '@paycollect_bot 01.01.2025 - ...'
+            }
+        }).encode('utf8')
+        try:
+            assert self._post(httpd, '/telegram/webhook', update, secret) == 200
+            assert self._post(httpd, '/telegram/webhook', update, 'wrong') == 403
+            assert self._post(httpd, '/other', update, secret) == 404
+            assert self._post(httpd, '/telegram/webhook', b'not json', secret) == 400
+            assert self._post(httpd, '/telegram/webhook', b'{}', secret) == 400
+            assert self._post(httpd, '/telegram/webhook', b'[1, 2]', secret) == 400
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            server.RequestHandler.process_updates = None
+
+        assert len(received) == 1
+        assert received[0].message.chat.id == -1001
+        assert received[0].message.text.startswith('@paycollect_bot')
+
+class TestInvoiceJournal:
+    """Тесты журнала счетов и повторной записи"""
+
+    def test_pending_survive_restart(self, tmp_path):
+        """Незаписанные счета остаются в журнале после перезапуска"""
+        from journal import InvoiceJournal
+
+        path = str(tmp_path / 'journal.db')
+        journal = InvoiceJournal(path)
+        first = journal.append(-1, 10, 'sheet-id', 'Админ', ['01.01.2025', 'Счёт'])
+        second = journal.append(-1, 11, 'sheet-id', 'Админ', ['02.01.2025', 'Счёт'])
+        journal.mark_committed(first.id, 5)
+        journal.close()
+
+        reopened = InvoiceJournal(path)
+        pending = reopened.pending()
+        assert [entry.id for entry in pending] == [second.id]
+        assert pending[0].row == ['02.01.2025', 'Счёт']
+        assert pending[0].sheet_name == 'Админ'
+        reopened.close()
+
+    def test_committer_retries_failed_entries(self, tmp_path):
+        """Неудачная запись остаётся в журнале и уходит при следующем проходе"""
+        from concurrent.futures import Future
+        from journal import InvoiceJournal, JournalCommitter
+
+        journal = InvoiceJournal(str(tmp_path / 'journal.db'))
+        submitted = []
+        outage = {'on': True}
+
+        def submit(entry):
+            if outage['on']:
+                raise ConnectionError("Sheets недоступен")
+            future = Future()
+            submitted.append(entry.id)
+            future.set_result(100 + entry.id)
+            return future
+
+        committer = JournalCommitter(journal, submit)
+        entry = committer.append(-1, 10, 'sheet-id', 'Админ', ['01.01.2025'])
+        with pytest.raises(ConnectionError):
+            committer.commit(entry)
+        assert journal.pending()[0].attempts == 1
+
+        outage['on'] = False
+        assert committer.replay() == 1
+        assert committer.replay() == 0
+        assert submitted == [entry.id]
+        assert journal.pending_count() == 0
+        journal.close()
+
+    def test_in_flight_entries_not_replayed(self, tmp_path):
+        """Счёт, ожидающий записи, не отправляется повторно"""
+        from concurrent.futures import Future
+        from journal import InvoiceJournal, JournalCommitter
+
+        journal = InvoiceJournal(str(tmp_path / 'journal.db'))
+        futures = []
+
+        def submit(entry):
+            futures.append(Future())
+            return futures[-1]
+
+        committer = JournalCommitter(journal, submit)
+        committer.commit(committer.append(-1, 10, 'sheet-id', 'Админ', ['01.01.2025']))
+        assert committer.replay() == 0
+        futures[0].set_result(2)
+        assert journal.pending_count() == 0
+        journal.close()
+
+    def test_released_entry_replayed_after_outage(self, tmp_path):
+        """Счёт, принятый в деградированном режиме, уходит в таблицу после замыкания выключателя"""
+        from concurrent.futures import Future
+        from circuit_breaker import CircuitBreaker
+        from journal import InvoiceJournal, JournalCommitter
+
+        journal = InvoiceJournal(str(tmp_path / 'journal.db'))
+        clock = FakeClock()
+        breaker = CircuitBreaker('sheets', failure_threshold=1, reset_timeout=60, clock=clock)
+        breaker.record_failure()
+        submitted = []
+
+        def submit(entry):
+            submitted.append(entry.id)
+            future = Future()
+            future.set_result(2)
+            return future
+
+        committer = JournalCommitter(journal, submit, paused=lambda entry: breaker.is_open)
+        entry = committer.append(-1, 10, 'sheet-id', 'Админ', ['01.01.2025'])
+        assert breaker.is_open
+        committer.release(entry)  # Путь деградированного режима в process_message
+        assert committer.replay() == 0
+
+        breaker.record_success()
+        assert not breaker.is_open
+        assert committer.replay() == 1
+        assert submitted == [entry.id]
+        assert journal.pending_count() == 0
+        journal.close()
+
+    def test_pause_is_per_storage(self, tmp_path):
+        """Пока Sheets недоступен, счета локальных хранилищ продолжают уходить из журнала"""
+        from concurrent.futures import Future
+        from journal import InvoiceJournal, JournalCommitter
+
+        journal = InvoiceJournal(str(tmp_path / 'journal.db'))
+        submitted = []
+
+        def submit(entry):
+            submitted.append(entry.sheet_name)
+            future = Future()
+            future.set_result(entry.id)
+            return future
+
+        outage = {'on': True}
+        committer = JournalCommitter(
+            journal, submit, paused=lambda entry: outage['on'] and entry.sheet_name != 'Поток'
+        )
+        for n in range(3):
+            journal.append(-1, n, 'sheet-id', 'Админ', ['01.01.2025'])
+        journal.append(-2, 10, 'sheet-id', 'Поток', ['01.01.2025'])
+
+        assert committer.replay(limit=2) == 1  # Локальный счёт найден за счетами на паузе
+        assert submitted == ['Поток']
+        outage['on'] = False
+        assert committer.replay(limit=2) == 2
+        assert committer.replay(limit=2) == 1
+        assert journal.pending_count() == 0
+        journal.close()
+
+    def test_replay_after_lost_response_does_not_duplicate(self, tmp_path):
+        """Строка записана, но ответ batch_update потерян: повтор находит её и не пишет второй раз"""
+        from journal import InvoiceJournal, JournalCommitter
+        from row_cursor import RowCursorRegistry
+        from write_queue import WriteBehindQueue
+
+        class FlakyWorksheet(FakeWorksheet):
+            lose_response = True
+
+            def batch_update(self, data, **kwargs):
+                super().batch_update(data, **kwargs)
+                if self.lose_response:
+                    raise ConnectionError("ответ не получен")
+
+        path = str(tmp_path / 'journal.db')
+        journal = InvoiceJournal(path)
+        sheet = FlakyWorksheet('Админ', dates=['Дата'])
+        cursors = RowCursorRegistry(resync_interval=3600)
+        queue = WriteBehindQueue(
+            cursors.peek,
+            on_commit=cursors.advance,
+            on_error=lambda worksheet, e: cursors.invalidate(worksheet),
+            on_allocate=lambda worksheet, allocations: journal.mark_allocated(worksheet.title, allocations)
+        )
+
+        def find_written(entry):
+            return entry.row_number if sheet.rows.get(entry.row_number) == entry.row else None
+
+        committer = JournalCommitter(journal, lambda entry: queue.submit(sheet, entry.row, entry.id),
+                                     find_written=find_written)
+        entry = committer.append(-1, 10, 'sheet-id', 'Админ', ['01.01.2025', 'https://t.me/c/1/10'])
+        future = committer.commit(entry)
+        queue.flush()
+        with pytest.raises(ConnectionError):
+            future.result(timeout=1)
+        journal.close()
+
+        # Перезапуск: журнал помнит выделенную строку, счёт не дописывается второй раз
+        sheet.lose_response = False
+        journal = InvoiceJournal(path)
+        pending = journal.pending()
+        assert (pending[0].written_sheet, pending[0].row_number) == ('Админ', 2)
+        committer = JournalCommitter(journal, lambda entry: queue.submit(sheet, entry.row, entry.id),
+                                     find_written=find_written)
+        assert committer.replay() == 1
+        queue.flush()
+        assert journal.pending_count() == 0
+        assert sheet.calls.count('batch_update') == 1
+        assert list(sheet.rows) == [2]
+        journal.close()
+
+class FakeClock:
+    """Виртуальное время для тестов ограничителя: sleep только сдвигает часы"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def make_api_error(code):
+    """gspread.exceptions.APIError с заданным кодом ответа"""
+    import requests
+
+    response = requests.Response()
+    response.status_code = code
+    response._content = json.dumps({'error': {'code': code, 'message': 'quota', 'status': 'X'}}).encode()
+    return gspread.exceptions.APIError(response)
+
+
+class TestSheetsRateLimiter:
+    """Тесты ограничителя запросов к Sheets"""
+
+    def test_bucket_spaces_requests(self):
+        """Сверх запаса запросы ждут своей очереди, а не падают"""
+        from rate_limiter import TokenBucket
+
+        clock = FakeClock()
+        bucket = TokenBucket(60, burst=2, clock=clock, sleep=clock.sleep)
+        for _ in range(5):
+            bucket.acquire()
+        assert clock.now == pytest.approx(3.0)
+
+    def test_retry_on_429_with_backoff(self):
+        """429 повторяется с задержкой, скорость bucket снижается"""
+        from rate_limiter import SheetsRateLimiter
+
+        clock = FakeClock()
+        limiter = SheetsRateLimiter(60, 60, clock=clock, sleep=clock.sleep)
+        responses = [make_api_error(429), make_api_error(503), 'ok']
+
+        def call():
+            result = responses.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        assert limiter.call('write', call) == 'ok'
+        stats = limiter.stats()
+        assert stats['retries'] == 2 and stats['throttled'] == 1
+        assert stats['write_rate_per_minute'] < 60
+        assert stats['read_rate_per_minute'] == 60
+
+    def test_non_retryable_and_exhausted(self):
+        """404 не повторяется, постоянный 429 приводит к ошибке после max_retries"""
+        from rate_limiter import SheetsRateLimiter
+
+        clock = FakeClock()
+        limiter = SheetsRateLimiter(600, 600, max_retries=2, clock=clock, sleep=clock.sleep)
+
+        def not_found():
+            raise make_api_error(404)
+
+        def quota():
+            raise make_api_error(429)
+
+        with pytest.raises(gspread.exceptions.APIError):
+            limiter.call('read', not_found)
+        assert limiter.stats()['retries'] == 0
+        with pytest.raises(gspread.exceptions.APIError):
+            limiter.call('read', quota)
+        assert limiter.stats()['retries'] == 2
+        assert limiter.stats()['failures'] == 2
+
+class TestCircuitBreaker:
+    """Тесты выключателя Google Sheets"""
+
+    def test_trip_probe_and_recover(self):
+        """Серия ошибок размыкает выключатель, успешная проба замыкает его"""
+        from circuit_breaker import CircuitBreaker, CircuitOpenError
+
+        clock = FakeClock()
+        changes = []
+        breaker = CircuitBreaker('sheets', failure_threshold=2, reset_timeout=30, clock=clock,
+                                 on_state_change=lambda b, old, new: changes.append((new, b.status()['state'])))
+
+        def down():
+            raise ConnectionError("timeout")
+
+        for _ in range(2):
+            with pytest.raises(ConnectionError):
+                breaker.call(down)
+        assert breaker.is_open
+        with pytest.raises(CircuitOpenError):
+            breaker.call(lambda: 'ok')
+
+        clock.now += 30
+        assert not breaker.is_open
+        assert breaker.allow_request()  # Пробный запрос
+        assert not breaker.allow_request()  # Второй параллельно не пускаем
+        breaker.record_success()
+        assert breaker.call(lambda: 'ok') == 'ok'
+        assert changes == [('open', 'open'), ('half_open', 'half_open'), ('closed', 'closed')]
+
+    def test_failed_probe_reopens(self):
+        """Неудачная проба снова размыкает выключатель"""
+        from circuit_breaker import CircuitBreaker
+
+        clock = FakeClock()
+        breaker = CircuitBreaker('sheets', failure_threshold=1, reset_timeout=10, clock=clock)
+        breaker.record_failure(ConnectionError())
+        clock.now += 10
+        assert breaker.allow_request()
+        breaker.record_failure(ConnectionError())
+        assert breaker.status()['state'] == 'open'
+        assert breaker.status()['retry_in'] == 10
+
+    def test_http_client_counts_only_availability_errors(self):
+        """Ошибки 4xx не размыкают выключатель, 5xx и сетевые — размыкают"""
+        import requests
+        from circuit_breaker import CircuitBreaker, CircuitOpenError, breaker_http_client
+        from gspread.http_client import HTTPClient
+
+        errors = [make_api_error(400), make_api_error(400), make_api_error(503), requests.ConnectionError()]
+
+        class FailingClient(HTTPClient):
+            def request(self, *args, **kwargs):
+                raise errors.pop(0)
+
+        breaker = CircuitBreaker('sheets', failure_threshold=2, reset_timeout=60)
+        client = breaker_http_client(FailingClient, breaker)(auth=None, session=requests.Session())
+        for _ in range(4):
+            with pytest.raises(Exception) as info:
+                client.request('get', 'https://sheets')
+            assert not isinstance(info.value, CircuitOpenError)
+        assert breaker.status()['state'] == 'open'
+        with pytest.raises(CircuitOpenError):
+            client.request('get', 'https://sheets')
+
+    def test_concurrent_state_changes_do_not_deadlock(self):
+        """Обработчик перехода читает состояние всех выключателей: два размыкания одновременно не виснут"""
+        import threading
+        from circuit_breaker import BreakerRegistry
+
+        both_changing = threading.Barrier(2, timeout=2)
+        snapshots = []
+
+        def on_state_change(breaker, old, new):
+            both_changing.wait()  # Оба потока внутри обработчика одновременно
+            snapshots.append(breakers.status())
+
+        breakers = BreakerRegistry('sheets', failure_threshold=1, reset_timeout=60, on_state_change=on_state_change)
+        threads = [
+            threading.Thread(target=breakers.get(key).record_failure, daemon=True) for key in ('shard-a', 'shard-b')
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        assert not any(thread.is_alive() for thread in threads)
+        assert len(snapshots) == 2
+        assert {state['state'] for state in snapshots[-1].values()} == {'open'}
+
+    def test_breaker_counts_each_retry_attempt(self):
+        """Выключатель внутри повторов ограничителя: размыкается за threshold попыток, дальше — без повторов"""
+        import requests
+        from circuit_breaker import CircuitBreaker, CircuitOpenError, breaker_http_client
+        from gspread.http_client import HTTPClient
+        from rate_limiter import SheetsRateLimiter, limited_http_client
+
+        attempts = []
+
+        class OutageClient(HTTPClient):
+            def request(self, method, endpoint, *args, **kwargs):
+                attempts.append(endpoint)
+                raise make_api_error(503)
+
+        clock = FakeClock()
+        limiter = SheetsRateLimiter(600, 600, max_retries=6, clock=clock, sleep=clock.sleep)
+        breaker = CircuitBreaker('sheets', failure_threshold=5, reset_timeout=60, clock=clock)
+        client_class = limited_http_client(limiter, base=breaker_http_client(OutageClient, breaker))
+        client = client_class(auth=None, session=requests.Session())
+
+        with pytest.raises(CircuitOpenError):
+            client.request('post', 'https://sheets/values:batchUpdate')
+        assert len(attempts) == 5
+        slept = sum(clock.sleeps)
+
+        with pytest.raises(CircuitOpenError):
+            client.request('post', 'https://sheets/values:batchUpdate')
+        assert len(attempts) == 5 and sum(clock.sleeps) == slept  # Ни запроса, ни ожидания
+
+    def test_breaker_per_spreadsheet(self):
+        """Сбой одной таблицы-шарда размыкает только её выключатель"""
+        import requests
+        from circuit_breaker import BreakerRegistry, CircuitOpenError, breaker_http_client
+        from gspread.http_client import HTTPClient
+
+        class ShardClient(HTTPClient):
+            def request(self, method, endpoint, *args, **kwargs):
+                if '/spreadsheets/shard-a' in endpoint:
+                    raise requests.ConnectionError()
+                return 'ok'
+
+        breakers = BreakerRegistry('sheets', failure_threshold=2, reset_timeout=60)
+        client = breaker_http_client(ShardClient, breakers)(auth=None, session=requests.Session())
+        api = 'https://sheets.googleapis.com/v4/spreadsheets'
+        for _ in range(2):
+            with pytest.raises(requests.ConnectionError):
+                client.request('post', f'{api}/shard-a/values:batchUpdate')
+        with pytest.raises(CircuitOpenError):
+            client.request('get', f'{api}/shard-a')
+        assert client.request('post', f'{api}/shard-b/values:batchUpdate') == 'ok'
+        assert breakers.get('shard-a').is_open and not breakers.get('shard-b').is_open
+        assert breakers.status()['shard-a']['name'] == 'sheets:shard-a'
+
+class TestProcessedIndex:
+    """Тесты защиты от повторной доставки апдейтов"""
+
+    def test_duplicates_detected_with_row(self):
+        """Повторное сообщение распознаётся, известна строка записи"""
+        from dedupe import ProcessedIndex
+
+        index = ProcessedIndex(max_size=10)
+        assert index.reserve(-1, 7) == (True, None)
+        assert index.reserve(-1, 7) == (False, None)
+        index.record(-1, 7, 42)
+        assert index.reserve(-1, 7) == (False, 42)
+        assert index.reserve(-2, 7) == (True, None)
+        assert index.duplicates == 2
+
+    def test_memory_bounded_lru(self):
+        """Индекс не растёт больше max_size, вытесняются самые старые"""
+        from dedupe import ProcessedIndex
+
+        index = ProcessedIndex(max_size=3)
+        for message_id in range(5):
+            index.reserve(-1, message_id)
+        assert len(index) == 3
+        assert index.reserve(-1, 0) == (True, None)
+        assert index.reserve(-1, 4) == (False, None)
+
+    def test_release_and_warm_from_journal(self, tmp_path):
+        """Снятая отметка позволяет повтор, индекс заполняется из журнала"""
+        from dedupe import ProcessedIndex
+        from journal import InvoiceJournal
+
+        journal = InvoiceJournal(str(tmp_path / 'journal.db'))
+        first = journal.append(-1, 10, 'sheet-id', 'Админ', ['01.01.2025'])
+        journal.append(-1, 11, 'sheet-id', 'Админ', ['02.01.2025'])
+        journal.mark_committed(first.id, 5)
+
+        index = ProcessedIndex()
+        index.load(journal.recent_messages(100))
+        assert index.reserve(-1, 10) == (False, 5)
+        assert index.reserve(-1, 11) == (False, None)
+        index.release(-1, 11)
+        assert index.reserve(-1, 11) == (True, None)
+        journal.close()
+
+class TestInvoiceIndex:
+    """Тесты поиска повторно присланных счетов"""
+
+    @staticmethod
+    def _row(account='Счет 1', amount='30500,00', supplier='ООО Петрович', link='https://t.me/c/1/1'):
+        return ['01.01.2025', account, 'Объект', '', 'Мск', 'Этап', 'Окна', 'Окна', amount, supplier, link, 'ООО Дом']
+
+    def test_check_and_add_normalizes_fields(self):
+        """Повтор находится без учёта регистра и пробелов, пустые поля не индексируются"""
+        from dedupe import InvoiceIndex
+
+        index = InvoiceIndex()
+        assert index.check_and_add(self._row()) is None
+        original = index.check_and_add(self._row(account='счет  1', amount='30 500,00', link='https://t.me/c/2/9'))
+        assert original == (None, None, None, 'https://t.me/c/1/1')
+        assert index.check_and_add(self._row(amount='100,00')) is None
+        assert index.check_and_add(self._row(supplier='')) is None
+        assert len(index) == 2
+
+    def test_built_incrementally_from_sheet(self):
+        """Индекс строится из листа блоками и указывает на исходную строку"""
+        from dedupe import InvoiceIndex, build_index_from_worksheet, sheet_row_url
+
+        ws = FakeWorksheet(sheet_id=7, row_count=25)
+        ws.rows[1] = ['Дата', 'Реквизиты']
+        for n in range(2, 12):
+            ws.rows[n] = self._row(account=f'Счет {n}')
+
+        index = InvoiceIndex()
+        assert build_index_from_worksheet(index, ws, chunk=4) == 10
+        assert ws.calls == ['get'] * 4  # 1-4, 5-8, 9-12 и пустой 13-16; до row_count не читаем
+        assert index.check_and_add(self._row(account='Счет 5'))[:3] == ('fake', 7, 5)
+        assert sheet_row_url('fake', 7, 5).endswith('/d/fake/edit#gid=7&range=A5')
+
+    def test_own_writes_keep_original_location(self):
+        """Запись повтора не подменяет ссылку на оригинал"""
+        from dedupe import InvoiceIndex
+
+        index = InvoiceIndex()
+        original = self._row()
+        duplicate = self._row(link='https://t.me/c/2/9')
+        index.check_and_add(original)
+        index.check_and_add(duplicate)
+        index.set_location(duplicate, 'fake', 0, 20)
+        index.set_location(original, 'fake', 0, 10)
+        assert index.check_and_add(duplicate) == ('fake', 0, 10, 'https://t.me/c/1/1')
+
+    def test_resend_after_failed_journal_write(self):
+        """Счёт, не попавший в журнал, убирается из индекса: повторная отправка не считается дублем"""
+        from dedupe import InvoiceIndex
+
+        index = InvoiceIndex()
+        row = self._row()
+        assert index.check_and_add(row) is None
+        index.discard(row)  # Ошибка записи в журнал в process_message
+        assert index.check_and_add(row) is None
+        assert len(index) == 1
+
+        # Записанный счёт и счёт другого сообщения не удаляются
+        index.set_location(row, 'fake', 0, 10)
+        index.discard(row)
+        other = self._row(link='https://t.me/c/2/9')
+        index.discard(other)
+        assert index.check_and_add(other) == ('fake', 0, 10, 'https://t.me/c/1/1')
+
+class TestSendQueue:
+    """Тесты очереди исходящих сообщений"""
+
+    class FloodError(Exception):
+        """Как telebot ApiTelegramException"""
+
+        def __init__(self, code, retry_after=None):
+            super().__init__(f"Error code: {code}")
+            self.error_code = code
+            self.result_json = {'parameters': {'retry_after': retry_after}} if retry_after is not None else {}
+
+    def test_retry_after_honoured_and_order_kept(self):
+        """После 429 сообщение не теряется, порядок в чате сохраняется"""
+        import threading
+        from send_queue import SendQueue
+
+        sent = []
+        all_sent = threading.Event()
+        failures = {'left': 1}
+
+        def send(message, text):
+            if text == 'b' and failures['left']:
+                failures['left'] -= 1
+                raise self.FloodError(429, retry_after=0)
+            sent.append((message.chat.id, text))
+            if len(sent) == 4:
+                all_sent.set()
+
+        queue = SendQueue(send, group_per_minute=6000, workers=2).start()
+        for text in 'abc':
+            queue.reply(make_message(-1, 1, ''), text)
+        queue.reply(make_message(-2, 1, ''), 'x')
+        assert all_sent.wait(5)
+        queue.stop(timeout=5)
+
+        assert [text for chat_id, text in sent if chat_id == -1] == ['a', 'b', 'c']
+        assert queue.stats()['flood_waits'] == 1
+        assert queue.stats()['pending'] == 0
+
+    def test_reply_never_blocks_and_permanent_errors_dropped(self):
+        """reply не ждёт Telegram; 403 не зацикливает очередь"""
+        import threading
+        import time
+        from send_queue import SendQueue
+
+        release = threading.Event()
+        sent = []
+
+        def send(message, text):
+            release.wait(5)
+            if text == 'kicked':
+                raise self.FloodError(403)
+            sent.append(text)
+
+        queue = SendQueue(send, private_per_second=1000, workers=1).start()
+        started = time.monotonic()
+        queue.reply(make_message(5, 1, ''), 'kicked')
+        queue.reply(make_message(5, 2, ''), 'ok')
+        assert time.monotonic() - started < 0.5
+        release.set()
+        queue.stop(timeout=5)
+        assert sent == ['ok']
+        assert queue.stats()['failed'] == 1
+
+    def test_group_rate_limit(self):
+        """В группу уходит не больше лимита: после запаса — с интервалом"""
+        import time
+        from send_queue import SendQueue
+
+        times = []
+        queue = SendQueue(lambda message, text: times.append(time.monotonic()), group_per_minute=600).start()
+        for i in range(5):
+            queue.reply(make_message(-1, i, ''), str(i))
+        queue.stop(timeout=5)
+
+        assert len(times) == 5
+        assert times[4] - times[0] >= 0.15  # Запас 3 сообщения, дальше 10 в секунду
+
+class TestLogPipeline:
+    """Тесты неблокирующего логирования"""
+
+    @staticmethod
+    def _record(level, msg):
+        import logging
+        return logging.LogRecord('bot', level, __file__, 1, msg, None, None)
+
+    def test_full_queue_drops_and_reports(self):
+        """При полной очереди запись отбрасывается, а не ждёт; потери сообщаются позже"""
+        import logging
+        import queue
+        from log_pipeline import PressureQueueHandler
+
+        log_queue = queue.Queue(maxsize=2)
+        handler = PressureQueueHandler(log_queue)
+        for i in range(4):
+            handler.handle(self._record(logging.INFO, f'msg {i}'))
+        assert handler.dropped == 2
+
+        log_queue.get_nowait()
+        log_queue.get_nowait()
+        handler.handle(self._record(logging.INFO, 'after'))
+        messages = [log_queue.get_nowait().getMessage() for _ in range(2)]
+        assert 'потеряно записей: 2' in messages[0]
+        assert messages[1] == 'after'
+
+    def test_debug_sampled_under_pressure(self):
+        """Под нагрузкой проходит только часть DEBUG, INFO не прореживается"""
+        import logging
+        import queue
+        from log_pipeline import PressureQueueHandler
+
+        log_queue = queue.Queue(maxsize=100)
+        handler = PressureQueueHandler(log_queue, high_water=0.5, sample_every=10)
+        for i in range(50):
+            handler.handle(self._record(logging.INFO, 'fill'))
+        for i in range(30):
+            handler.handle(self._record(logging.DEBUG, 'debug'))
+        handler.handle(self._record(logging.INFO, 'info'))
+        assert log_queue.qsize() == 50 + 3 + 1
+        assert handler.sampled_out == 27
+
+    def test_json_lines_and_time_rotation(self, tmp_path):
+        """Файл — JSON-строки; ротация срабатывает по времени"""
+        import json
+        import logging
+        from log_pipeline import JsonFormatter, SizeAndTimeRotatingFileHandler
+
+        path = tmp_path / 'bot.log'
+        handler = SizeAndTimeRotatingFileHandler(str(path), max_bytes=10 ** 6, backup_count=2, interval=3600)
+        handler.setFormatter(JsonFormatter())
+        handler.handle(self._record(logging.INFO, '📩 первое'))
+        handler.rollover_at = 0  # Интервал истёк
+        handler.handle(self._record(logging.WARNING, 'второе'))
+        handler.close()
+
+        assert json.loads((tmp_path / 'bot.log.1').read_text(encoding='utf8'))['msg'] == '📩 первое'
+        entry = json.loads(path.read_text(encoding='utf8'))
+        assert entry['level'] == 'WARNING' and entry['logger'] == 'bot'
+
+    def test_parse_levels(self):
+        """Уровни отдельных логгеров задаются одной строкой"""
+        from log_pipeline import parse_levels
+
+        assert parse_levels('telebot=warning, write_queue=DEBUG,') == {'telebot': 'WARNING', 'write_queue': 'DEBUG'}
+
+class TestMetrics:
+    """Тесты метрик этапов обработки"""
+
+    def test_render_histograms_and_counters(self):
+        """Гистограммы накопительные, счётчики с метками чата и листа"""
+        from metrics import MetricsRegistry
+
+        metrics = MetricsRegistry(buckets=(0.01, 0.1))
+        metrics.observe('parse', 0.005)
+        metrics.observe('parse', 0.05)
+        metrics.observe('parse', 3)
+        metrics.inc('messages_total', chat=-1, sheet='Админ "бот"', outcome='processed')
+        metrics.inc('messages_total', chat=-1, sheet='Админ "бот"', outcome='processed')
+        metrics.gauge('journal_pending', lambda: 4)
+
+        text = metrics.render()
+        assert 'paycollect_stage_seconds_bucket{stage="parse",le="0.01"} 1' in text
+        assert 'paycollect_stage_seconds_bucket{stage="parse",le="0.1"} 2' in text
+        assert 'paycollect_stage_seconds_bucket{stage="parse",le="+Inf"} 3' in text
+        assert 'paycollect_stage_seconds_count{stage="parse"} 3' in text
+        assert 'paycollect_messages_total{chat="-1",outcome="processed",sheet="Админ \\"бот\\""} 2' in text
+        assert 'paycollect_journal_pending 4' in text
+        assert metrics.stage('parse').quantile(0.5) == 0.1
+
+    def test_limiter_metrics(self):
+        """Состояние ограничителей квоты попадает в /metrics с меткой файла ключей"""
+        from metrics import MetricsRegistry
+        from rate_limiter import SheetsRateLimiter, register_limiter_metrics
+
+        clock = FakeClock()
+        limiter = SheetsRateLimiter(60, 60, clock=clock, sleep=clock.sleep)
+        responses = [make_api_error(429), 'ok']
+
+        def call():
+            result = responses.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        limiter.call('write', call)
+        metrics = MetricsRegistry()
+        register_limiter_metrics(metrics, lambda: {'keys.json': limiter})
+
+        text = metrics.render()
+        assert '# TYPE paycollect_sheets_limiter_throttled_total counter' in text
+        assert 'paycollect_sheets_limiter_throttled_total{credentials="keys.json"} 1' in text
+        assert 'paycollect_sheets_limiter_requests_total{credentials="keys.json"} 2' in text
+        assert 'paycollect_sheets_limiter_rate_per_minute{credentials="keys.json",kind="read"} 60' in text
+        assert 'paycollect_sheets_limiter_tokens{credentials="keys.json",kind="write"}' in text
+
+    def test_write_queue_reports_sheet_write(self):
+        """Очередь записи отмечает время batch_update"""
+        from metrics import MetricsRegistry
+        from write_queue import WriteBehindQueue
+
+        metrics = MetricsRegistry()
+        ws = FakeWorksheet()
+        queue = WriteBehindQueue(lambda worksheet, count: list(range(2, 2 + count)), metrics=metrics)
+        queue.submit(ws, ['01.01.2025'])
+        queue.flush()
+        assert metrics.stage('sheet_write').count == 1
+
+    def test_metrics_endpoint(self):
+        """/metrics отдаётся по HTTP, другие пути — 404"""
+        import urllib.error
+        import urllib.request
+        from metrics import MetricsRegistry, serve_metrics
+
+        metrics = MetricsRegistry()
+        metrics.observe('route', 0.0001)
+        server = serve_metrics(metrics, port=0)
+        try:
+            base = f"http://127.0.0.1:{server.server_address[1]}"
+            with urllib.request.urlopen(f"{base}/metrics", timeout=5) as response:
+                assert 'stage="route"' in response.read().decode('utf8')
+            try:
+                urllib.request.urlopen(f"{base}/other", timeout=5)
+                assert False, "ожидалась 404"
+            except urllib.error.HTTPError as e:
+                assert e.code == 404
+        finally:
+            server.shutdown()
+
+class TestStatsChannel:
+    """Тесты канала статистики бот -> monitor.py"""
+
+    def test_snapshot_delivered_over_socket(self, tmp_path):
+        """Снимок доходит до монитора, события и последняя активность сохраняются"""
+        import time
+        from stats_channel import StatsPublisher, StatsReceiver
+
+        path = str(tmp_path / 'stats.sock')
+        receiver = StatsReceiver(path).start()
+        counts = {'processed': 3, 'failed': 1}
+        publisher = StatsPublisher(path, lambda: {'messages': dict(counts), 'sheets_breaker': {'state': 'closed'}})
+        publisher.record('processed')
+        publisher.record('failed', "чат -1, лист 'Админ'")
+        assert publisher.publish()
+
+        deadline = time.monotonic() + 5
+        while not receiver.received and time.monotonic() < deadline:
+            time.sleep(0.01)
+        summary = receiver.summary()
+        receiver.stop()
+
+        assert summary['connected']
+        assert summary['messages_processed'] == 3 and summary['errors'] == 1
+        assert summary['last_activity'] is not None
+        assert [event['kind'] for event in summary['events']] == ['failed']
+        assert summary['sheets_breaker'] == {'state': 'closed'}
+
+    def test_publish_without_monitor_never_raises(self, tmp_path):
+        """Если монитор не запущен, бот продолжает работу"""
+        from stats_channel import StatsPublisher
+
+        publisher = StatsPublisher(str(tmp_path / 'absent.sock'), lambda: {'messages': {}})
+        assert publisher.publish() is False
+
+    def test_throughput_and_error_rate_over_window(self):
+        """Скорость и доля ошибок считаются по разнице снимков за окно"""
+        import json
+        from stats_channel import StatsReceiver
+
+        clock = FakeClock()
+        receiver = StatsReceiver('unused', window=60, clock=clock)
+        for processed, failed in ((0, 0), (9, 0), (18, 2)):
+            receiver.handle(json.dumps({'pid': 1, 'messages': {'processed': processed, 'failed': failed}}).encode())
+            clock.now += 30
+
+        summary = receiver.summary()
+        assert summary['throughput_per_minute'] == 20.0
+        assert summary['error_rate'] == 0.1
+        assert not summary['connected']  # Последний снимок старше stale_after
+
+        receiver.handle(json.dumps({'pid': 2, 'messages': {'processed': 1}}).encode())
+        assert receiver.summary()['throughput_per_minute'] == 0.0  # Бот перезапущен
+
+class TestStorageSinks:
+    """Тесты локальных хранилищ строк и выбора хранилища по маршруту"""
+
+    def test_sqlite_append_lookup_update(self, tmp_path):
+        """SQLite возвращает номера строк пачки и обновляет строку по номеру"""
+        from sinks import SinkError, SQLiteSink
+
+        path = str(tmp_path / 'registry.db')
+        sink = SQLiteSink(path, 'main', 'Админ')
+        assert sink.append_batch([['01.01.2025', 'Счёт 1'], ['02.01.2025', 'Счёт 2']]) == [1, 2]
+        assert sink.submit(['03.01.2025', 'Счёт 3']).result() == 3
+
+        sink.update_row(2, ['02.01.2025', 'Счёт 2 (исправлен)'])
+        sink.close()
+
+        reopened = SQLiteSink(path, 'main', 'Админ')
+        assert reopened.lookup_row(2) == ['02.01.2025', 'Счёт 2 (исправлен)']
+        assert SQLiteSink(path, 'main', 'Снаб').lookup_row(1) is None
+        # Одноимённый лист другой таблицы-шарда — отдельный лист
+        shard = SQLiteSink(path, 'shard', 'Админ')
+        assert shard.lookup_row(1) is None
+        with pytest.raises(SinkError):
+            shard.update_row(2, ['x'])
+        shard.close()
+        with pytest.raises(SinkError):
+            reopened.update_row(99, ['x'])
+        reopened.close()
+
+    def test_csv_is_append_only(self, tmp_path):
+        """CSV продолжает нумерацию после перезапуска и не поддерживает обновление"""
+        from sinks import CSVSink, SinkError
+
+        path = str(tmp_path / 'registry.csv')
+        assert CSVSink(path).append_batch([['1', 'Счёт, с запятой'], ['2', 'Счёт']]) == [1, 2]
+
+        sink = CSVSink(path)
+        assert sink.submit(['3', 'Счёт']).result() == 3
+        assert sink.lookup_row(1) == ['1', 'Счёт, с запятой']
+        assert sink.lookup_row(10) is None
+        with pytest.raises(SinkError):
+            sink.update_row(1, ['1', 'x'])
+
+        main = CSVSink.for_sheet(str(tmp_path / 'csv'), 'main', 'Поток/1')
+        shard = CSVSink.for_sheet(str(tmp_path / 'csv'), 'shard', 'Поток/1')
+        assert main.path != shard.path
+        assert main.append_batch([['1']]) == [1]
+        assert shard.append_batch([['1'], ['2']]) == [1, 2]
+
+    def test_sink_interface_is_abstract(self):
+        """Хранилище без append_batch/lookup_row/update_row не создаётся"""
+        from sinks import StorageSink
+
+        class Partial(StorageSink):
+            def append_batch(self, rows):
+                return []
+
+        with pytest.raises(TypeError):
+            StorageSink()
+        with pytest.raises(TypeError):
+            Partial()
+
+    def test_route_sink_kind(self):
+        """Хранилище задаётся ролью; у одного листа не может быть двух хранилищ"""
+        from routing import ChatRouter, RoutingError, build_sinks, build_table
+
+        config = {
+            'roles': {'admin': {'sheet': 'Админ'}, 'stream': {'sheet': 'Поток', 'sink': 'sqlite'}},
+            'chats': {'-1': 'admin', '-2': 'stream'}
+        }
+        router = ChatRouter(None, 'main', fallback_config=config)
+        router.load()
+        assert router.sink_for('main', 'Поток') == 'sqlite'
+        assert router.sink_for('main', 'Админ') == 'sheets'
+
+        with pytest.raises(RoutingError):
+            build_table({'roles': {'a': {'sheet': 'A', 'sink': 'parquet'}}, 'chats': {'-1': 'a'}}, 'main')
+        conflict = build_table({
+            'roles': {'a': {'sheet': 'A'}, 'b': {'sheet': 'A', 'sink': 'csv'}},
+            'chats': {'-1': 'a', '-2': 'b'}
+        }, 'main')
+        with pytest.raises(RoutingError):
+            build_sinks(conflict)
+
+class TestLazySheetsConnection:
+    """Тесты фонового подключения к Google Sheets"""
+
+    def test_client_waits_for_warm_up(self):
+        """Первое обращение ждёт прогрева, прогрев получает готовый клиент"""
+        import threading
+        from sheets_connection import LazySheetsConnection
+
+        release = threading.Event()
+        warmed = []
+        client = object()
+
+        def connect():
+            release.wait(5)
+            return client
+
+        connection = LazySheetsConnection(connect, warm_up=warmed.append)
+        assert not connection.ready  # Конструктор не подключается
+        connection.start()
+        assert not connection.wait_ready(0.05)
+        release.set()
+        assert connection.client(timeout=5) is client
+        assert warmed == [client]
+        assert connection.status()['ready']
+
+    def test_connect_errors_are_retried(self):
+        """Ошибка подключения не роняет бота: client() бросает SheetsNotReady, поток повторяет попытку"""
+        from sheets_connection import LazySheetsConnection, SheetsNotReady
+
+        attempts = []
+
+        def connect():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise ConnectionError("нет сети")
+            return 'client'
+
+        connection = LazySheetsConnection(connect, retry_interval=0.05)
+        with pytest.raises(SheetsNotReady):
+            connection.client(timeout=0.01)
+        assert connection.client(timeout=5) == 'client'
+        assert len(attempts) == 3
+        connection.stop()
+
+class TestSheetsClientFactory:
+    """Тесты общей фабрики клиентов Google Sheets"""
+
+    class FakeCredentials:
+        def __init__(self):
+            self.token = None
+            self.expiry = None
+            self.refreshes = 0
+            self.requests = []
+
+        def refresh(self, request):
+            from datetime import datetime, timedelta
+            self.requests.append(request)
+            self.refreshes += 1
+            self.token = f'token-{self.refreshes}'
+            self.expiry = datetime(2025, 1, 1, 12, 0) + timedelta(hours=self.refreshes)
+
+    def test_token_refreshed_before_expiry(self):
+        """Токен обновляется только в последние refresh_margin секунд жизни"""
+        from datetime import datetime
+        from sheets_client import SheetsClientFactory
+
+        now = {'value': datetime(2025, 1, 1, 12, 0)}
+        credentials = self.FakeCredentials()
+        factory = SheetsClientFactory(None, credentials=credentials, refresh_margin=300, now=lambda: now['value'])
+
+        assert factory.ensure_token()  # Токена ещё нет
+        assert not factory.ensure_token()
+        now['value'] = datetime(2025, 1, 1, 12, 54)
+        assert not factory.ensure_token()
+        now['value'] = datetime(2025, 1, 1, 12, 56)
+        assert factory.ensure_token()
+        assert credentials.refreshes == 2
+        assert factory.stats()['token_refreshes'] == 2
+
+        # Обмен токена не через AuthorizedSession: она обновила бы токен ещё раз сама
+        from google.auth.transport.requests import AuthorizedSession
+        sessions = {id(request.session) for request in credentials.requests}
+        assert sessions == {id(factory.token_session())}
+        assert not isinstance(factory.token_session(), AuthorizedSession)
+        factory.close()
+
+    def test_spreadsheet_metadata_cached(self):
+        """Таблица открывается один раз за metadata_ttl, клиент переиспользуется"""
+        from sheets_client import SheetsClientFactory, shared_factory
+
+        opened = []
+
+        class FakeClient:
+            def open_by_key(self, key):
+                opened.append(key)
+                return f'spreadsheet-{key}'
+
+        clock = {'value': 0.0}
+        factory = SheetsClientFactory(None, metadata_ttl=600, clock=lambda: clock['value'])
+        factory.client = lambda: FakeClient()
+
+        assert factory.spreadsheet('a') == 'spreadsheet-a'
+        clock['value'] = 599
+        assert factory.spreadsheet('a') == 'spreadsheet-a'
+        clock['value'] = 601
+        factory.spreadsheet('a')
+        assert opened == ['a', 'a']
+        assert factory.stats()['metadata_hits'] == 1
+
+        assert shared_factory('keys.json') is shared_factory('keys.json')
+
+class TestSheetCapacity:
+    """Тесты расширения листов и перехода на лист нового периода"""
+
+    def test_write_grows_full_sheet(self):
+        """Строка за пределами листа больше не отклоняется: лист расширяется"""
+        from capacity import CapacityManager
+        from write_queue import WriteBehindQueue
+
+        worksheet = FakeWorksheet(row_count=3, dates=['Дата', '01.01.2025', '02.01.2025'])
+        queue = WriteBehindQueue(TestWriteBehindQueue._allocator, capacity=CapacityManager(grow_chunk=10, headroom=0))
+        future = queue.submit(worksheet, ['03.01.2025', 'Счёт'])
+        queue.flush()
+
+        assert future.result(timeout=1) == 4
+        assert worksheet.row_count == 13
+        assert worksheet.calls.count('add_rows') == 1
+
+    def test_background_growth_and_full_sheet(self):
+        """Малый запас строк расширяет лист в фоне; на пределе вызывается on_full"""
+        import threading
+        from capacity import CapacityManager
+        from write_queue import NoFreeRowError
+
+        full = threading.Event()
+        capacity = CapacityManager(grow_chunk=100, headroom=20, max_rows=150, on_full=lambda ws: full.set())
+        worksheet = FakeWorksheet(row_count=100)
+
+        capacity.observe(worksheet, 50)  # Запас 51 строка — сеть не нужна
+        assert worksheet.calls == []
+        capacity.observe(worksheet, 90)
+        for _ in range(100):
+            if worksheet.row_count != 100:
+                break
+            threading.Event().wait(0.01)
+        assert worksheet.row_count == 150  # Не больше max_rows
+
+        capacity.observe(worksheet, 140)
+        assert full.wait(2)
+        with pytest.raises(NoFreeRowError):
+            capacity.reserve(worksheet, 151)
+
+    def test_redirects_survive_reload(self, tmp_path):
+        """Переадресация листа сохраняется на диск и переживает перезагрузку маршрутов"""
+        from datetime import datetime
+        from capacity import period_title
+        from routing import ChatRouter
+
+        config = {'roles': {'admin': {'sheet': 'Админ'}}, 'chats': {'-1': 'admin'}}
+        path = str(tmp_path / 'redirects.json')
+        router = ChatRouter(None, 'main', fallback_config=config, redirects_path=path)
+        router.load()
+
+        router.redirect(('main', 'Админ'), ('main', 'Админ 2025-03'))
+        router.redirect(('main', 'Админ 2025-03'), ('main', 'Админ 2025-03 (2)'))
+        assert router.lookup(-1).sheet_name == 'Админ 2025-03 (2)'
+        assert router.resolve('main', 'Админ') == ('main', 'Админ 2025-03 (2)')
+        assert router.origin('main', 'Админ 2025-03 (2)') == ('main', 'Админ')
+
+        restarted = ChatRouter(None, 'main', fallback_config=config, redirects_path=path)
+        restarted.load()
+        assert restarted.lookup(-1).sheet_name == 'Админ 2025-03 (2)'
+
+        existing = {'Админ', 'Админ 2025-03', 'Админ 2025-03 (2)'}
+        assert period_title('Админ', existing, now=datetime(2025, 3, 31)) == 'Админ 2025-03 (3)'
+        assert period_title('Админ', existing, now=datetime(2025, 4, 1)) == 'Админ 2025-04'
+
+class TestShardMap:
+    """Тесты карты таблиц-шардов"""
+
+    def test_new_shard_does_not_move_old_keys(self, tmp_path):
+        """Закрепления переживают перезапуск; новый шард получает только новые проекты"""
+        from shards import ShardMap
+
+        path = tmp_path / 'shards.json'
+        state = str(tmp_path / 'assignments.json')
+        path.write_text(json.dumps({
+            'key': 'project',
+            'shards': {'a': {'spreadsheet_id': 'sheet-a'}, 'b': {'spreadsheet_id': 'sheet-b'}}
+        }), encoding='utf8')
+        shard_map = ShardMap(str(path), state, 'keys.json').load()
+        before = {project: shard_map.shard_for(-1, project).name for project in ('Объект1', 'Объект2', 'Объект3')}
+        assert set(before.values()) == {'a', 'b'}  # Новые ключи — в наименее занятый шард
+        assert shard_map.shard_for(-2, '  объект1 ').name == before['Объект1']
+
+        path.write_text(json.dumps({
+            'key': 'project',
+            'shards': {
+                'a': {'spreadsheet_id': 'sheet-a', 'open': False},
+                'b': {'spreadsheet_id': 'sheet-b', 'open': False},
+                'c': {'spreadsheet_id': 'sheet-c', 'credentials': 'keys-c.json'}
+            }
+        }), encoding='utf8')
+        reloaded = ShardMap(str(path), state, 'keys.json').load()
+        assert {project: reloaded.shard_for(-1, project).name for project in before} == before
+        assert reloaded.shard_for(-1, 'Объект4').name == 'c'
+        assert reloaded.credentials_for('sheet-c') == 'keys-c.json'
+        assert reloaded.credentials_for('sheet-a') == 'keys.json'
+
+    def test_fixed_assignments_and_validation(self, tmp_path):
+        """Явные назначения главнее автоматических; ссылки на неизвестный шард — ошибка"""
+        from shards import ShardMap, ShardMapError
+
+        path = tmp_path / 'shards.json'
+        path.write_text(json.dumps({
+            'shards': {'a': {'spreadsheet_id': 'sheet-a'}, 'b': {'spreadsheet_id': 'sheet-b'}},
+            'chats': {'-100': 'b'},
+            'projects': {'Архив': 'a'}
+        }), encoding='utf8')
+        shard_map = ShardMap(str(path), None, 'keys.json').load()
+        assert shard_map.shard_for(-100, 'Объект1').name == 'b'
+        assert shard_map.shard_for(-200, 'архив').name == 'a'
+        assert ShardMap(str(tmp_path / 'missing.json'), None, 'keys.json').load().shard_for(-1) is None
+
+        path.write_text(json.dumps({'shards': {'a': {'spreadsheet_id': 'x'}}, 'chats': {'-1': 'z'}}), encoding='utf8')
+        with pytest.raises(ShardMapError):
+            ShardMap(str(path), None, 'keys.json').load()
+
+class TestReferenceDictionaries:
+    """Тесты проверки полей по справочникам"""
+
+    def _references(self, columns):
+        from invoice_parser import InvoiceParser
+        from reference import ReferenceDictionaries
+
+        references = ReferenceDictionaries(lambda: columns, InvoiceParser().fields, ttl=600)
+        assert references.refresh()
+        return references
+
+    def test_typo_gets_suggestion_and_exact_match_is_canonical(self):
+        """Опечатка отклоняется с подсказкой; регистр, пробелы и ё приводятся к справочнику"""
+        references = self._references({
+            'project': ['Стройка МСК', 'Стройка СПб', 'Ремонт офиса'],
+            'category': ['Материалы', 'Расчёты с подрядчиками']
+        })
+
+        checked = references.check({'project': 'Стройка МКС', 'category': 'Материалы', 'amount': 100.0})
+        assert len(checked.errors) == 1
+        assert "'Название чата'" in checked.errors[0]
+        assert "Возможно, вы имели в виду: 'Стройка МСК'" in checked.errors[0]
+
+        checked = references.check({'project': '  стройка  мск ', 'category': 'расчеты с подрядчиками'})
+        assert checked.errors == []
+        assert checked.values['project'] == 'Стройка МСК'
+        assert checked.values['category'] == 'Расчёты с подрядчиками'
+
+        # Поля без столбца в справочнике не проверяются
+        assert references.check({'supplier': 'Кто угодно'}).errors == []
+
+    def test_sheet_headers_and_failed_reload(self):
+        """Столбцы находятся по имени, названию или синониму; сбой чтения оставляет старые индексы"""
+        from unittest.mock import Mock
+
+        from invoice_parser import InvoiceParser
+        from reference import ReferenceDictionaries, load_reference_sheet
+
+        worksheet = Mock()
+        worksheet.get_all_values.return_value = [
+            ['Проект', 'Поставщик', 'Примечание', 'stage'],
+            ['Стройка МСК', 'ООО Ромашка', 'x', 'Фундамент'],
+            ['Ремонт офиса', '', '', 'Кровля'],
+        ]
+        fields = InvoiceParser().fields
+        columns = load_reference_sheet(worksheet, fields)
+        assert columns == {
+            'project': ['Стройка МСК', 'Ремонт офиса'],
+            'supplier': ['ООО Ромашка'],
+            'stage': ['Фундамент', 'Кровля']
+        }
+
+        now = [0.0]
+        load = Mock(side_effect=[columns, Exception('quota')])
+        references = ReferenceDictionaries(load, fields, ttl=10, clock=lambda: now[0])
+        assert references.refresh()
+        assert not references.refresh()
+        assert references.check({'stage': 'Кровл'}).errors  # Индексы первой загрузки на месте
+        assert references.check({'stage': 'кровля'}).values['stage'] == 'Кровля'
+
+
 def run_tests():
     """Запуск всех тестов"""
     print("🧪 Запуск тестов конфигурации...")
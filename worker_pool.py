@@ -0,0 +1,109 @@
+"""
+Ограниченный пул потоков с сохранением порядка внутри ключа
+
+Задачи с разными ключами (листами) выполняются параллельно, задачи с одним
+ключом — строго по очереди в порядке поступления. Размер пула, общая
+очередь и очередь на один ключ ограничены; при переполнении submit сразу
+бросает PoolFullError, не блокируя вызывающий поток.
+"""
+
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class PoolFullError(Exception):
+    """Очередь пула или ключа переполнена"""
+
+
+class KeyedWorkerPool:
+    """Пул потоков: параллельно по ключам, последовательно внутри ключа"""
+
+    def __init__(self, workers=4, max_queue=1000, max_per_key=200, name='worker'):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_per_key = max_per_key
+        self._backlogs = {}  # ключ -> deque задач
+        self._ready = deque()  # ключи с задачами, которые сейчас никто не выполняет
+        self._running = set()
+        self._queued = 0
+        self._rejected = 0
+        self._completed = 0
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._threads = [
+            threading.Thread(target=self._worker, name=f'{name}-{i}', daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, key, fn, *args):
+        """Ставит задачу в очередь ключа; не блокирует"""
+        with self._cond:
+            if self._stopped:
+                raise PoolFullError("Пул остановлен")
+            backlog = self._backlogs.get(key)
+            if self._queued >= self.max_queue or (backlog is not None and len(backlog) >= self.max_per_key):
+                self._rejected += 1
+                raise PoolFullError(f"Очередь переполнена (всего {self._queued}, ключ {key})")
+            if backlog is None:
+                backlog = self._backlogs[key] = deque()
+                if key not in self._running:
+                    self._ready.append(key)
+            backlog.append((fn, args))
+            self._queued += 1
+            self._cond.notify()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._ready and not self._stopped:
+                    self._cond.wait()
+                if not self._ready:
+                    return
+                key = self._ready.popleft()
+                backlog = self._backlogs[key]
+                fn, args = backlog.popleft()
+                if not backlog:
+                    del self._backlogs[key]
+                self._queued -= 1
+                self._running.add(key)
+
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.error(f"❌ Ошибка задачи пула для ключа {key}: {e}")
+
+            with self._cond:
+                self._running.discard(key)
+                self._completed += 1
+                # Следующая задача ключа встаёт в конец — ключи обслуживаются по кругу
+                if key in self._backlogs:
+                    self._ready.append(key)
+                    self._cond.notify()
+
+    def stats(self):
+        """Текущее состояние пула для логов и мониторинга"""
+        with self._cond:
+            return {
+                'workers': self.workers,
+                'queued': self._queued,
+                'active': len(self._running),
+                'rejected': self._rejected,
+                'completed': self._completed,
+                'max_queue': self.max_queue,
+                'max_per_key': self.max_per_key,
+                'backlog': {str(key): len(backlog) for key, backlog in self._backlogs.items()}
+            }
+
+    def shutdown(self, wait=True, timeout=None):
+        """Дорабатывает уже принятые задачи и останавливает потоки"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join(timeout)
@@ -0,0 +1,63 @@
+"""
+Кэш объектов листов Google Sheets
+
+``spreadsheet.worksheet(name)`` при каждом вызове запрашивает метаданные
+таблицы. Кэш получает все листы одним запросом ``worksheets()`` и отдаёт их
+из памяти, пока не истечёт ``ttl`` или пока лист не будет сброшен после
+ошибки API.
+"""
+
+import logging
+import threading
+import time
+
+from gspread.exceptions import WorksheetNotFound
+
+logger = logging.getLogger(__name__)
+
+
+class WorksheetCache:
+    """Листы таблицы по названию с обновлением по TTL"""
+
+    def __init__(self, spreadsheet, ttl=600):
+        self.spreadsheet = spreadsheet
+        self.ttl = ttl
+        self._worksheets = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def _is_stale(self):
+        return self._loaded_at is None or time.monotonic() - self._loaded_at >= self.ttl
+
+    def refresh(self):
+        """Загружает все листы таблицы одним запросом метаданных"""
+        worksheets = self.spreadsheet.worksheets()
+        self._worksheets = {worksheet.title: worksheet for worksheet in worksheets}
+        self._loaded_at = time.monotonic()
+        logger.info(f"🔄 Кэш листов обновлён: {', '.join(self._worksheets)}")
+
+    def get(self, title):
+        """Возвращает лист по названию; сеть используется только при промахе или устаревании"""
+        with self._lock:
+            worksheet = self._worksheets.get(title)
+            if worksheet is None or self._is_stale():
+                try:
+                    self.refresh()
+                except Exception as e:
+                    if worksheet is None:
+                        raise
+                    # Таблица недоступна — продолжаем работать с устаревшим объектом листа
+                    logger.warning(f"⚠️ Не удалось обновить кэш листов, используем прежний '{title}': {e}")
+                    return worksheet
+                worksheet = self._worksheets.get(title)
+            if worksheet is None:
+                raise WorksheetNotFound(title)
+            return worksheet
+
+    def invalidate(self, title=None):
+        """Сбрасывает лист (или весь кэш), следующий get перечитает метаданные"""
+        with self._lock:
+            if title is None:
+                self._worksheets = {}
+            else:
+                self._worksheets.pop(title, None)
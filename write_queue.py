@@ -0,0 +1,163 @@
+"""
+Очередь отложенной записи (write-behind) строк реестра в Google Sheets
+
+Обработчики сообщений кладут подготовленные строки в очередь и сразу
+освобождаются. Фоновый поток накапливает строки в течение окна
+``flush_interval`` или до ``max_batch_size`` штук, группирует их по листам
+и записывает каждую группу одним вызовом ``batch_update``.
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+from gspread.utils import ValueInputOption, rowcol_to_a1
+
+logger = logging.getLogger(__name__)
+
+
+class NoFreeRowError(Exception):
+    """В листе не осталось строк для записи"""
+
+
+def row_range(row_number, width):
+    """Возвращает A1-диапазон строки, например 'A5:L5'"""
+    return f"{rowcol_to_a1(row_number, 1)}:{rowcol_to_a1(row_number, width)}"
+
+
+def worksheet_key(worksheet):
+    """Ключ группировки: один и тот же лист может прийти разными объектами"""
+    return (worksheet.spreadsheet_id, worksheet.id)
+
+
+class WriteBehindQueue:
+    """Накапливает строки и записывает их пачками, по одному запросу на лист"""
+
+    def __init__(self, row_allocator, flush_interval=0.5, max_batch_size=50, on_commit=None, on_error=None,
+                 metrics=None, capacity=None, on_allocate=None):
+        # row_allocator(worksheet, count) -> список номеров свободных строк
+        self.row_allocator = row_allocator
+        # on_commit(worksheet, row_numbers) и on_error(worksheet, exc) — уведомления о результате пачки
+        self.on_commit = on_commit
+        self.on_error = on_error
+        # on_allocate(worksheet, [(tag, row_number)]) — до batch_update, чтобы повтор мог проверить строку
+        self.on_allocate = on_allocate
+        self.metrics = metrics  # MetricsRegistry: время batch_update попадает в этап sheet_write
+        self.capacity = capacity  # CapacityManager: расширение листа вместо NoFreeRowError
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+        self._pending = []
+        self._cond = threading.Condition()
+        # Две пачки одного листа не должны получить одни и те же свободные строки
+        self._flush_lock = threading.Lock()
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        """Запускает фоновый поток записи"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+            self._thread.start()
+        return self
+
+    def submit(self, worksheet, row, tag=None):
+        """Ставит строку в очередь. Future вернёт номер записанной строки.
+
+        tag (например, id счёта в журнале) передаётся в on_allocate вместе с выделенной строкой.
+        """
+        future = Future()
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("Очередь записи остановлена")
+            self._pending.append((worksheet, row, future, tag))
+            # Первая строка открывает окно накопления, полная пачка его закрывает
+            if len(self._pending) == 1 or len(self._pending) >= self.max_batch_size:
+                self._cond.notify()
+        return future
+
+    def stop(self, timeout=None):
+        """Останавливает поток, предварительно записав всё накопленное"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.flush()
+
+    def pending_count(self):
+        with self._cond:
+            return len(self._pending)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._pending and not self._stopped:
+                    self._cond.wait()
+                if self._stopped and not self._pending:
+                    return
+                # Окно накопления: ждём ещё строк, но не дольше flush_interval
+                deadline = time.monotonic() + self.flush_interval
+                while len(self._pending) < self.max_batch_size and not self._stopped:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            self.flush()
+
+    def flush(self):
+        """Записывает все накопленные строки, сгруппировав их по листам"""
+        # stop() после join с таймаутом может застать фоновый поток посреди записи
+        with self._flush_lock:
+            with self._cond:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return
+
+            groups = {}
+            for worksheet, row, future, tag in batch:
+                group = groups.setdefault(worksheet_key(worksheet), (worksheet, []))
+                group[1].append((row, future, tag))
+
+            for worksheet, items in groups.values():
+                self._flush_group(worksheet, items)
+
+    def _flush_group(self, worksheet, items):
+        futures = [future for _, future, _ in items]
+        try:
+            row_numbers = self.row_allocator(worksheet, len(items))
+            if len(row_numbers) < len(items):
+                raise NoFreeRowError("Не найдена подходящая строка для записи данных")
+            last_row = max(row_numbers[:len(items)])
+            if self.capacity is not None:
+                self.capacity.reserve(worksheet, last_row)
+            if last_row > worksheet.row_count:
+                raise NoFreeRowError("Не найдена подходящая строка для записи данных")
+
+            allocations = [(tag, row_number) for row_number, (_, _, tag) in zip(row_numbers, items) if tag is not None]
+            if allocations and self.on_allocate is not None:
+                self.on_allocate(worksheet, allocations)
+
+            data = [
+                {'range': row_range(row_number, len(row)), 'values': [row]}
+                for row_number, (row, _, _) in zip(row_numbers, items)
+            ]
+            started = time.perf_counter()
+            worksheet.batch_update(data, value_input_option=ValueInputOption.user_entered)
+            if self.metrics is not None:
+                self.metrics.observe('sheet_write', time.perf_counter() - started)
+            logger.info(f"💾 Лист '{worksheet.title}': записано {len(items)} строк одним запросом")
+        except Exception as e:
+            logger.error(f"❌ Ошибка пакетной записи в лист '{worksheet.title}': {e}")
+            if self.on_error is not None:
+                self.on_error(worksheet, e)
+            for future in futures:
+                future.set_exception(e)
+            return
+
+        if self.on_commit is not None:
+            self.on_commit(worksheet, row_numbers[:len(items)])
+        if self.capacity is not None:
+            self.capacity.observe(worksheet, last_row + 1)
+        for row_number, future in zip(row_numbers, futures):
+            future.set_result(row_number)